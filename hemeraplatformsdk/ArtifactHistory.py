@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+import json
+import time
+
+from hemeraplatformsdk.BuildMetrics import metrics
+from hemeraplatformsdk.BuildTracer import tracer
+
+# Values compared between releases, and how they are called in reports
+TRACKED_VALUES = {
+    "download_size": "download size",
+    "uncompressed_size": "uncompressed size",
+    "package_count": "package count",
+    "build_seconds": "build time"
+}
+HISTORY_FILE_SUFFIX = ".history.jsonl"
+
+
+class ArtifactRegressionException(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+
+def get_default_history_file(appliance_name):
+    return appliance_name + HISTORY_FILE_SUFFIX
+
+
+def baseline_from_release_metadata(release_metadata):
+    """
+    What can be compared of a release, out of its metadata in a store.
+    """
+    return {
+        "version": release_metadata["version"],
+        "download_size": release_metadata["download_size"],
+        "package_count": len(release_metadata["packages"])
+    }
+
+
+class ArtifactHistory:
+    """
+    Keeps track of artifact sizes and build times across releases, and flags regressions.
+
+    The history is a JSON lines file, one entry per artifact built, which is only ever appended to. Each new entry
+    is compared with a baseline, usually the previous release: growth above warn_growth is reported, growth above
+    fail_growth fails the build. Both are fractions (0.1 is 10%), and can be set for each value in "thresholds".
+    Entries which failed the check are kept, but are never used as a baseline.
+    """
+    def __init__(self, filename, warn_growth=None, fail_growth=None, thresholds=None):
+        self.filename = filename
+        self.warn_growth = warn_growth
+        self.fail_growth = fail_growth
+        self.thresholds = thresholds if thresholds else {}
+
+    def load(self):
+        entries = []
+        try:
+            with open(self.filename) as history_file:
+                for line in history_file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Truncated by a crashed build, most likely.
+                        pass
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def append(self, entry):
+        with open(self.filename, "a") as history_file:
+            history_file.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def get_last_entry(self, appliance_name, artifact_type, exclude_version=None, **match):
+        for entry in reversed(self.load()):
+            if entry.get("regressions") or entry["appliance_name"] != appliance_name or \
+                    entry["artifact_type"] != artifact_type:
+                continue
+            if exclude_version and entry["version"] == exclude_version:
+                continue
+            if any(entry.get(k) != v for k, v in match.items()):
+                continue
+            return entry
+        return None
+
+    def create_entry(self, appliance_name, version, artifact_type, download_size, build_seconds,
+                     uncompressed_size=None, package_count=None, **extra):
+        entry = {
+            "timestamp": int(time.time()),
+            "appliance_name": appliance_name,
+            "version": version if version else "rolling",
+            "artifact_type": artifact_type,
+            "download_size": download_size,
+            "build_seconds": build_seconds,
+            "stages": {name: total for name, _, total in tracer.get_summary()}
+        }
+        if uncompressed_size is not None:
+            entry["uncompressed_size"] = uncompressed_size
+        if package_count is not None:
+            entry["package_count"] = package_count
+        entry.update(extra)
+        return entry
+
+    def get_threshold(self, key, kind):
+        try:
+            return self.thresholds[key][kind]
+        except KeyError:
+            return getattr(self, kind)
+
+    def compare(self, entry, baseline):
+        """
+        Returns warnings and failures, as messages.
+        """
+        warnings = []
+        failures = []
+        for key, description in TRACKED_VALUES.items():
+            try:
+                old_value = baseline[key]
+                new_value = entry[key]
+            except KeyError:
+                continue
+            if not old_value:
+                continue
+
+            growth = new_value / old_value - 1
+            metrics.set("artifact_growth_ratio", growth, "Growth of tracked values since the previous release",
+                        artifact_type=entry["artifact_type"], tracked_value=key)
+            message = "{} grew by {:.1f}% since {}: {} -> {}".format(description, growth * 100, baseline["version"],
+                                                                      old_value, new_value)
+            fail_growth = self.get_threshold(key, "fail_growth")
+            warn_growth = self.get_threshold(key, "warn_growth")
+            if fail_growth is not None and growth > fail_growth:
+                failures.append(message)
+            elif warn_growth is not None and growth > warn_growth:
+                warnings.append(message)
+        return warnings, failures
+
+    def record(self, entry, baseline):
+        """
+        Appends entry to the history, and fails if it regressed too much compared to baseline.
+        """
+        warnings = []
+        failures = []
+        if baseline:
+            print("-- Comparing {} {} with {}".format(entry["artifact_type"], entry["version"], baseline["version"]))
+            warnings, failures = self.compare(entry, baseline)
+        else:
+            print("-- No previous {} to compare {} with".format(entry["artifact_type"], entry["version"]))
+
+        if failures:
+            entry["regressions"] = failures
+        self.append(entry)
+        print("--- Recorded in {}".format(self.filename))
+
+        for message in warnings:
+            print("--- WARNING: " + message)
+        for message in failures:
+            print("--- ERROR: " + message)
+        if failures:
+            raise ArtifactRegressionException("{} {} regressed: {}".format(entry["artifact_type"], entry["version"],
+                                                                           "; ".join(failures)))
+
+
+def create_artifact_history(regression_tracking, appliance_name):
+    return ArtifactHistory(regression_tracking.get("history_file", get_default_history_file(appliance_name)),
+                           warn_growth=regression_tracking.get("warn_growth"),
+                           fail_growth=regression_tracking.get("fail_growth"),
+                           thresholds=regression_tracking.get("thresholds"))
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from hemeraplatformsdk.FileUploader import StoreNotAvailableException
+from hemeraplatformsdk.ImageBuilder import get_available_memory
+from hemeraplatformsdk.ImageConfigurationManager import ImageConfigurationManager
+
+BUILD_COMMAND = "from hemeraplatformsdk.ImageBuilder import build_hemera_image; build_hemera_image()"
+# mic, mksquashfs and compressors use a few cores each
+CPUS_PER_BUILD = 4
+# When the host does not tell how many loop devices it has
+DEFAULT_LOOP_DEVICES = 8
+
+
+def count_free_loop_devices():
+    loop_devices = [d for d in os.listdir("/sys/block") if d.startswith("loop")] if os.path.isdir("/sys/block") \
+        else []
+    if not loop_devices:
+        # Created on demand
+        return DEFAULT_LOOP_DEVICES
+    return len([d for d in loop_devices if not os.path.exists(os.path.join("/sys/block", d, "loop", "backing_file"))])
+
+
+def estimate_rootfs_size(image):
+    """
+    Upper bound of the size of mic's rootfs in bytes, out of the configuration alone. None if it can't be told.
+    """
+    try:
+        return image["rootfs_size_estimate"] * 1024 * 1024
+    except KeyError:
+        pass
+    if image["type"] != "raw":
+        return None
+    # Whatever mic makes has to fit in the partitions.
+    size = 0
+    for d in image["devices"]:
+        size += d.get("size", 0) + sum(p.get("size", 0) for p in d.get("partitions", []))
+    return size * 1024 * 1024 if size else None
+
+
+def estimate_peak_disk_usage(configuration):
+    # Same as ImageBuilder's, before any builder exists.
+    rootfs_size = estimate_rootfs_size(configuration["image"])
+    if rootfs_size is None:
+        return None
+    peak = 2 * rootfs_size
+    if "installer" in configuration:
+        installer_rootfs_size = estimate_rootfs_size(configuration["installer"])
+        peak += (2 * installer_rootfs_size if installer_rootfs_size else 0) + 2 * rootfs_size
+    return peak
+
+
+def count_loop_devices(configuration):
+    """
+    How many loop devices a build may hold at once: one per device of raw images, which may be packaged concurrently.
+    """
+    count = 0
+    for key in ["image", "installer"]:
+        if key in configuration and configuration[key]["type"] == "raw":
+            count += len(configuration[key]["devices"])
+    if "crypto" in configuration:
+        # Encrypted packages
+        count += 1
+    return count
+
+
+class BuildMatrix:
+    """
+    Builds variants, versions and arches of one appliance concurrently, each in its own directory and process.
+
+    Builds are started in order, as long as the host can take them: at most jobs at once, within the free disk space
+    of the work directory and the loop devices available. Builds of the same arch share mic's package cache: the
+    first one runs alone and fills it, so that the others only find what they need in there, at most mic_cache_jobs
+    at once. Releases which are already in a store are not built at all.
+    """
+    def __init__(self, metadata, work_dir, jobs, mic_cache_jobs, loop_devices, disk_space, disk_per_build=None,
+                 build_args=None, metrics_dir=None):
+        with open(metadata) as data_file:
+            self.configuration = json.load(data_file)
+        self.metadata = os.path.abspath(metadata)
+        self.work_dir = work_dir
+        self.jobs = jobs
+        self.mic_cache_jobs = mic_cache_jobs
+        self.build_args = build_args if build_args else []
+        self.disk_per_build = disk_per_build
+        self.metrics_dir = metrics_dir
+
+        self.entries = []
+        # What running builds leave to the others
+        self.available = {"jobs": jobs, "disk": disk_space, "loop_devices": loop_devices}
+        # arch -> whether mic's cache was filled by a build of that arch
+        self.warm_caches = {}
+        self.cache_builds = {}
+        self.condition = threading.Condition()
+
+    def add_entry(self, variant=None, version=None, arch=None, arch_in_name=False):
+        configuration = json.loads(json.dumps(self.configuration))
+        if arch:
+            configuration["image"]["arch"] = arch
+            if "installer" in configuration:
+                configuration["installer"]["arch"] = arch
+            if arch_in_name:
+                # Stores tell releases apart by name, not arch.
+                configuration["image"]["name"] += "_" + arch
+                if "installer" in configuration and "name" in configuration["installer"]:
+                    configuration["installer"]["name"] += "_" + arch
+
+        name = "-".join(p for p in [variant, version, arch] if p)
+        env = os.environ.copy()
+        env.pop("CI_BUILD_TAG", None)
+        if version:
+            env["CI_BUILD_TAG"] = variant + "_" + version if variant else version
+        else:
+            env["CI_BUILD_REF_NAME"] = variant if variant else "master"
+
+        peak_disk = estimate_peak_disk_usage(configuration)
+        if peak_disk is None and self.disk_per_build:
+            peak_disk = self.disk_per_build
+
+        self.entries.append({
+            "name": name if name else "default",
+            "variant": variant,
+            "version": version,
+            "arch": configuration["image"]["arch"],
+            "configuration": configuration,
+            "metadata": self.metadata if configuration == self.configuration else None,
+            "env": env,
+            "resources": {"jobs": 1, "disk": peak_disk if peak_disk else 0,
+                          "loop_devices": count_loop_devices(configuration)},
+            "result": "pending"
+        })
+
+    def find_released_entries(self):
+        """
+        Marks the entries whose release is already in a store. The stores are asked once, rather than by each build.
+        """
+        configuration = ImageConfigurationManager(self.metadata)
+        for entry in self.entries:
+            if not entry["version"]:
+                continue
+            for u in configuration.get_upload_managers():
+                try:
+                    if u.check_store_has_image(entry["configuration"]["image"]["name"],
+                                               entry["configuration"]["image"]["group"],
+                                               version=entry["version"], variant=entry["variant"]):
+                        print("-- {} is already in {}, not building it".format(entry["name"], str(u)))
+                        entry["result"] = "in store"
+                        break
+                except FileNotFoundError:
+                    pass
+                except StoreNotAvailableException:
+                    print("-- WARNING: Could not check whether {} has {}".format(str(u), entry["name"]))
+
+    def can_start(self, entry):
+        arch = entry["arch"]
+        if arch in self.warm_caches:
+            if not self.warm_caches[arch] or self.cache_builds.get(arch, 0) >= self.mic_cache_jobs:
+                # The cache is being filled, or is busy enough.
+                return False
+        if not any(e["result"] == "running" for e in self.entries):
+            # Whatever it needs, it can't get more than everything.
+            return True
+        return all(amount <= self.available[resource] for resource, amount in entry["resources"].items())
+
+    def acquire(self, entry):
+        for resource, amount in entry["resources"].items():
+            self.available[resource] -= amount
+        self.warm_caches.setdefault(entry["arch"], False)
+        self.cache_builds[entry["arch"]] = self.cache_builds.get(entry["arch"], 0) + 1
+        entry["result"] = "running"
+
+    def release(self, entry, returncode):
+        with self.condition:
+            for resource, amount in entry["resources"].items():
+                self.available[resource] += amount
+            # Whatever the outcome, whatever could be downloaded is in the cache now.
+            self.warm_caches[entry["arch"]] = True
+            self.cache_builds[entry["arch"]] -= 1
+            entry["result"] = "ok" if returncode == 0 else "failed"
+            self.condition.notify()
+
+    def run_build(self, entry):
+        build_dir = os.path.join(self.work_dir, entry["name"])
+        entry["directory"] = build_dir
+        entry["log"] = os.path.join(build_dir, entry["name"] + ".log")
+        build_args = list(self.build_args)
+        if self.metrics_dir:
+            build_args += ["--metrics", os.path.join(self.metrics_dir, entry["name"] + ".prom")]
+
+        start = time.perf_counter()
+        returncode = None
+        try:
+            # Whatever happens from now on, the build's resources have to go back to the others.
+            os.makedirs(build_dir, exist_ok=True)
+            metadata = entry["metadata"]
+            if not metadata:
+                metadata = os.path.join(build_dir, os.path.basename(self.metadata))
+                with open(metadata, "w") as outfile:
+                    json.dump(entry["configuration"], outfile, indent=4)
+            with open(entry["log"], "w") as log:
+                returncode = subprocess.call([sys.executable, "-c", BUILD_COMMAND, metadata] + build_args,
+                                             cwd=build_dir, env=entry["env"], stdout=log, stderr=subprocess.STDOUT)
+        finally:
+            entry["wall_time"] = time.perf_counter() - start
+            self.release(entry, returncode)
+
+        print("--- {} {} in {:.1f} s".format(entry["name"], "built" if returncode == 0 else "failed",
+                                            entry["wall_time"]))
+        if returncode != 0:
+            print("---- See {}".format(entry["log"]))
+
+    def run(self):
+        threads = []
+        pending = [e for e in self.entries if e["result"] == "pending"]
+        with self.condition:
+            while pending:
+                entry = next((e for e in pending if self.can_start(e)), None)
+                if not entry:
+                    self.condition.wait()
+                    continue
+                pending.remove(entry)
+                self.acquire(entry)
+                print("-- Building {}".format(entry["name"]))
+                thread = threading.Thread(target=self.run_build, args=(entry,))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        for entry in self.entries:
+            entry["download_size"] = None
+            if entry["result"] != "ok":
+                continue
+            for f in os.listdir(entry["directory"]):
+                if f.endswith(".metadata"):
+                    with open(os.path.join(entry["directory"], f)) as data_file:
+                        entry["download_size"] = json.load(data_file)["download_size"]
+
+    def print_summary(self):
+        print("-- {:<30} {:<10} {:>10} {:>12}".format("build", "result", "wall (s)", "size (MB)"))
+        for entry in self.entries:
+            print("-- {:<30} {:<10} {:>10} {:>12}".format(
+                entry["name"], entry["result"],
+                "{:.1f}".format(entry["wall_time"]) if "wall_time" in entry else "-",
+                "{:.1f}".format(entry["download_size"] / 1048576) if entry.get("download_size") else "-"))
+
+    def get_summary(self):
+        return [{k: v for k, v in entry.items() if k not in ("configuration", "env", "metadata")}
+                for entry in self.entries]
+
+
+def build_hemera_image_matrix(args_parameter=None):
+    parser = argparse.ArgumentParser(description='Builds variants, versions and arches of a Hemera image '
+                                                 'concurrently')
+    parser.add_argument('metadata', type=str, help="The image's metadata")
+    parser.add_argument('--variant', type=str, action='append',
+                        help="Build this variant. Can be given more than once")
+    parser.add_argument('--version', type=str, action='append',
+                        help="Build this version, rather than a rolling image. Can be given more than once")
+    parser.add_argument('--arch', type=str, action='append',
+                        help="Build for this arch rather than the one in the metadata. Can be given more than once: "
+                             "the arch is then appended to the image name")
+    parser.add_argument('--work-dir', type=str, default=".",
+                        help="Where to build, in a directory per build. Defaults to the current directory")
+    parser.add_argument('--jobs', type=int, default=max(1, (os.cpu_count() or 1) // CPUS_PER_BUILD),
+                        help="How many builds can run at once. Defaults to one every {} CPUs".format(CPUS_PER_BUILD))
+    parser.add_argument('--mic-cache-jobs', type=int, default=2,
+                        help="How many builds of an arch can use mic's package cache at once, once it was filled")
+    parser.add_argument('--loop-devices', type=int, help="How many loop devices builds can use. Defaults to the "
+                                                         "free ones")
+    parser.add_argument('--disk-per-build', type=int,
+                        help="Disk space builds take, in MB, when it can't be told from the metadata")
+    parser.add_argument('--skip-cleanup', action='store_true',
+                        help='Skips the cleanup phase of each build. Warning: this will leave build artifacts around!')
+    parser.add_argument('--skip-upload', action='store_true',
+                        help='Skips the upload phase. Use for local testing.')
+    parser.add_argument('--skip-crypto', action='store_true',
+                        help='Skips the crypto instruction. WARNING: Use for local testing only!!')
+    parser.add_argument('--scratch', type=str, choices=["disk", "tmpfs"], default="disk",
+                        help="Where builds keep their intermediates. The memory budget is shared between jobs")
+    parser.add_argument('--memory-budget', type=int,
+                        help="Memory tmpfs scratch spaces may take altogether, in MB. Defaults to half the available "
+                             "memory")
+    parser.add_argument('--pipeline-installer', action='store_true',
+                        help='Installs the installer\'s packages while the embedded image is being built')
+    parser.add_argument('--metrics-dir', type=str,
+                        help="Where to write the metrics of each build, as OpenMetrics text files")
+    parser.add_argument('--json', type=str, help="Write the results to this JSON file")
+
+    if args_parameter:
+        args = parser.parse_args(args=args_parameter)
+    else:
+        args = parser.parse_args()
+
+    for variant in args.variant if args.variant else []:
+        if "_" in variant:
+            parser.error("Variants can't contain '_', it separates them from versions in build tags: " + variant)
+
+    build_args = []
+    for flag in ["skip_cleanup", "skip_upload", "skip_crypto", "pipeline_installer"]:
+        if getattr(args, flag):
+            build_args.append("--" + flag.replace("_", "-"))
+    build_args += ["--scratch", args.scratch]
+    if args.scratch == "tmpfs":
+        memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else get_available_memory() // 2
+        build_args += ["--memory-budget", str(max(1, memory_budget // args.jobs // 1048576))]
+
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    matrix = BuildMatrix(args.metadata, work_dir, args.jobs, args.mic_cache_jobs,
+                         args.loop_devices if args.loop_devices is not None else count_free_loop_devices(),
+                         shutil.disk_usage(work_dir).free,
+                         disk_per_build=args.disk_per_build * 1024 * 1024 if args.disk_per_build else None,
+                         build_args=build_args,
+                         metrics_dir=os.path.abspath(args.metrics_dir) if args.metrics_dir else None)
+    for variant in args.variant if args.variant else [None]:
+        for version in args.version if args.version else [None]:
+            for arch in args.arch if args.arch else [None]:
+                matrix.add_entry(variant, version, arch, arch_in_name=args.arch and len(args.arch) > 1)
+
+    print("-- Building {} images, up to {} at once, in {}".format(len(matrix.entries), args.jobs, work_dir))
+    if not args.skip_upload:
+        matrix.find_released_entries()
+    matrix.run()
+    matrix.print_summary()
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(matrix.get_summary(), outfile, indent=4)
+
+    if any(entry["result"] == "failed" for entry in matrix.entries):
+        exit(1)
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import threading
+import time
+
+from hemeraplatformsdk.BuildTracer import tracer
+from hemeraplatformsdk.ProcessExecutor import executor
+
+METRIC_PREFIX = "hemera_"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class BuildMetrics:
+    """
+    Collects metrics about a build and its uploads, and writes them as an OpenMetrics text file.
+
+    Each file describes a single run, so every metric is a gauge: point node_exporter's textfile collector at the
+    directory the file is written to. Stage durations and tool usage are taken from the tracer and the executor when
+    the file is written. Common labels (appliance, version...) are added to every sample.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.labels = {}
+        # name -> [help, {sorted labels: value}]
+        self.metrics = {}
+
+    def reset(self):
+        with self.lock:
+            self.labels = {}
+            self.metrics = {}
+
+    def set_labels(self, **labels):
+        with self.lock:
+            self.labels.update({k: v for k, v in labels.items() if v is not None})
+
+    def set(self, name, value, help_text, **labels):
+        with self.lock:
+            samples = self.metrics.setdefault(name, [help_text, {}])[1]
+            samples[tuple(sorted(labels.items()))] = value
+
+    def add(self, name, value, help_text, **labels):
+        with self.lock:
+            samples = self.metrics.setdefault(name, [help_text, {}])[1]
+            key = tuple(sorted(labels.items()))
+            samples[key] = samples.get(key, 0) + value
+
+    def get(self, name, **labels):
+        with self.lock:
+            try:
+                return self.metrics[name][1].get(tuple(sorted(labels.items())))
+            except KeyError:
+                return None
+
+    def record_hashing(self, algorithm, size, seconds):
+        self.add("hash_bytes", size, "Bytes hashed", algorithm=algorithm)
+        self.add("hash_seconds", seconds, "Time spent hashing", algorithm=algorithm)
+        total_seconds = self.get("hash_seconds", algorithm=algorithm)
+        self.set("hash_bytes_per_second", self.get("hash_bytes", algorithm=algorithm) / total_seconds
+                 if total_seconds else 0, "Hashing throughput", algorithm=algorithm)
+
+    def record_upload(self, store, size, seconds):
+        self.add("upload_bytes", size, "Bytes uploaded", store=store)
+        self.add("upload_seconds", seconds, "Time spent uploading", store=store)
+        total_seconds = self.get("upload_seconds", store=store)
+        self.set("upload_bytes_per_second", self.get("upload_bytes", store=store) / total_seconds
+                 if total_seconds else 0, "Upload throughput", store=store)
+
+    def collect_run_metrics(self):
+        for name, count, total in tracer.get_summary():
+            self.set("stage_seconds", total, "Time spent in each stage of the build", stage=name)
+            self.set("stage_runs", count, "Number of times each stage of the build ran", stage=name)
+        for s in executor.get_summary():
+            self.set("tool_seconds", s["wall_time"], "Wall time spent running each external tool", tool=s["tool"])
+            self.set("tool_cpu_seconds", s["user_time"] + s["system_time"], "CPU time used by each external tool",
+                     tool=s["tool"])
+            self.set("tool_max_rss_bytes", s["max_rss"], "Peak RSS of each external tool", tool=s["tool"])
+            self.set("tool_runs", s["count"], "Number of times each external tool ran", tool=s["tool"])
+
+    def format_sample(self, name, labels, value):
+        labels = dict(self.labels, **dict(labels))
+        label_string = ",".join('{}="{}"'.format(k, escape_label_value(v)) for k, v in sorted(labels.items()))
+        return "{}{}{} {}".format(METRIC_PREFIX, name, "{" + label_string + "}" if label_string else "",
+                                  repr(float(value)) if isinstance(value, float) else int(value))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (help_text, samples) in sorted(self.metrics.items()):
+                lines.append("# TYPE {}{} gauge".format(METRIC_PREFIX, name))
+                lines.append("# HELP {}{} {}".format(METRIC_PREFIX, name, help_text))
+                for labels, value in samples.items():
+                    lines.append(self.format_sample(name, labels, value))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, filename, success=True):
+        self.collect_run_metrics()
+        self.set("success", 1 if success else 0, "Whether the run succeeded")
+        self.set("last_run_timestamp_seconds", time.time(), "When the run ended")
+
+        # Collectors must never see a partial file.
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(filename)), delete=False) as f:
+            f.write(self.render())
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, filename)
+        print("-- Metrics written to {}".format(filename))
+
+
+metrics = BuildMetrics()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class BuildTracer:
+    """
+    Records nested, timed spans of a build, and exports them as a Chrome/Perfetto trace.
+
+    Spans are cheap and always recorded: wrap any stage in "with tracer.span(name):". Spans opened from
+    different threads end up on different tracks. The span yields its arguments, which can be filled in while
+    the span runs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.thread_ids = {}
+        self.origin = time.perf_counter()
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.thread_ids = {}
+            self.origin = time.perf_counter()
+
+    def get_thread_id(self):
+        # Small, stable ids look better than native ones in trace viewers.
+        with self.lock:
+            return self.thread_ids.setdefault(threading.get_ident(), len(self.thread_ids) + 1)
+
+    @contextlib.contextmanager
+    def span(self, name, category="build", **args):
+        thread_id = self.get_thread_id()
+        start = time.perf_counter()
+        try:
+            yield args
+        except:
+            args["failed"] = True
+            raise
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) * 1000000,
+                "dur": (end - start) * 1000000,
+                "pid": os.getpid(),
+                "tid": thread_id
+            }
+            if args:
+                event["args"] = {k: str(v) for k, v in args.items()}
+            with self.lock:
+                self.events.append(event)
+
+    def write_trace(self, filename):
+        with self.lock:
+            events = sorted(self.events, key=lambda e: e["ts"])
+        with open(filename, "w") as outfile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, outfile)
+
+    def get_summary(self):
+        """
+        Total time and number of occurrences of each span, by name, longest first.
+        """
+        with self.lock:
+            events = list(self.events)
+
+        summary = {}
+        for e in events:
+            count, total = summary.get(e["name"], (0, 0))
+            summary[e["name"]] = count + 1, total + e["dur"] / 1000000
+        return sorted(((name, count, total) for name, (count, total) in summary.items()),
+                      key=lambda s: s[2], reverse=True)
+
+    def print_summary(self):
+        summary = self.get_summary()
+        if not summary:
+            return
+        # The longest span is the whole build.
+        build_time = summary[0][2]
+        print("-- {:<40} {:>6} {:>12} {:>8}".format("stage", "count", "time (s)", "%"))
+        for name, count, total in summary:
+            print("-- {:<40} {:>6} {:>12.2f} {:>8.1f}".format(name, count, total,
+                                                              100 * total / build_time if build_time else 0))
+
+
+tracer = BuildTracer()
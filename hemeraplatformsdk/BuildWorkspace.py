@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from hemeraplatformsdk.ProcessExecutor import executor
+
+WORKSPACE_ROOT = "/tmp/hemera-workspaces"
+LOCK_FILE = ".lock"
+MOUNTS_FILE = ".mounts"
+KEEP_FILE = ".keep"
+
+
+def get_workspace_root():
+    return os.environ.get("HEMERA_WORKSPACE_DIR", WORKSPACE_ROOT)
+
+
+def get_mountpoints():
+    mountpoints = []
+    with open("/proc/self/mountinfo") as mountinfo:
+        for line in mountinfo:
+            # Spaces and such are octal escaped.
+            mountpoints.append(line.split()[4].encode("latin-1").decode("unicode_escape"))
+    return mountpoints
+
+
+def unmount_all(paths):
+    """
+    Unmounts whatever is mounted at, or below, any of paths. Innermost mounts go first.
+    """
+    paths = [os.path.abspath(p) for p in paths]
+    mounted = [m for m in get_mountpoints()
+               if any(m == p or m.startswith(p.rstrip("/") + "/") for p in paths)]
+    for mountpoint in sorted(set(mounted), key=lambda m: m.count("/"), reverse=True):
+        print("--- Unmounting leftover {}".format(mountpoint))
+        try:
+            executor.check_call(["umount", "-l", mountpoint])
+        except subprocess.CalledProcessError:
+            print("--- WARNING: Could not unmount {}".format(mountpoint))
+
+
+class BuildWorkspace:
+    """
+    Scratch space of a single build: mountpoints, staged trees and generated configuration files.
+
+    The workspace is a unique directory, created on first use, so that several builds can run on the same host.
+    It holds a lock for as long as its build runs: a workspace whose lock can be taken belongs to a build which died,
+    and prune_stale_workspaces gets rid of it, along with whatever the build left mounted. Mounts a build makes
+    outside of its workspace should be recorded with add_mount, to be found in there.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.lock_file = None
+
+    def get_path(self, *names):
+        with self.lock:
+            if not self.path:
+                os.makedirs(get_workspace_root(), exist_ok=True)
+                self.path = tempfile.mkdtemp(prefix="build-{}-".format(os.getpid()), dir=get_workspace_root())
+                # The lock only shows up once held: pruning must not take a starting build for a dead one.
+                self.lock_file = open(os.path.join(self.path, LOCK_FILE + ".tmp"), "w")
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+                os.rename(os.path.join(self.path, LOCK_FILE + ".tmp"), os.path.join(self.path, LOCK_FILE))
+                print("--- Build workspace: {}".format(self.path))
+        path = os.path.join(self.path, *names)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def add_mount(self, mountpoint):
+        with open(os.path.join(self.get_path(), MOUNTS_FILE), "a") as mounts_file:
+            mounts_file.write(json.dumps(os.path.abspath(mountpoint)) + "\n")
+
+    def release(self, keep=False):
+        with self.lock:
+            if not self.path:
+                return
+            if keep:
+                print("-- Build workspace kept in {}".format(self.path))
+                open(os.path.join(self.path, KEEP_FILE), "w").close()
+            else:
+                remove_workspace(self.path)
+            self.lock_file.close()
+            self.path = None
+            self.lock_file = None
+
+
+def remove_workspace(path):
+    mounts = [path]
+    try:
+        with open(os.path.join(path, MOUNTS_FILE)) as mounts_file:
+            mounts += [json.loads(line) for line in mounts_file if line.strip()]
+    except (FileNotFoundError, ValueError):
+        pass
+    unmount_all(mounts)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def prune_stale_workspaces():
+    """
+    Cleans up after builds which died without doing it, e.g. when they were killed.
+    """
+    try:
+        entries = list(os.scandir(get_workspace_root()))
+    except FileNotFoundError:
+        return
+
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False) or os.path.exists(os.path.join(entry.path, KEEP_FILE)):
+            continue
+        try:
+            with open(os.path.join(entry.path, LOCK_FILE)) as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                print("-- Cleaning up stale build workspace {}".format(entry.path))
+                remove_workspace(entry.path)
+        except BlockingIOError:
+            # A running build
+            pass
+        except FileNotFoundError:
+            # Its build is just starting, or is cleaning up.
+            pass
+
+
+workspace = BuildWorkspace()
@@ -3,6 +3,8 @@
 import io
 import json
 import os
+import re
+import tempfile
 from json import JSONDecodeError
 
 import paramiko
@@ -12,12 +14,47 @@ import time
 
 lastTimeCalled = [0.0]
 
+RELEASE_METADATA_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "hemeraplatformsdk", "releases")
+
 
 class StoreNotAvailableException(Exception):
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
 
 
+class ReleaseMetadataCache:
+    """
+    On-disk copy of the old releases' metadata of an appliance in a given store.
+
+    Released metadata never changes, so stores only need to send what is not known yet. The cache also keeps
+    whatever validators (ETag, Last-Modified, mtimes) the store uses to tell us so.
+    """
+    def __init__(self, store, appliance_name):
+        self.filename = os.path.join(os.environ.get("HEMERA_RELEASE_METADATA_CACHE_DIR", RELEASE_METADATA_CACHE_DIR),
+                                     re.sub(r"[^A-Za-z0-9_.-]+", "_", store), appliance_name + ".json")
+        self.data = {}
+
+        try:
+            with open(self.filename) as cache_file:
+                self.data = json.load(cache_file)
+        except (IOError, JSONDecodeError):
+            # No cache, or a broken one. Start from scratch.
+            pass
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        # Write atomically, concurrent builds might be reading it.
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.filename), delete=False) as outfile:
+            json.dump(self.data, outfile)
+        os.replace(outfile.name, self.filename)
+
+
 class FileUploader:
     def __init__(self, metadata):
         self.data = metadata
@@ -27,12 +64,18 @@ class FileUploader:
         except KeyError:
             self.host = self.data["host"]
 
+    def __str__(self):
+        return "{}:{}".format(self.data["type"], self.host)
+
     def check_store_has_image(self, name, group, version=None, variant=None):
         raise StoreNotAvailableException("Storage " + self.data["type"] + " does not support listing files.")
 
     def get_old_versions_from_store(self, name, group, variant=None):
         raise StoreNotAvailableException("Storage " + self.data["type"] + " does not support listing old versions.")
 
+    def check_store_has_update_package(self, name, group, from_version, version, variant=None):
+        raise StoreNotAvailableException("Storage " + self.data["type"] + " does not support listing updates.")
+
     def can_store_images(self):
         return False
 
@@ -115,21 +158,48 @@ class SCPFileUploader(FileUploader):
         match_string = name
         if variant:
             match_string += "_" + variant
+
+        # Metadata files never change once released: only read the ones we have not seen yet, or which were touched.
+        cache = ReleaseMetadataCache("scp_{}_{}_{}".format(self.host, self.data["base_upload_path"], group),
+                                     match_string)
+        cached_releases = cache.get("releases", {})
+        releases = {}
+
         with paramiko.SFTPClient.from_transport(self.client.get_transport()) as sftp:
             dirs = sftp.listdir(os.path.join(self.data["base_upload_path"], group, name, "releases"))
             for d in dirs:
-                files = sftp.listdir(os.path.join(self.data["base_upload_path"], group, name, "releases", d))
+                files = sftp.listdir_attr(os.path.join(self.data["base_upload_path"], group, name, "releases", d))
                 for f in files:
-                    if match_string + "-" + d in f and ".metadata" in f:
-                        mf = sftp.file(os.path.join(self.data["base_upload_path"], group, name, "releases", d, f))
+                    if match_string + "-" + d in f.filename and ".metadata" in f.filename:
+                        try:
+                            cached_release = cached_releases[d]
+                            if cached_release["filename"] == f.filename and cached_release["mtime"] == f.st_mtime:
+                                releases[d] = cached_release
+                                old_versions.append((d, cached_release["metadata"]))
+                                break
+                        except KeyError:
+                            pass
+
+                        mf = sftp.file(os.path.join(self.data["base_upload_path"], group, name, "releases", d,
+                                                    f.filename))
                         metadata = mf.read()
                         try:
-                            old_versions.append((d, json.loads(metadata)))
+                            releases[d] = {
+                                "filename": f.filename,
+                                "mtime": f.st_mtime,
+                                "metadata": json.loads(metadata)
+                            }
+                            old_versions.append((d, releases[d]["metadata"]))
                         except JSONDecodeError:
                             print("---- WARNING: Failed to retrieve metadata for {}! "
-                                  "Metadata is malformed. Skipping...".format(f))
+                                  "Metadata is malformed. Skipping...".format(f.filename))
                         break
 
+        print("---- {} releases found, {} of them were already cached".format(
+            len(releases), len([d for d in releases if cached_releases.get(d) is releases[d]])))
+        cache.set("releases", releases)
+        cache.save()
+
         return old_versions
 
     def upload_image(self, name, group, metadata, image, version=None, variant=None):
@@ -202,19 +272,39 @@ class ImageStoreFileUploader(FileUploader):
         except:
             appliance_name = name
 
+        # Released metadata is immutable: revalidate our local copy rather than downloading everything again.
+        cache = ReleaseMetadataCache("image_store_{}".format(self.host), appliance_name)
+        headers = {'X-API-Key': self.data["api_key"]}
+        if cache.get("releases") is not None:
+            if cache.get("etag"):
+                headers["If-None-Match"] = cache.get("etag")
+            if cache.get("last_modified"):
+                headers["If-Modified-Since"] = cache.get("last_modified")
+
         r = requests.get('{}/images/{}'.format(self.host, appliance_name),
                          verify=self.verify_ssl,
-                         headers={'X-API-Key': self.data["api_key"]})
+                         headers=headers)
+
+        if r.status_code == 304:
+            print("---- Old versions did not change, using local cache.")
+            return cache.get("releases")
 
         if r.status_code != 200:
             print("---- Getting versions failed! Return code: ", r.status_code, r.text)
             raise Exception("Getting versions failed", r.text)
 
         try:
-            return json.loads(r.text)
+            releases = json.loads(r.text)
         except JSONDecodeError:
             raise Exception("Getting versions failed - message malformed", r.text)
 
+        cache.set("releases", releases)
+        cache.set("etag", r.headers.get("ETag"))
+        cache.set("last_modified", r.headers.get("Last-Modified"))
+        cache.save()
+
+        return releases
+
     def check_store_has_image(self, name, group, version=None, variant=None):
         try:
             appliance_name = name + "_" + variant
@@ -233,6 +323,27 @@ class ImageStoreFileUploader(FileUploader):
         except JSONDecodeError:
             raise FileNotFoundError("Image not available in store!")
 
+    def check_store_has_update_package(self, name, group, from_version, version, variant=None):
+        try:
+            appliance_name = name + "_" + variant
+        except:
+            appliance_name = name
+
+        r = requests.options('{}/updates/{}/{}'.format(self.host, appliance_name, version),
+                             verify=self.verify_ssl,
+                             headers={'X-API-Key': self.data["api_key"]})
+
+        if r.status_code != 200:
+            return False
+
+        try:
+            packages = json.loads(r.text)
+        except JSONDecodeError:
+            return False
+        if isinstance(packages, dict):
+            packages = [packages]
+        return any(p.get("from_version") == from_version for p in packages if isinstance(p, dict))
+
     def upload_image(self, name, group, metadata, image, version=None, variant=None):
         print("---- Uploading image payload to ImageStore endpoint", self.host, "...")
 
@@ -320,19 +431,39 @@ class ImageStoreV2FileUploader(FileUploader):
         except:
             appliance_name = name
 
+        # Released metadata is immutable: revalidate our local copy rather than downloading everything again.
+        cache = ReleaseMetadataCache("image_store_v2_{}_{}".format(self.host, self.organization), appliance_name)
+        headers = {'Authorization': self.data["api_key"]}
+        if cache.get("releases") is not None:
+            if cache.get("etag"):
+                headers["If-None-Match"] = cache.get("etag")
+            if cache.get("last_modified"):
+                headers["If-Modified-Since"] = cache.get("last_modified")
+
         r = requests.get('{}/api/v1/{}/images/{}'.format(self.host, self.organization, appliance_name),
                          verify=self.verify_ssl,
-                         headers={'Authorization': self.data["api_key"]})
+                         headers=headers)
+
+        if r.status_code == 304:
+            print("---- Old versions did not change, using local cache.")
+            return cache.get("releases")
 
         if r.status_code != 200:
             print("---- Getting versions failed! Return code: ", r.status_code, r.text)
             raise Exception("Getting versions failed", r.text)
 
         try:
-            return json.loads(r.text)
+            releases = json.loads(r.text)
         except JSONDecodeError:
             raise Exception("Getting versions failed - message malformed", r.text)
 
+        cache.set("releases", releases)
+        cache.set("etag", r.headers.get("ETag"))
+        cache.set("last_modified", r.headers.get("Last-Modified"))
+        cache.save()
+
+        return releases
+
     def check_store_has_image(self, name, group, version=None, variant=None):
         try:
             appliance_name = name + "_" + variant
@@ -352,6 +483,28 @@ class ImageStoreV2FileUploader(FileUploader):
         except JSONDecodeError:
             raise FileNotFoundError("Image not available in store!")
 
+    def check_store_has_update_package(self, name, group, from_version, version, variant=None):
+        try:
+            appliance_name = name + "_" + variant
+        except:
+            appliance_name = name
+
+        r = requests.options('{}/api/v1/{}/updates/{}/{}'.format(self.host, self.organization,
+                                                                 appliance_name, version),
+                             verify=self.verify_ssl,
+                             headers={'Authorization': self.data["api_key"]})
+
+        if r.status_code != 200:
+            return False
+
+        try:
+            packages = json.loads(r.text)
+        except JSONDecodeError:
+            return False
+        if isinstance(packages, dict):
+            packages = [packages]
+        return any(p.get("from_version") == from_version for p in packages if isinstance(p, dict))
+
     def upload_image(self, name, group, metadata, image, version=None, variant=None):
         print("---- Uploading image payload to ImageStore endpoint", self.host, "...")
 
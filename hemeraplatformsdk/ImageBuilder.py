@@ -1,26 +1,56 @@
 #!/usr/bin/python3
 
 import argparse
+import concurrent.futures
 import json
 import os
 import shutil
+import signal
+import sys
+import time
 
 import hemeraplatformsdk
+from hemeraplatformsdk.ArtifactHistory import baseline_from_release_metadata, create_artifact_history
+from hemeraplatformsdk.BuildMetrics import metrics
+from hemeraplatformsdk.BuildTracer import tracer
+from hemeraplatformsdk.BuildWorkspace import prune_stale_workspaces, workspace
+from hemeraplatformsdk.FileUploader import StoreNotAvailableException
 from hemeraplatformsdk.ImageConfigurationManager import ImageConfigurationManager
+from hemeraplatformsdk.IntermediateFiles import intermediates
+from hemeraplatformsdk.ProcessExecutor import executor
+from hemeraplatformsdk.UpdatePackageGenerator import compare_version
 from hemeraplatformsdk.imagebuilders.FsImageBuilder import FsImageBuilder
 from hemeraplatformsdk.imagebuilders.SquashImageBuilder import SquashImageBuilder
 from hemeraplatformsdk.imagebuilders.VMImageBuilder import VMImageBuilder
 from hemeraplatformsdk.imagebuilders.RawMultipartImageBuilder import RawMultipartImageBuilder
 
 
+def get_available_memory():
+    with open("/proc/meminfo") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
 class ReleaseInStoreException(Exception):
     def __init__(self,*args,**kwargs):
         Exception.__init__(self,*args,**kwargs)
 
 
+class InsufficientDiskSpaceException(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+
 class ImageBuilder:
-    def __init__(self, filename, skip_crypto=False, skip_upload=False):
+    def __init__(self, filename, skip_crypto=False, skip_upload=False, pipeline_installer=False,
+                 skip_sanity_checks=False, scratch="disk", memory_budget=None):
         self.configuration = ImageConfigurationManager(filename, skip_crypto, skip_upload)
+        self.pipeline_installer = pipeline_installer
+        self.skip_sanity_checks = skip_sanity_checks
+        self.scratch = scratch
+        self.memory_budget = memory_budget
 
         self.builders = []
 
@@ -37,6 +67,7 @@ class ImageBuilder:
                     pass
 
     def build(self):
+        start = time.perf_counter()
         # What kind of image are we dealing with?
         if self.configuration.is_installer():
             print("-- Building an installer image")
@@ -48,21 +79,34 @@ class ImageBuilder:
                 print("-- WARNING: Compressed inner images in an installer are not supported! Disabling compression.")
                 image_builder.set_should_compress(False)
 
-            self.build_single_image(image_builder)
-            installed_image_metadata, installed_image_image = image_builder.get_image_files()
-
             builder = self.create_image_builder(self.configuration.get_installer())
-            builder.prepare_installer_data(installed_image_image)
-            self.build_single_image(builder)
+            builder.recovery_package_wanted = bool(self.configuration.get_image_version())
+            self.prepare_scratch_space(image_builder, builder)
+            if self.pipeline_installer:
+                installed_image_metadata = self.build_pipelined_installer(image_builder, builder)
+            else:
+                self.build_single_image(image_builder)
+                installed_image_metadata, installed_image_image = image_builder.get_image_files()
+
+                builder.prepare_installer_data(installed_image_image)
+                self.build_single_image(builder)
             if self.configuration.get_image_version():
-                builder.generate_recovery_package()
+                with tracer.span("generate_recovery_package"):
+                    builder.generate_recovery_package()
                 recovery_package_metadata, recovery_package_file = builder.get_recovery_package_files()
         else:
             print("-- Building a standalone image")
             builder = self.create_image_builder(self.configuration.get_image())
+            self.prepare_scratch_space(builder)
             self.build_single_image(builder)
 
-        metadata, image = builder.get_image_files()
+        with tracer.span("metadata"):
+            metadata, image = builder.get_image_files()
+        if builder.scratch_mounted:
+            # Only what we ship leaves memory.
+            image = self.persist_artifact(image)
+            if self.configuration.is_installer() and self.configuration.get_image_version():
+                recovery_package_file = self.persist_artifact(recovery_package_file)
         if self.configuration.is_installer():
             installer_metadata = metadata
             metadata = installed_image_metadata
@@ -70,34 +114,144 @@ class ImageBuilder:
             metadata["download_size"] = installer_metadata["download_size"]
             metadata["artifact_type"] = "installer"
             try:
-                metadata["compression_format"] = self.configuration.get_installer()["compression_format"]
+                # How the installer was actually stored, which might not be what was asked for.
+                metadata["compression_format"] = installer_metadata["compression_format"] \
+                    if "compression_format" in installer_metadata else \
+                    self.configuration.get_installer()["compression_format"]
             except KeyError:
                 pass
         else:
             metadata["artifact_type"] = "image"
             try:
-                metadata["compression_format"] = self.configuration.get_image()["compression_format"]
+                if "compression_format" not in metadata:
+                    metadata["compression_format"] = self.configuration.get_image()["compression_format"]
             except KeyError:
                 pass
 
         with open(self.configuration.get_full_image_name()+".metadata", "w") as outfile:
             json.dump(metadata, outfile)
+        metrics.set("artifact_bytes", metadata["download_size"], "Size of the artifact to download",
+                    artifact_type=metadata["artifact_type"])
+        metrics.set("artifact_packages", len(metadata["packages"]), "Number of packages in the artifact",
+                    artifact_type=metadata["artifact_type"])
+
+        # Before uploading: a release which regressed too much should not be published.
+        if self.configuration.get_regression_tracking():
+            self.track_artifact(builder, metadata, time.perf_counter() - start)
 
         for u in (u for u in self.configuration.get_upload_managers() if u.can_store_images()):
             print("-- Uploading image...")
-            u.upload_image(self.configuration.get_image()["name"], self.configuration.get_image()["group"],
-                           self.configuration.get_full_image_name() + ".metadata", image,
-                           version=self.configuration.get_image_version(),
-                           variant=self.configuration.get_image_variant())
+            start = time.perf_counter()
+            with tracer.span("upload", category="upload", store=u):
+                u.upload_image(self.configuration.get_image()["name"], self.configuration.get_image()["group"],
+                               self.configuration.get_full_image_name() + ".metadata", image,
+                               version=self.configuration.get_image_version(),
+                               variant=self.configuration.get_image_variant())
+                if self.configuration.is_installer() and self.configuration.get_image_version():
+                    with open(self.configuration.get_full_image_name() + "_recovery.metadata", "w") as outfile:
+                        json.dump(recovery_package_metadata, outfile)
+                    u.upload_recovery_package(self.configuration.get_image()["name"],
+                                              self.configuration.get_image()["group"],
+                                              self.configuration.get_full_image_name() + "_recovery.metadata",
+                                              recovery_package_file,
+                                              version=self.configuration.get_image_version(),
+                                              variant=self.configuration.get_image_variant())
+            uploaded_files = [self.configuration.get_full_image_name() + ".metadata", image]
             if self.configuration.is_installer() and self.configuration.get_image_version():
-                with open(self.configuration.get_full_image_name() + "_recovery.metadata", "w") as outfile:
-                    json.dump(recovery_package_metadata, outfile)
-                u.upload_recovery_package(self.configuration.get_image()["name"],
-                                          self.configuration.get_image()["group"],
-                                          self.configuration.get_full_image_name() + "_recovery.metadata",
-                                          recovery_package_file,
-                                          version=self.configuration.get_image_version(),
-                                          variant=self.configuration.get_image_variant())
+                uploaded_files += [self.configuration.get_full_image_name() + "_recovery.metadata",
+                                   recovery_package_file]
+            metrics.record_upload(str(u), sum(os.path.getsize(f) for f in uploaded_files),
+                                  time.perf_counter() - start)
+
+    @staticmethod
+    def estimate_peak_disk_usage(image_builder, installer_builder=None):
+        peak = image_builder.estimate_peak_disk_usage()
+        if peak is None:
+            return None
+        if installer_builder:
+            # The embedded image ends up in the installer's rootfs, and from there in its squashfs.
+            installer_peak = installer_builder.estimate_peak_disk_usage()
+            peak += (installer_peak if installer_peak else 0) + 2 * image_builder.estimate_rootfs_size()
+        return peak
+
+    def prepare_scratch_space(self, image_builder, installer_builder=None):
+        peak = self.estimate_peak_disk_usage(image_builder, installer_builder)
+        if self.scratch == "tmpfs":
+            memory_budget = self.memory_budget if self.memory_budget else get_available_memory() // 2
+            if peak is None:
+                print("-- Can't tell how much space the build needs, building on disk")
+                return
+            elif peak > memory_budget:
+                print("-- The build needs up to {:.1f} MB, more than the memory budget of {:.1f} MB: building on disk"
+                      .format(peak / 1048576, memory_budget / 1048576))
+            else:
+                print("-- The build needs up to {:.1f} MB, within the memory budget of {:.1f} MB: building in memory"
+                      .format(peak / 1048576, memory_budget / 1048576))
+                if installer_builder:
+                    # Both builders share the budget, in proportion to what each one needs. Whatever is not the
+                    # image's own peak happens in the installer's build directory.
+                    image_budget = memory_budget * image_builder.estimate_peak_disk_usage() // max(peak, 1)
+                    image_builder.mount_scratch_space(image_budget)
+                    installer_builder.mount_scratch_space(memory_budget - image_budget)
+                else:
+                    image_builder.mount_scratch_space(memory_budget)
+                return
+
+        self.check_free_space(peak, image_builder.build_dir)
+
+    def check_free_space(self, peak, build_dir):
+        if peak is None:
+            print("-- Can't tell how much disk space the build needs, skipping the free space check")
+            return
+
+        free_space = shutil.disk_usage(build_dir).free
+        print("-- Estimated peak disk usage: {:.1f} MB, {:.1f} MB available"
+              .format(peak / 1048576, free_space / 1048576))
+        if peak > free_space:
+            message = "Not enough free space in {}: the build needs up to {:.1f} MB, {:.1f} MB are available" \
+                .format(os.path.dirname(build_dir), peak / 1048576, free_space / 1048576)
+            if not self.skip_sanity_checks:
+                raise InsufficientDiskSpaceException(message)
+            print("-- WARNING: {}. Continuing, as requested.".format(message))
+
+    def get_previous_release(self, artifact_type):
+        previous_release = None
+        for u in self.configuration.get_upload_managers():
+            try:
+                old_versions = u.get_old_versions_from_store(self.configuration.get_image()["name"],
+                                                             self.configuration.get_image()["group"],
+                                                             variant=self.configuration.get_image_variant())
+            except (StoreNotAvailableException, FileNotFoundError):
+                continue
+            for release in old_versions:
+                if release["version"] == "rolling" or release.get("artifact_type", artifact_type) != artifact_type:
+                    continue
+                if compare_version(release["version"], "", self.configuration.get_image_version(), "") >= 0:
+                    continue
+                if not previous_release or compare_version(release["version"], "",
+                                                           previous_release["version"], "") > 0:
+                    previous_release = release
+        return previous_release
+
+    def track_artifact(self, builder, metadata, build_seconds):
+        history = create_artifact_history(self.configuration.get_regression_tracking(), metadata["appliance_name"])
+        entry = history.create_entry(metadata["appliance_name"], self.configuration.get_image_version(),
+                                     metadata["artifact_type"], metadata["download_size"], build_seconds,
+                                     uncompressed_size=builder.uncompressed_size if builder.uncompressed_size
+                                     else metadata["download_size"], package_count=len(metadata["packages"]))
+        baseline = history.get_last_entry(metadata["appliance_name"], metadata["artifact_type"],
+                                          exclude_version=self.configuration.get_image_version())
+
+        # What is in the store is what was actually released: it wins over our own records.
+        previous_release = self.get_previous_release(metadata["artifact_type"]) \
+            if self.configuration.get_image_version() else None
+        if previous_release:
+            if not baseline or baseline["version"] != previous_release["version"]:
+                baseline = {}
+            baseline.update(baseline_from_release_metadata(previous_release))
+
+        with tracer.span("regression_tracking"):
+            history.record(entry, baseline)
 
     def create_image_builder(self, metadata):
         if metadata["type"] == "fs":
@@ -124,20 +278,64 @@ class ImageBuilder:
 
         return builder
 
+    def build_pipelined_installer(self, image_builder, installer_builder):
+        # The installer's packages don't depend on the embedded image: only copying it in has to wait.
+        print("-- Building the installer alongside the embedded image.")
+        installer_builder.defer_installer_payload()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            installer_build = pool.submit(self.build_single_image, installer_builder)
+            try:
+                self.build_single_image(image_builder)
+                installed_image_metadata, installed_image_image = image_builder.get_image_files()
+                installer_builder.prepare_installer_data(installed_image_image)
+                installer_builder.release_installer_payload()
+            except:
+                # Do not leave mic waiting forever.
+                installer_builder.abort_installer_payload()
+                raise
+            installer_build.result()
+
+        return installed_image_metadata
+
     @staticmethod
     def build_single_image(builder):
         # Build image
         print("-- Building image...")
-        builder.build_image()
+        with tracer.span("build_image", image=builder.image_name):
+            builder.build_image()
         if builder.should_compress():
             print("-- Compressing image...")
-            builder.compress_image()
+            with tracer.span("compress_image", image=builder.image_name):
+                builder.compress_image()
+
+    def persist_artifact(self, artifact):
+        # Uncompressed raw images are made of the files of each device.
+        if isinstance(artifact, list):
+            return [(d, [self.persist_artifact(f) for f in files] if files else files) for d, files in artifact]
+
+        destination = os.path.join(os.getcwd(), os.path.basename(artifact))
+        print("-- Moving {} to {}".format(os.path.basename(artifact), os.getcwd()))
+        with tracer.span("persist_artifact", file=os.path.basename(artifact)):
+            shutil.move(artifact, destination)
+        return destination
 
     def cleanup(self):
         for b in self.builders:
+            b.unmount_scratch_space()
             shutil.rmtree(b.build_dir)
 
 
+def write_build_trace(filename):
+    print("-- Build timeline:")
+    tracer.print_summary()
+    tracer.write_trace(filename)
+    print("-- Trace written to {}".format(filename))
+    print("-- External tools:")
+    executor.print_summary()
+    if executor.log_dir:
+        executor.write_records(os.path.join(executor.log_dir, "processes.json"))
+
+
 def build_hemera_image(args_parameter=None):
     parser = argparse.ArgumentParser(description='Hemera Image Builder')
     parser.add_argument('metadata', type=str, help="The image's metadata")
@@ -149,6 +347,23 @@ def build_hemera_image(args_parameter=None):
                         help='Skips the crypto instruction. WARNING: Use for local testing only!!')
     parser.add_argument('--skip-sanity-checks', action='store_true',
                         help='Continues even if some sanity checks fail. Do not use in production!')
+    parser.add_argument('--trace', type=str,
+                        help="Where to write the build's Chrome/Perfetto trace. Defaults to <image name>.trace.json")
+    parser.add_argument('--tool-logs', type=str,
+                        help="Where to write the output of each external tool. Defaults to <image name>.logs")
+    parser.add_argument('--console-tool-output', action='store_true',
+                        help='Lets external tools write to the console rather than to log files')
+    parser.add_argument('--metrics', type=str,
+                        help="Where to write the build's metrics as an OpenMetrics text file, e.g. in node_exporter's "
+                             "textfile collector directory")
+    parser.add_argument('--scratch', type=str, choices=["disk", "tmpfs"], default="disk",
+                        help="Where to keep intermediates. tmpfs builds in memory when the build fits the memory "
+                             "budget, and moves only the final artifacts to the current directory")
+    parser.add_argument('--memory-budget', type=int,
+                        help="Memory a tmpfs scratch space may take, in MB. Defaults to half the available memory")
+    parser.add_argument('--pipeline-installer', action='store_true',
+                        help='Installs the installer\'s packages while the embedded image is being built. Both mic '
+                             'runs share the same cache directory')
 
     if args_parameter:
         args = parser.parse_args(args=args_parameter)
@@ -157,9 +372,28 @@ def build_hemera_image(args_parameter=None):
 
     print("Hemera Image Builder, version", hemeraplatformsdk.__version__)
 
+    # Being stopped is a failure like any other: clean up after ourselves.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    prune_stale_workspaces()
+
     try:
-        builder = ImageBuilder(args.metadata, skip_upload=args.skip_upload, skip_crypto=args.skip_crypto)
-        builder.build()
+        # Intermediates are deleted as soon as they are consumed, unless we want to look at them afterwards.
+        intermediates.set_keep(args.skip_cleanup)
+        builder = ImageBuilder(args.metadata, skip_upload=args.skip_upload, skip_crypto=args.skip_crypto,
+                               pipeline_installer=args.pipeline_installer, skip_sanity_checks=args.skip_sanity_checks,
+                               scratch=args.scratch,
+                               memory_budget=args.memory_budget * 1024 * 1024 if args.memory_budget else None)
+        metrics.set_labels(appliance=builder.configuration.get_image()["name"],
+                           version=builder.configuration.get_image_version(),
+                           variant=builder.configuration.get_image_variant())
+        if not args.console_tool_output:
+            executor.set_log_dir(args.tool_logs if args.tool_logs else
+                                 builder.configuration.get_full_image_name() + ".logs")
+        with tracer.span("build"):
+            builder.build()
+        write_build_trace(args.trace if args.trace else builder.configuration.get_full_image_name() + ".trace.json")
+        if args.metrics:
+            metrics.write_textfile(args.metrics)
         print("-- Image built successfully!")
         if args.skip_cleanup:
             print("-- Not cleaning up, as requested.")
@@ -167,10 +401,21 @@ def build_hemera_image(args_parameter=None):
             print("-- Cleaning up...")
             builder.cleanup()
             print("-- Done.")
+        workspace.release(keep=args.skip_cleanup)
     except ReleaseInStoreException as exc:
         print("-- Release is already built. Assuming this was an honest mistake, failing gracefully...")
+        workspace.release()
         exit(0)
     except:
+        try:
+            write_build_trace(args.trace if args.trace else
+                              builder.configuration.get_full_image_name() + ".trace.json")
+        except UnboundLocalError:
+            # No builder, no build to trace.
+            pass
+        if args.metrics:
+            metrics.write_textfile(args.metrics, success=False)
+
         if args.skip_cleanup:
             print("-- Build failed! Not cleaning up, as requested.")
         else:
@@ -184,5 +429,6 @@ def build_hemera_image(args_parameter=None):
             except FileNotFoundError:
                 # Metadata might not be there.
                 pass
+        workspace.release(keep=args.skip_cleanup)
 
         raise
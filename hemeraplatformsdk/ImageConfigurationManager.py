@@ -176,5 +176,17 @@ class ImageConfigurationManager:
         else:
             return None
 
+    def get_update_planning(self):
+        try:
+            return self.data["update_planning"]
+        except KeyError:
+            return {}
+
+    def get_regression_tracking(self):
+        try:
+            return self.data["regression_tracking"]
+        except KeyError:
+            return {}
+
     def get_upload_managers(self):
         return self.upload_managers
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import os
+import shutil
+import threading
+
+from hemeraplatformsdk.BuildTracer import tracer
+
+
+class IntermediateFiles:
+    """
+    Tracks the intermediate files and trees of a build, and which steps of the build still have to read them.
+
+    A path is deleted as soon as the last of its consumers releases it, rather than when the build directory is
+    cleaned up: this keeps the peak disk usage of a build down. Paths which were never registered are left alone,
+    and so is everything when keep is set, e.g. to inspect a build afterwards.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> consumers which did not release it yet
+        self.consumers = {}
+        self.keep = False
+        self.deleted_bytes = 0
+
+    def reset(self):
+        with self.lock:
+            self.consumers = {}
+            self.deleted_bytes = 0
+
+    def set_keep(self, keep):
+        self.keep = keep
+
+    def register(self, path, *consumers):
+        with self.lock:
+            self.consumers.setdefault(os.path.abspath(path), set()).update(consumers)
+
+    def release(self, consumer, paths=None):
+        """
+        Tells consumer is done with paths, or with everything it registered for if paths is None.
+        """
+        if paths is not None:
+            paths = [os.path.abspath(p) for p in paths]
+
+        to_delete = []
+        with self.lock:
+            for path, consumers in self.consumers.items():
+                if paths is not None and path not in paths:
+                    continue
+                consumers.discard(consumer)
+                if not consumers:
+                    to_delete.append(path)
+            for path in to_delete:
+                del self.consumers[path]
+
+        for path in to_delete:
+            self.delete(path)
+
+    def delete(self, path):
+        if self.keep:
+            return
+
+        with tracer.span("delete_intermediate", category="cleanup", path=os.path.basename(path)):
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+                print("--- Deleted {}, it is not needed anymore".format(path))
+                return
+
+            try:
+                size = os.lstat(path).st_blocks * 512
+                os.remove(path)
+            except FileNotFoundError:
+                return
+        with self.lock:
+            self.deleted_bytes += size
+        print("--- Deleted {} ({:.1f} MB), it is not needed anymore".format(path, size / 1048576))
+
+
+intermediates = IntermediateFiles()
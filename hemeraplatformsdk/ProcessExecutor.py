@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+import collections
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from hemeraplatformsdk.BuildTracer import tracer
+
+# Which concurrency limit applies to each tool. Tools not in here run unrestricted.
+TOOL_CLASSES = {
+    # mic runs through the SDK
+    "sdk": "mic",
+    "mksquashfs": "compressor",
+    "qemu-img": "compressor",
+    "losetup": "device",
+    "mount": "device",
+    "umount": "device",
+    "cryptsetup": "device",
+    "blockdev": "device",
+    "mke2fs": "filesystem",
+    "mcopy": "filesystem",
+    "ubinize": "filesystem",
+    "sgdisk": "filesystem",
+    "dd": "filesystem"
+}
+# mksquashfs and qemu-img use all cores already, and loop/dm setup does not like concurrency.
+DEFAULT_TOOL_CONCURRENCY = {
+    "mic": 2,
+    "compressor": 1,
+    "device": 1,
+    "filesystem": os.cpu_count() or 1
+}
+LOG_TAIL_LINES = 20
+
+
+def exit_code_from_status(status):
+    # Like subprocess: negative when killed by a signal.
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return -os.WTERMSIG(status)
+
+
+def get_tool_class(tool):
+    if tool.startswith("mkfs."):
+        return "filesystem"
+    return TOOL_CLASSES.get(tool)
+
+
+class ProcessExecutor:
+    """
+    Runs every external tool of a build, accounting for the resources each one used.
+
+    Concurrency is limited per tool class. Defaults can be overridden through HEMERA_TOOL_CONCURRENCY, e.g.
+    "mic=1,compressor=2". Once a log directory is set, the output of each step goes to its own log file rather
+    than to the console.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.log_dir = None
+        self.step = 0
+        self.records = []
+
+        concurrency = dict(DEFAULT_TOOL_CONCURRENCY)
+        for limit in [l for l in os.environ.get("HEMERA_TOOL_CONCURRENCY", "").split(",") if l]:
+            tool_class, value = limit.split("=")
+            concurrency[tool_class.strip()] = int(value)
+        self.limits = {tool_class: threading.BoundedSemaphore(value) for tool_class, value in concurrency.items()}
+
+    def set_log_dir(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        self.log_dir = log_dir
+        print("-- Output of external tools goes to {}".format(log_dir))
+
+    def next_step(self):
+        with self.lock:
+            self.step += 1
+            return self.step
+
+    def run(self, args, input=None, capture_output=False, stdout=None, stderr=None, env=None,
+            universal_newlines=False, limited=True):
+        tool = os.path.basename(args[0])
+        step = self.next_step()
+        log_filename = os.path.join(self.log_dir, "{:04d}-{}.log".format(step, tool)) if self.log_dir else None
+        # Tools which wait for other tools must not take a slot those might need.
+        tool_limit = self.limits.get(get_tool_class(tool)) if limited else None
+
+        if tool_limit:
+            tool_limit.acquire()
+        try:
+            with tracer.span(tool, category="process", step=step) as span_args:
+                log_file = open(log_filename, "w") if log_filename else None
+                try:
+                    if log_file:
+                        print("$ " + " ".join(str(a) for a in args), file=log_file, flush=True)
+                    start = time.perf_counter()
+                    proc = subprocess.Popen(args, env=env, universal_newlines=universal_newlines,
+                                            stdin=subprocess.PIPE if input is not None else None,
+                                            stdout=subprocess.PIPE if capture_output else
+                                            stdout if stdout else log_file,
+                                            stderr=stderr if stderr else log_file)
+                    output = None
+                    try:
+                        if input is not None:
+                            proc.stdin.write(input)
+                            proc.stdin.close()
+                        if capture_output:
+                            output = proc.stdout.read()
+                            proc.stdout.close()
+                        # wait4 rather than wait: we want the child's rusage.
+                        _, status, rusage = os.wait4(proc.pid, 0)
+                    except BaseException:
+                        # Interrupted or terminated: don't leave the tool running under the cleanup.
+                        proc.kill()
+                        proc.wait()
+                        raise
+                    proc.returncode = exit_code_from_status(status)
+                    wall_time = time.perf_counter() - start
+                finally:
+                    if log_file:
+                        log_file.close()
+
+                record = {
+                    "step": step,
+                    "tool": tool,
+                    "args": [str(a) for a in args],
+                    "returncode": proc.returncode,
+                    "wall_time": wall_time,
+                    "user_time": rusage.ru_utime,
+                    "system_time": rusage.ru_stime,
+                    # Linux reports it in KB
+                    "max_rss": rusage.ru_maxrss * 1024,
+                    # In 512 bytes blocks
+                    "blocks_in": rusage.ru_inblock,
+                    "blocks_out": rusage.ru_oublock,
+                    "log": log_filename
+                }
+                span_args.update({k: v for k, v in record.items() if k not in ("step", "tool", "args")})
+                with self.lock:
+                    self.records.append(record)
+        finally:
+            if tool_limit:
+                tool_limit.release()
+
+        if proc.returncode != 0:
+            if log_filename:
+                self.print_log_tail(log_filename)
+            raise subprocess.CalledProcessError(proc.returncode, args, output=output)
+        return output
+
+    def check_call(self, args, input=None, stdout=None, stderr=None, env=None, universal_newlines=False,
+                   limited=True):
+        self.run(args, input=input, stdout=stdout, stderr=stderr, env=env, universal_newlines=universal_newlines,
+                 limited=limited)
+        return 0
+
+    def check_output(self, args, input=None, stderr=None, env=None, universal_newlines=False):
+        return self.run(args, input=input, capture_output=True, stderr=stderr, env=env,
+                        universal_newlines=universal_newlines)
+
+    @staticmethod
+    def print_log_tail(log_filename):
+        with open(log_filename, errors="replace") as log_file:
+            lines = collections.deque(log_file, LOG_TAIL_LINES)
+        print("---- Last lines of {}:".format(log_filename), file=sys.stderr)
+        for line in lines:
+            print("---- " + line.rstrip("\n"), file=sys.stderr)
+
+    def get_summary(self):
+        """
+        Resources used by each tool over the whole build, most time consuming first.
+        """
+        with self.lock:
+            records = list(self.records)
+
+        summary = {}
+        for r in records:
+            s = summary.setdefault(r["tool"], {"tool": r["tool"], "count": 0, "wall_time": 0, "user_time": 0,
+                                               "system_time": 0, "max_rss": 0, "bytes_in": 0, "bytes_out": 0})
+            s["count"] += 1
+            s["wall_time"] += r["wall_time"]
+            s["user_time"] += r["user_time"]
+            s["system_time"] += r["system_time"]
+            s["max_rss"] = max(s["max_rss"], r["max_rss"])
+            s["bytes_in"] += r["blocks_in"] * 512
+            s["bytes_out"] += r["blocks_out"] * 512
+        return sorted(summary.values(), key=lambda s: s["wall_time"], reverse=True)
+
+    def print_summary(self):
+        summary = self.get_summary()
+        if not summary:
+            return
+        print("-- {:<16} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+            "tool", "count", "wall (s)", "user (s)", "sys (s)", "rss (MB)", "read (MB)", "write (MB)"))
+        for s in summary:
+            print("-- {:<16} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                s["tool"], s["count"], s["wall_time"], s["user_time"], s["system_time"], s["max_rss"] / 1048576,
+                s["bytes_in"] / 1048576, s["bytes_out"] / 1048576))
+
+    def write_records(self, filename):
+        with self.lock:
+            records = list(self.records)
+        with open(filename, "w") as outfile:
+            json.dump(records, outfile, indent=4)
+
+
+executor = ProcessExecutor()
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+import os
+import shlex
+import struct
+import uuid
+
+from hemeraplatformsdk.BuildTracer import tracer
+from hemeraplatformsdk.ProcessExecutor import executor
+
+# Offset and format of bytes_used in the squashfs superblock
+SQUASHFS_BYTES_USED_OFFSET = 40
+SQUASHFS_BYTES_USED_FORMAT = "<Q"
+# Room for the LUKS header, whatever its version
+LUKS_HEADER_MARGIN = 16 * 1024 * 1024
+# Worst case metadata cost of a single inode, used when sizing containers
+SQUASHFS_INODE_MARGIN = 1024
+CONTAINER_ALIGNMENT = 1024 * 1024
+DEFAULT_SQUASH_COMPRESSOR = "lzo"
+
+
+def align_to(size, alignment):
+    return ((size + alignment - 1) // alignment) * alignment
+
+
+def squash_profile_args(profile):
+    """
+    mksquashfs arguments for a squash profile, as found in the image metadata.
+    """
+    if not profile:
+        profile = {}
+
+    args = ["-comp", profile.get("compressor", DEFAULT_SQUASH_COMPRESSOR)]
+    try:
+        args += ["-b", str(profile["block_size"])]
+    except KeyError:
+        pass
+    try:
+        args += ["-processors", str(profile["processors"])]
+    except KeyError:
+        pass
+    try:
+        if profile["fragments"] == "none":
+            args.append("-no-fragments")
+        elif profile["fragments"] == "always":
+            args.append("-always-use-fragments")
+    except KeyError:
+        pass
+
+    return args
+
+
+class SquashPackageGenerator:
+    """
+    Creates a squashfs-based Hemera package, optionally inside a LUKS container.
+
+    Encrypted packages are written in a single pass: the container is sized upfront as a sparse file, mksquashfs
+    writes straight into its dm-crypt mapping, and the container is then trimmed to what squashfs actually used.
+    There is no unencrypted copy on disk at any point.
+    """
+    def __init__(self, source_dir, filename, crypto=None, mksquashfs_args=None, profile=None,
+                 source_date_epoch=None):
+        self.source_dir = source_dir
+        self.filename = filename
+        self.crypto = crypto if crypto else {}
+        self.profile = profile
+        self.source_date_epoch = source_date_epoch
+        self.mksquashfs_args = mksquashfs_args if mksquashfs_args else []
+        # Several packages can be generated at once, in one process or more.
+        self.mapping_name = "hemerapkg-{}-{}".format(os.getpid(), uuid.uuid4().hex[:8])
+
+    def estimate_container_size(self):
+        # Uncompressed worst case: every byte of data plus metadata for every entry.
+        size = 0
+        for root, dirs, files in os.walk(self.source_dir):
+            for f in files:
+                try:
+                    size += os.lstat(os.path.join(root, f)).st_size
+                except OSError:
+                    pass
+            size += (len(dirs) + len(files)) * SQUASHFS_INODE_MARGIN
+        return align_to(size + LUKS_HEADER_MARGIN, CONTAINER_ALIGNMENT)
+
+    def run_mksquashfs(self, destination):
+        mksquashfs_call = ["mksquashfs", self.source_dir, destination, "-noappend"]
+        mksquashfs_call += squash_profile_args(self.profile)
+        if self.source_date_epoch is not None:
+            mksquashfs_call += ["-mkfs-time", str(self.source_date_epoch), "-all-time", str(self.source_date_epoch)]
+        mksquashfs_call += self.mksquashfs_args
+        mksquashfs_call += shlex.split(os.environ.get("ADDITIONAL_MKSQUASHFS_ARGS", ""))
+        with tracer.span("mksquashfs", category="squash", package=os.path.basename(self.filename)):
+            executor.check_call(mksquashfs_call)
+
+    def run_cryptsetup(self, arguments, keys):
+        executor.check_call(["cryptsetup"] + arguments, input="".join(k + "\n" for k in keys),
+                            universal_newlines=True)
+
+    def generate(self):
+        try:
+            key = self.crypto["key"]
+        except KeyError:
+            print("---- Squash package: skipping encryption. WARNING: This is not an usual behavior!")
+            self.run_mksquashfs(self.filename)
+            print("---- Squash package generated successfully")
+            return
+
+        try:
+            self.generate_encrypted(key)
+        except:
+            # Never leave a half-baked package around.
+            try:
+                os.remove(self.filename)
+            except FileNotFoundError:
+                pass
+            raise
+
+        print("---- Encrypted package: {} ready".format(self.filename))
+
+    def generate_encrypted(self, key):
+        print("---- Encrypted image: creating base image")
+        with open(self.filename, "wb") as container:
+            container.truncate(self.estimate_container_size())
+
+        loop_device = executor.check_output(["losetup", "--find", "--show", self.filename],
+                                            universal_newlines=True).strip()
+        try:
+            print("---- Encrypted image: performing encryption")
+            self.run_cryptsetup(["-q", "luksFormat", loop_device], [key])
+
+            try:
+                print("---- Adding {} additional LUKS keys".format(len(self.crypto["additional_keys"])))
+                for additional_key in self.crypto["additional_keys"]:
+                    self.run_cryptsetup(["luksAddKey", loop_device], [key, additional_key, additional_key])
+            except KeyError:
+                # No additional keys
+                pass
+
+            self.run_cryptsetup(["-q", "open", "--type", "luks", loop_device, self.mapping_name], [key])
+            mapping = os.path.join("/dev/mapper", self.mapping_name)
+            try:
+                payload_offset = int(executor.check_output(["blockdev", "--getsize64", loop_device])) - \
+                    int(executor.check_output(["blockdev", "--getsize64", mapping]))
+
+                print("---- Creating squashfs-based hemera package")
+                self.run_mksquashfs(mapping)
+
+                with open(mapping, "rb") as f:
+                    f.seek(SQUASHFS_BYTES_USED_OFFSET)
+                    bytes_used = struct.unpack(SQUASHFS_BYTES_USED_FORMAT,
+                                               f.read(struct.calcsize(SQUASHFS_BYTES_USED_FORMAT)))[0]
+            finally:
+                executor.check_call(["cryptsetup", "close", self.mapping_name])
+        finally:
+            executor.check_call(["losetup", "-d", loop_device])
+
+        # Drop the slack we reserved: LUKS does not record its payload size, squashfs is at its start.
+        with open(self.filename, "r+b") as container:
+            container.truncate(align_to(payload_offset + bytes_used, CONTAINER_ALIGNMENT))
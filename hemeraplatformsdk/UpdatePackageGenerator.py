@@ -2,28 +2,37 @@
 
 import argparse
 import errno
+import functools
 import os
 import json
-from version_utils import rpm
+import re
 import shutil
-import subprocess
 import tempfile
+import time
 import hashlib
 import sys
 
+from hemeraplatformsdk.ArtifactHistory import create_artifact_history
+from hemeraplatformsdk.BuildMetrics import metrics
+from hemeraplatformsdk.BuildTracer import tracer
+from hemeraplatformsdk.FileUploader import StoreNotAvailableException
 from hemeraplatformsdk.ImageConfigurationManager import ImageConfigurationManager
-from hemeraplatformsdk.imagebuilders.BaseImageBuilder import MIC_CACHE_DIR
+from hemeraplatformsdk.SquashPackageGenerator import SquashPackageGenerator
+from hemeraplatformsdk.imagebuilders.BaseImageBuilder import INCOMPRESSIBLE_RATIO, MIC_CACHE_DIR, \
+    get_source_date_epoch, sample_compression_ratio
 
 
 def sha1checksum(filename):
     sha1 = hashlib.sha1()
 
+    start = time.perf_counter()
     with open(filename, 'rb') as f:
         while True:
             data = f.read(65536)
             if not data:
                 break
             sha1.update(data)
+    metrics.record_hashing("sha1", os.path.getsize(filename), time.perf_counter() - start)
 
     return sha1.hexdigest()
 
@@ -57,6 +66,7 @@ def string_to_version(verstring):
     return epoch, version, release
 
 
+@functools.lru_cache(maxsize=None)
 def split_filename(filename):
     """
     Pass in a standard style rpm fullname
@@ -88,18 +98,114 @@ def split_filename(filename):
     return name, arch, epoch, ver, rel
 
 
+# rpmvercmp segments: tildes, carets, and runs of digits or letters. Anything else is a separator.
+RPM_VERSION_SEGMENT_RE = re.compile(r"~|\^|[0-9]+|[a-zA-Z]+")
+RPM_SEGMENT_TILDE = 0
+RPM_SEGMENT_CARET = 1
+RPM_SEGMENT_ALPHA = 2
+RPM_SEGMENT_NUMERIC = 3
+
+
+@functools.lru_cache(maxsize=None)
+def version_segments(verstring):
+    """
+    Split a version or release string in rpmvercmp segments, once.
+
+    Numeric segments are stored as integers, which is equivalent to rpm's strip-leading-zeros-then-compare.
+    """
+    segments = []
+    for segment in RPM_VERSION_SEGMENT_RE.findall(verstring):
+        if segment == '~':
+            segments.append((RPM_SEGMENT_TILDE, None))
+        elif segment == '^':
+            segments.append((RPM_SEGMENT_CARET, None))
+        elif segment.isdigit():
+            segments.append((RPM_SEGMENT_NUMERIC, int(segment)))
+        else:
+            segments.append((RPM_SEGMENT_ALPHA, segment))
+    return tuple(segments)
+
+
+def compare_segments(one, two):
+    # Same semantics as rpm's rpmvercmp, working on pre-split segments.
+    len_one = len(one)
+    len_two = len(two)
+    i = 0
+    while True:
+        type_one, value_one = one[i] if i < len_one else (None, None)
+        type_two, value_two = two[i] if i < len_two else (None, None)
+
+        # ~ sorts before everything, even the end of the string
+        if type_one == RPM_SEGMENT_TILDE or type_two == RPM_SEGMENT_TILDE:
+            if type_one != RPM_SEGMENT_TILDE:
+                return 1
+            if type_two != RPM_SEGMENT_TILDE:
+                return -1
+            i += 1
+            continue
+
+        # ^ sorts after the end of the string, but before anything else
+        if type_one == RPM_SEGMENT_CARET or type_two == RPM_SEGMENT_CARET:
+            if type_one is None:
+                return -1
+            if type_two is None:
+                return 1
+            if type_one != RPM_SEGMENT_CARET:
+                return 1
+            if type_two != RPM_SEGMENT_CARET:
+                return -1
+            i += 1
+            continue
+
+        if type_one is None or type_two is None:
+            break
+
+        # Numeric segments are always newer than alpha segments
+        if type_one != type_two:
+            return 1 if type_one == RPM_SEGMENT_NUMERIC else -1
+
+        if value_one != value_two:
+            return 1 if value_one > value_two else -1
+        i += 1
+
+    if i >= len_one and i >= len_two:
+        return 0
+    return -1 if i >= len_one else 1
+
+
+def rpmvercmp(a, b):
+    if a == b:
+        return 0
+    return compare_segments(version_segments(a), version_segments(b))
+
+
+@functools.lru_cache(maxsize=None)
+def package_evr(filename):
+    """
+    Return the parsed (epoch, version segments, release segments) tuple of a package string.
+    """
+    _, _, epoch, ver, rel = split_filename(filename)
+    return int(epoch) if epoch else 0, version_segments(ver), version_segments(rel)
+
+
+def compare_evr(evr1, evr2):
+    # Same as compare_version, on tuples returned by package_evr.
+    if evr1[0] != evr2[0]:
+        return 1 if evr1[0] > evr2[0] else -1
+    rc = compare_segments(evr1[1], evr2[1])
+    if rc != 0:
+        return rc
+    return compare_segments(evr1[2], evr2[2])
+
+
 def compare_version(v1, r1, v2, r2):
     # return 1: a is newer than b
     # 0: a and b are the same version
     # -1: b is newer than a
-    v1 = str(v1)
-    r1 = str(r1)
-    v2 = str(v2)
-    r2 = str(r2)
-    #print '%s, %s, %s vs %s, %s, %s' % (e1, v1, r1, e2, v2, r2)
-    rc = rpm.compare_versions(v1+"-"+r1, v2+"-"+r2)
-    #print '%s, %s, %s vs %s, %s, %s = %s' % (e1, v1, r1, e2, v2, r2, rc)
-    return rc
+    rc = rpmvercmp(str(v1), str(v2))
+    if rc != 0:
+        return rc
+    return rpmvercmp(str(r1), str(r2))
 
 
 def packages_to_dictionary(packages):
@@ -111,51 +217,93 @@ def packages_to_dictionary(packages):
     return packages_dict
 
 
-def generate_squash_package(image_crypto, dir, filename, remove_uid_gid=True):
-    process_env = os.environ.copy()
-    if remove_uid_gid:
-        process_env["ADDITIONAL_MKSQUASHFS_ARGS"] = "-force-uid 0 -force-gid 0"
-    squash_call = ["mkhemerasquashfs", dir, filename]
-    try:
-        squash_call.append(image_crypto["key"])
-    except TypeError:
-        # No Crypto specified
-        pass
-    except KeyError:
-        pass
+def compute_package_changes(new_packages, old_packages):
+    """
+    Compare two dictionaries returned by packages_to_dictionary.
 
-    subprocess.check_call(squash_call, env=process_env)
+    Return the list of packages to install (new or updated) and the list of package names to remove.
+    """
+    install_packages = []
+    remove_packages = []
+
+    for k, v in iter(new_packages.items()):
+        if k in old_packages:
+            old_package = old_packages[k][1]
+            if old_package == v[1]:
+                # Same exact package, nothing to do.
+                continue
+
+            if compare_evr(package_evr(v[1]), package_evr(old_package)) > 0:
+                install_packages.append(v[1])
+        else:
+            install_packages.append(v[1])
+
+    # Do we need to remove any packages?
+    for k in iter(old_packages.keys()):
+        if k not in new_packages:
+            remove_packages.append(k)
+
+    return install_packages, remove_packages
 
-    # Add additional crypto keys
-    try:
-        print("--- Adding {} additional LUKS keys".format(len(image_crypto["additional_keys"])))
-        with tempfile.TemporaryDirectory() as tempdir:
-            subprocess.check_call(["/sbin/losetup", "/dev/loop7", tempdir])
-            for additional_key in image_crypto["additional_keys"]:
-                proc = subprocess.Popen(["/sbin/cryptsetup", "luksAddKey", "/dev/loop7"], stdin=subprocess.PIPE,
-                                        stdout=subprocess.PIPE, universal_newlines=True)
-                proc.stdin.write(image_crypto["key"] + "\n")
-                proc.stdin.write(additional_key + "\n")
-                proc.stdin.write(additional_key + "\n")
-                proc.communicate()
-                if proc.returncode != 0:
-                    subprocess.check_call(["/sbin/losetup", "-d" "/dev/loop7"])
-                    raise Exception("luksAddKey failed!")
-
-            subprocess.check_call(["/sbin/losetup", "-d" "/dev/loop7"])
-    except (KeyError, TypeError):
-        # No additional keys
-        pass
+
+def index_package_sizes(packages_dir):
+    """
+    Map the name of every RPM found in packages_dir (without the .rpm extension) to its size.
+    """
+    package_sizes = {}
+    for root, dirs, files in os.walk(packages_dir):
+        for f in files:
+            if f.endswith(".rpm"):
+                package_sizes[f[:-4]] = os.path.getsize(os.path.join(root, f))
+
+    return package_sizes
+
+
+def squash_payload_args(dir, payload_profile):
+    """
+    mksquashfs arguments for a payload profile.
+
+    "compressed" compresses everything, "uncompressed" stores data and fragments as they are, and "auto" picks one
+    of the two by sampling how compressible the payload is.
+    """
+    if payload_profile == "auto":
+        ratio = sample_compression_ratio([dir])
+        payload_profile = "uncompressed" if ratio > INCOMPRESSIBLE_RATIO else "compressed"
+        print("---- Payload sampled compression ratio is {:.2f}, storing it {}".format(ratio, payload_profile))
+
+    if payload_profile == "uncompressed":
+        return ["-noD", "-noF"]
+    elif payload_profile == "compressed":
+        return []
+    else:
+        raise ValueError("Unknown payload profile {}".format(payload_profile))
+
+
+def generate_squash_package(image_crypto, dir, filename, remove_uid_gid=True, payload_profile="compressed",
+                            squash_profile=None, sort_file=None, source_date_epoch=None):
+    mksquashfs_args = []
+    if remove_uid_gid:
+        mksquashfs_args += ["-force-uid", "0", "-force-gid", "0"]
+    mksquashfs_args += squash_payload_args(dir, payload_profile)
+    if sort_file:
+        mksquashfs_args += ["-sort", sort_file]
+
+    SquashPackageGenerator(dir, filename, crypto=image_crypto, mksquashfs_args=mksquashfs_args,
+                           profile=squash_profile, source_date_epoch=source_date_epoch).generate()
 
 
 class UpdatePackageGenerator:
-    def __init__(self, configuration, new_release, old_release, packages_dir):
+    def __init__(self, configuration, new_release, old_release, packages_dir, package_sizes=None,
+                 payload_profile="auto"):
         self.data = configuration
         self.appliance_name = configuration.get_full_image_name()
         self.new_release = new_release
         self.old_release = old_release
         self.build_dir = os.path.join(os.getcwd(), "build-" + configuration.get_full_image_name())
         self.packages_dir = packages_dir
+        self.package_sizes = package_sizes
+        # RPM payloads are already compressed: let sampling decide whether squashing should bother.
+        self.payload_profile = payload_profile
         self.new_packages = {}
         self.old_packages = {}
         self.install_packages = []
@@ -170,25 +318,26 @@ class UpdatePackageGenerator:
 
     def populate_package_list(self):
         # Verify what's up here.
-        for k,v in iter(self.new_packages.items()):
-            if k in self.old_packages:
-                oldVersion = self.old_packages[k][0]
-                newVersion = v[0]
-
-                if compare_version(newVersion[0], newVersion[1], oldVersion[0], oldVersion[1]) > 0:
-                    self.install_packages.append(v[1])
-            else:
-                self.install_packages.append(v[1])
-
-        # Do we need to remove any packages?
-        for k in iter(self.old_packages.keys()):
-            if not k in self.new_packages:
-                # We have to remove this package
-                self.remove_packages.append(k)
+        self.install_packages, self.remove_packages = compute_package_changes(self.new_packages, self.old_packages)
 
         print("---- New/Updated packages:", len(self.install_packages))
         print("---- Removed packages:", len(self.remove_packages))
 
+    def estimate_package_size(self):
+        """
+        Estimate the size of the update package from the RPMs it would ship, without copying or squashing anything.
+        """
+        if self.package_sizes is None:
+            self.package_sizes = index_package_sizes(self.packages_dir)
+
+        # The very estimate update plans are made of.
+        planner = UpdatePathPlanner(self.new_release, [self.old_release], self.package_sizes)
+        estimated_size = planner.estimate_delta_size(self.new_release, self.old_release)
+        if planner.missing_package_sizes:
+            print("---- WARNING: {} packages were not found in {}, their size is a guess."
+                  .format(len(planner.missing_package_sizes), self.packages_dir))
+        return estimated_size
+
     def create_package(self):
         # Step 1: Create dir
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -228,7 +377,10 @@ class UpdatePackageGenerator:
             # Step 5: Create SquashFS
             print("---- Creating update package...")
             generate_squash_package(self.data.get_crypto(), temp_dir,
-                                    os.path.join(self.build_dir, self.base_package_name + ".hpd"))
+                                    os.path.join(self.build_dir, self.base_package_name + ".hpd"),
+                                    payload_profile=self.payload_profile,
+                                    squash_profile=self.data.get_image().get("squash_profile"),
+                                    source_date_epoch=get_source_date_epoch(self.data.get_image()))
 
         # Step 6: Create full metadata
         try:
@@ -246,6 +398,180 @@ class UpdatePackageGenerator:
                os.path.join(self.build_dir, self.base_package_name + ".hpd")
 
 
+class UpdatePathPlanner:
+    """
+    Decides which update packages are worth building for a new release, before building any of them.
+
+    Delta sizes are estimated from the size of the RPMs each delta would ship. Every old release is then served by
+    a direct delta, by a chain through a newer release which has a direct delta, or by the full image only.
+    Chains only go through intermediate releases whose update package from the old release was published, as told
+    by step_exists(from_version, version). Without step_exists, every such package is assumed to be published.
+    Unless skip_oversized is False, deltas at least as big as the full image are oversized too. Oversized deltas
+    are left out of the plan, or with oversized_deltas set to "flag", planned anyway and marked as such.
+    """
+    def __init__(self, new_release, old_releases, package_sizes, storage_budget=None, max_delta_ratio=None,
+                 chained_updates=False, skip_oversized=True, oversized_deltas="skip", step_exists=None):
+        self.new_release = new_release
+        self.old_releases = {r["version"]: r for r in old_releases}
+        self.package_sizes = package_sizes
+        # Budget is expressed in MB, like every other size in the image metadata.
+        self.storage_budget = storage_budget * 1024 * 1024 if storage_budget is not None else None
+        self.max_delta_ratio = max_delta_ratio
+        self.chained_updates = chained_updates
+        self.skip_oversized = skip_oversized
+        self.oversized_deltas = oversized_deltas
+        self.step_exists = step_exists
+        self.full_image_size = new_release.get("download_size", 0)
+
+        self.missing_package_sizes = set()
+        if package_sizes:
+            self.average_package_size = int(sum(package_sizes.values()) / len(package_sizes))
+        else:
+            self.average_package_size = 0
+
+        self.delta_sizes = {}
+
+    def estimate_package_size(self, package):
+        try:
+            return self.package_sizes[package]
+        except KeyError:
+            # Not in the cache anymore. Guess.
+            self.missing_package_sizes.add(package)
+            return self.average_package_size
+
+    def estimate_delta_size(self, new_release, old_release):
+        key = old_release["version"], new_release["version"]
+        if key not in self.delta_sizes:
+            install_packages, _ = compute_package_changes(packages_to_dictionary(new_release["packages"]),
+                                                          packages_to_dictionary(old_release["packages"]))
+            self.delta_sizes[key] = sum(self.estimate_package_size(p) for p in install_packages)
+        return self.delta_sizes[key]
+
+    def fits_bandwidth(self, size):
+        if not self.full_image_size:
+            return True
+        if not self.max_delta_ratio:
+            # An update bigger than the full image is never worth it, but that is for planning to decide.
+            return size < self.full_image_size if self.skip_oversized else True
+        return size <= self.full_image_size * self.max_delta_ratio
+
+    def best_chain(self, version, through):
+        best = None
+        for intermediate in through:
+            if compare_version(intermediate, "", version, "") <= 0:
+                continue
+            if self.step_exists and not self.step_exists(version, intermediate):
+                continue
+            size = self.estimate_delta_size(self.old_releases[intermediate], self.old_releases[version]) + \
+                self.estimate_delta_size(self.new_release, self.old_releases[intermediate])
+            if best is None or size < best[1]:
+                best = intermediate, size
+        return best
+
+    def plan(self):
+        direct = {v: self.estimate_delta_size(self.new_release, r) for v, r in self.old_releases.items()}
+
+        # Prefer deltas saving the most download per byte stored.
+        if self.full_image_size:
+            def savings(v):
+                return (self.full_image_size - direct[v]) / max(direct[v], 1)
+        else:
+            def savings(v):
+                return -direct[v]
+
+        oversized = [v for v in direct if not self.fits_bandwidth(direct[v])]
+        candidates = [v for v in direct if v not in oversized or self.oversized_deltas == "flag"]
+
+        selected = []
+        storage = 0
+        for v in sorted(candidates, key=savings, reverse=True):
+            if self.storage_budget is not None and storage + direct[v] > self.storage_budget:
+                continue
+            selected.append(v)
+            storage += direct[v]
+
+        # Drop direct deltas which can be replaced by a chain at no additional download cost. Biggest go first,
+        # and releases used as an intermediate step have to keep their direct delta.
+        if self.chained_updates:
+            pinned = set()
+            for v in sorted(selected, key=lambda v: direct[v], reverse=True):
+                if v in pinned:
+                    continue
+                chain = self.best_chain(v, [i for i in selected if i != v])
+                if chain and chain[1] <= direct[v]:
+                    selected.remove(v)
+                    storage -= direct[v]
+                    pinned.add(chain[0])
+
+        paths = {}
+        for v in self.old_releases:
+            chain = self.best_chain(v, selected) if self.chained_updates and v not in selected else None
+            if v in selected:
+                paths[v] = {
+                    "type": "direct",
+                    "steps": [v, self.new_release["version"]],
+                    "estimated_download_size": direct[v]
+                }
+            elif chain and self.fits_bandwidth(chain[1]):
+                paths[v] = {
+                    "type": "chained",
+                    "steps": [v, chain[0], self.new_release["version"]],
+                    "estimated_download_size": chain[1]
+                }
+            else:
+                paths[v] = {
+                    "type": "full",
+                    "steps": [self.new_release["version"]],
+                    "estimated_download_size": self.full_image_size
+                }
+
+        return {
+            "version": self.new_release["version"],
+            "full_image_size": self.full_image_size,
+            "storage_budget": self.storage_budget,
+            "max_delta_ratio": self.max_delta_ratio,
+            "chained_updates": self.chained_updates,
+            "oversized_deltas": self.oversized_deltas,
+            "estimated_storage": storage,
+            "packages_without_size": len(self.missing_package_sizes),
+            "deltas": [{
+                "from_version": v,
+                "version": self.new_release["version"],
+                "estimated_size": direct[v],
+                "oversized": v in oversized
+            } for v in selected],
+            "skipped_deltas": [{
+                "from_version": v,
+                "version": self.new_release["version"],
+                "estimated_size": direct[v]
+            } for v in oversized if v not in candidates],
+            "paths": paths
+        }
+
+
+def store_step_checker(uploader, configuration):
+    """
+    Tells whether uploader has the update package between two releases. Stores are asked once per package, and
+    packages are assumed to be missing when a store can't tell.
+    """
+    steps = {}
+
+    def step_exists(from_version, version):
+        if (from_version, version) not in steps:
+            try:
+                steps[from_version, version] = uploader.check_store_has_update_package(
+                    configuration.get_image()["name"], configuration.get_image()["group"], from_version, version,
+                    variant=configuration.get_image_variant())
+            except StoreNotAvailableException:
+                steps[from_version, version] = False
+            if not steps[from_version, version]:
+                print("-- {} has no update package {} -> {}, not chaining through it"
+                      .format(str(uploader), from_version, version))
+        return steps[from_version, version]
+
+    return step_exists
+
+
 def create_hemera_update_packages(args_parameter=None):
     parser = argparse.ArgumentParser(description='Hemera Update Package generator')
     parser.add_argument('metadata', type=str, help="The image's metadata")
@@ -257,6 +583,13 @@ def create_hemera_update_packages(args_parameter=None):
                         help='Skips the crypto instruction. WARNING: Use for local testing only!!')
     parser.add_argument('--skip-sanity-checks', action='store_true',
                         help='Continues even if some sanity checks fail. Do not use in production!')
+    parser.add_argument('--plan', type=str,
+                        help='Where to write the update plan. Defaults to the build directory.')
+    parser.add_argument('--plan-only', action='store_true',
+                        help='Only computes and writes the update plan, without building any package.')
+    parser.add_argument('--metrics', type=str,
+                        help="Where to write metrics as an OpenMetrics text file, e.g. in node_exporter's textfile "
+                             "collector directory")
 
     if args_parameter:
         args = parser.parse_args(args=args_parameter)
@@ -266,6 +599,8 @@ def create_hemera_update_packages(args_parameter=None):
     # Create ImageConfigurationManager
     configuration = ImageConfigurationManager(args.metadata)
     assert configuration.get_image_version()
+    metrics.set_labels(appliance=configuration.get_image()["name"], version=configuration.get_image_version(),
+                       variant=configuration.get_image_variant())
 
     major_version = int(configuration.get_image_version().split('.')[0])
 
@@ -293,62 +628,167 @@ def create_hemera_update_packages(args_parameter=None):
               "There's no way I can generate packages locally! Exiting gracefully...")
         sys.exit(0)
 
-    # Get old releases
-    for u in actual_uploaders:
-        # Get information about current image.
-        try:
-            current_release_metadata = u.check_store_has_image(configuration.get_image()["name"],
-                                                               configuration.get_image()["group"],
-                                                               version=configuration.get_image_version(),
-                                                               variant=configuration.get_image_variant())
-        except FileNotFoundError:
-            print("-- Uploader {} does not have image {} version {}. Continuing..."
-                  .format(str(u), configuration.get_image()["name"], configuration.get_image_version()))
-            continue
+    update_planning = configuration.get_update_planning()
+    plan_filename = args.plan if args.plan else os.path.join(build_dir, configuration.get_full_image_name() +
+                                                             "_update_plan.json")
+    regression_tracking = configuration.get_regression_tracking()
+    plans = {}
+    package_sizes = index_package_sizes(MIC_CACHE_DIR)
 
-        print("-- Generating updates for uploader {}".format(str(u)))
-        old_versions = u.get_old_versions_from_store(configuration.get_image()["name"],
-                                                     configuration.get_image()["group"],
-                                                     variant=configuration.get_image_variant())
+    try:
+        # Get old releases
+        for u in actual_uploaders:
+            # Get information about current image.
+            try:
+                current_release_metadata = u.check_store_has_image(configuration.get_image()["name"],
+                                                                   configuration.get_image()["group"],
+                                                                   version=configuration.get_image_version(),
+                                                                   variant=configuration.get_image_variant())
+            except FileNotFoundError:
+                print("-- Uploader {} does not have image {} version {}. Continuing..."
+                      .format(str(u), configuration.get_image()["name"], configuration.get_image_version()))
+                continue
 
-        if not old_versions:
-            print("-- Apparently, that was the only release available. "
-                  "All is fine, see you next time, then I'll have work to do!")
-            continue
+            print("-- Generating updates for uploader {}".format(str(u)))
+            old_versions = u.get_old_versions_from_store(configuration.get_image()["name"],
+                                                         configuration.get_image()["group"],
+                                                         variant=configuration.get_image_variant())
 
-        for metadata in old_versions:
-            if metadata["version"] == "rolling" or metadata["version"] == current_release_metadata["version"]:
-                continue
-            # We generate update packages only if the major version is the same.
-            if int(metadata["version"].split('.')[0]) != major_version:
+            if not old_versions:
+                print("-- Apparently, that was the only release available. "
+                      "All is fine, see you next time, then I'll have work to do!")
                 continue
 
-            # Verify if the version is actually newer. We do not want to accidentally generate downgrade packages!
-            if compare_version(configuration.get_image_version(), "", metadata["version"], "") < 1:
-                print("-- Version {} was found as a release, but it is newer than {}. Skipping."
-                      .format(metadata["version"], configuration.get_image_version()))
+            candidate_releases = []
+            for metadata in old_versions:
+                if metadata["version"] == "rolling" or metadata["version"] == current_release_metadata["version"]:
+                    continue
+                # We generate update packages only if the major version is the same.
+                if int(metadata["version"].split('.')[0]) != major_version:
+                    continue
+
+                # Verify if the version is actually newer. We do not want to accidentally generate downgrade packages!
+                if compare_version(configuration.get_image_version(), "", metadata["version"], "") < 1:
+                    print("-- Version {} was found as a release, but it is newer than {}. Skipping."
+                          .format(metadata["version"], configuration.get_image_version()))
+                    continue
+                candidate_releases.append(metadata)
+
+            # Update packages are compared release over release on the delta from the previous release only.
+            previous_version = None
+            for metadata in candidate_releases:
+                if not previous_version or compare_version(metadata["version"], "", previous_version, "") > 0:
+                    previous_version = metadata["version"]
+            history = create_artifact_history(regression_tracking, current_release_metadata["appliance_name"]) \
+                if regression_tracking else None
+
+            # Figure out which packages are actually worth building.
+            planner = UpdatePathPlanner(current_release_metadata, candidate_releases, package_sizes,
+                                        storage_budget=update_planning.get("storage_budget"),
+                                        max_delta_ratio=update_planning.get("max_delta_ratio"),
+                                        chained_updates=update_planning.get("chained_updates", False),
+                                        # Without planning, every update package gets built, as it always did.
+                                        skip_oversized=bool(update_planning),
+                                        oversized_deltas=update_planning.get("oversized_deltas", "skip"),
+                                        step_exists=store_step_checker(u, configuration))
+            plan = planner.plan()
+            plans[str(u)] = plan
+            with open(plan_filename, 'w') as outfile:
+                json.dump(plans, outfile, indent=4)
+
+            print("-- Update plan: {} direct, {} chained, {} full image only. Estimated storage: {} bytes"
+                  .format(len(plan["deltas"]), len([p for p in plan["paths"].values() if p["type"] == "chained"]),
+                          len([p for p in plan["paths"].values() if p["type"] == "full"]), plan["estimated_storage"]))
+            for path_type in ("direct", "chained", "full"):
+                metrics.set("update_paths", len([p for p in plan["paths"].values() if p["type"] == path_type]),
+                            "Number of old releases served by each kind of update path", store=str(u),
+                            path_type=path_type)
+            metrics.set("update_estimated_storage_bytes", plan["estimated_storage"],
+                        "Estimated storage taken by the planned update packages", store=str(u))
+            if args.plan_only:
                 continue
-            print("-- Generating package {} -> {}".format(metadata["version"],
-                                                          configuration.get_image_version()))
-            generator = UpdatePackageGenerator(configuration,
-                                               new_release=current_release_metadata,
-                                               old_release=metadata, packages_dir=MIC_CACHE_DIR)
-
-            # Do it!
-            try:
-                generator.read_packages()
-                generator.populate_package_list()
-                generator.create_package()
 
-                print("-- Update package created successfully!")
-
-                # Upload now
-                if not args.skip_upload:
+            # Oversized deltas were either left out of the plan, or planned and flagged.
+            for delta in plan["skipped_deltas"]:
+                print("-- Package {} -> {} would be bigger than update planning allows ({} bytes). Skipping."
+                      .format(delta["from_version"], delta["version"], delta["estimated_size"]))
+                metrics.add("update_packages_skipped", 1, "Number of update packages skipped as oversized",
+                            store=str(u))
+
+            for delta in plan["deltas"]:
+                metadata = planner.old_releases[delta["from_version"]]
+                print("-- Generating package {} -> {}".format(metadata["version"],
+                                                              configuration.get_image_version()))
+                generator = UpdatePackageGenerator(configuration,
+                                                   new_release=current_release_metadata,
+                                                   old_release=metadata, packages_dir=MIC_CACHE_DIR,
+                                                   package_sizes=package_sizes)
+
+                # Do it!
+                try:
+                    generator.read_packages()
+                    generator.populate_package_list()
+
+                    # Check the package is actually worth it before doing any heavy lifting.
+                    estimated_size = generator.estimate_package_size()
+                    metrics.set("update_package_estimated_bytes", estimated_size,
+                                "Estimated size of each update package", store=str(u),
+                                from_version=metadata["version"])
+                    metrics.set("update_package_rpms", len(generator.install_packages),
+                                "Number of new or updated RPMs in each update package", store=str(u),
+                                from_version=metadata["version"])
+                    metrics.set("update_package_removed_rpms", len(generator.remove_packages),
+                                "Number of RPMs each update package removes", store=str(u),
+                                from_version=metadata["version"])
+                    print("---- Estimated package size: {} bytes. Full image size: {} bytes."
+                          .format(estimated_size, plan["full_image_size"]))
+                    if delta["oversized"]:
+                        print("-- WARNING: Package will be bigger than update planning allows!")
+
+                    start = time.perf_counter()
+                    with tracer.span("Create update package", from_version=metadata["version"]):
+                        generator.create_package()
+                    package_seconds = time.perf_counter() - start
+
+                    print("-- Update package created successfully!")
                     update_metadata, update_package = generator.get_update_package()
-                    u.upload_update_package(configuration.get_image()["name"], configuration.get_image()["group"],
-                                            update_metadata, update_package,
-                                            version=configuration.get_image_version(),
-                                            variant=configuration.get_image_variant())
-            except Exception as err:
-                print("Package creation failed!")
-                raise
+                    if history:
+                        entry = history.create_entry(current_release_metadata["appliance_name"],
+                                                     configuration.get_image_version(), "update",
+                                                     os.path.getsize(update_package), package_seconds,
+                                                     package_count=len(generator.install_packages),
+                                                     removed_package_count=len(generator.remove_packages),
+                                                     estimated_size=estimated_size, store=str(u),
+                                                     from_version=metadata["version"],
+                                                     from_previous_release=metadata["version"] == previous_version)
+                        if entry["from_previous_release"]:
+                            history.record(entry, history.get_last_entry(
+                                entry["appliance_name"], "update", exclude_version=entry["version"], store=str(u),
+                                from_previous_release=True))
+                        else:
+                            history.append(entry)
+                    metrics.add("update_packages_built", 1, "Number of update packages built", store=str(u))
+                    metrics.set("update_package_bytes", os.path.getsize(update_package),
+                                "Size of each update package", store=str(u), from_version=metadata["version"])
+
+                    # Upload now
+                    if not args.skip_upload:
+                        start = time.perf_counter()
+                        with tracer.span("Upload update package", store=str(u)):
+                            u.upload_update_package(configuration.get_image()["name"],
+                                                    configuration.get_image()["group"],
+                                                    update_metadata, update_package,
+                                                    version=configuration.get_image_version(),
+                                                    variant=configuration.get_image_variant())
+                        metrics.record_upload(str(u), os.path.getsize(update_metadata) +
+                                              os.path.getsize(update_package), time.perf_counter() - start)
+                except Exception as err:
+                    print("Package creation failed!")
+                    raise
+    except:
+        if args.metrics:
+            metrics.write_textfile(args.metrics, success=False)
+        raise
+
+    if args.metrics:
+        metrics.write_textfile(args.metrics)
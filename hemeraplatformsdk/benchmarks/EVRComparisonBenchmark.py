@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import random
+import time
+
+from hemeraplatformsdk.UpdatePackageGenerator import compute_package_changes, package_evr, \
+    packages_to_dictionary, split_filename, version_segments
+
+try:
+    from version_utils import rpm
+except ImportError:
+    rpm = None
+
+PACKAGE_ARCHES = ["armv7hl", "noarch"]
+PACKAGE_NAME_PARTS = ["lib", "qt5", "hemera", "gravity", "systemd", "python3", "perl", "kernel", "glib2", "dbus",
+                      "connman", "ofono", "openssl", "zypper", "rpm", "busybox", "util-linux", "e2fsprogs"]
+
+
+def random_version(rng):
+    version = ".".join(str(rng.randint(0, 20)) for _ in range(rng.randint(2, 4)))
+    kind = rng.random()
+    if kind < 0.1:
+        version += "+git{}".format(rng.randint(20150101, 20161231))
+    elif kind < 0.15:
+        version += "~rc{}".format(rng.randint(1, 5))
+    return version
+
+
+def random_release(rng):
+    return "{}.{}.{}".format(rng.randint(1, 30), rng.randint(1, 9), rng.randint(1, 99))
+
+
+def bump_version(rng, version):
+    # Bump a random numeric component, so that the new version is newer.
+    parts = version.split(".")
+    index = rng.randrange(len(parts))
+    head = "".join(c for c in parts[index] if c.isdigit()) or "0"
+    parts[index] = str(int(head) + 1)
+    return ".".join(parts[:index + 1])
+
+
+def generate_release(rng, packages):
+    return ["{}-{}-{}.{}.rpm".format(name, version, release, arch) for name, (version, release, arch)
+            in sorted(packages.items())]
+
+
+def generate_package_lists(package_count, delta_count, change_ratio, seed):
+    """
+    Generate a new release and delta_count old releases, each one older than the next.
+    """
+    rng = random.Random(seed)
+    packages = {}
+    while len(packages) < package_count:
+        name = "{}-{}{}".format(rng.choice(PACKAGE_NAME_PARTS), rng.choice(PACKAGE_NAME_PARTS), len(packages))
+        packages[name] = (random_version(rng), random_release(rng), rng.choice(PACKAGE_ARCHES))
+
+    releases = [generate_release(rng, packages)]
+    for _ in range(delta_count):
+        newer = dict(packages)
+        for name in rng.sample(sorted(packages), int(package_count * change_ratio)):
+            version, release, arch = packages[name]
+            if rng.random() < 0.5:
+                newer[name] = (bump_version(rng, version), release, arch)
+            else:
+                newer[name] = (version, random_release(rng), arch)
+        # Some packages appear, some disappear
+        for _ in range(int(package_count * change_ratio / 10)):
+            newer.pop(rng.choice(sorted(newer)), None)
+            newer["new-package{}".format(rng.randint(0, 1 << 30))] = (random_version(rng), random_release(rng),
+                                                                     rng.choice(PACKAGE_ARCHES))
+        packages = newer
+        releases.append(generate_release(rng, packages))
+
+    # Newest first
+    releases.reverse()
+    return releases[0], releases[1:]
+
+
+def version_utils_install_packages(new_release, old_release):
+    # This is the original populate_package_list path: uncached parsing, and version_utils on strings.
+    def to_dictionary(packages):
+        packages_dict = {}
+        for package in packages:
+            parsed = split_filename.__wrapped__(package)
+            packages_dict[parsed[0]] = parsed[3:], package
+        return packages_dict
+
+    new_packages = to_dictionary(new_release)
+    old_packages = to_dictionary(old_release)
+    install_packages = []
+    for k, v in new_packages.items():
+        if k in old_packages:
+            old_version = old_packages[k][0]
+            if rpm.compare_versions(v[0][0] + "-" + v[0][1], old_version[0] + "-" + old_version[1]) > 0:
+                install_packages.append(v[1])
+        else:
+            install_packages.append(v[1])
+    return install_packages
+
+
+def cached_install_packages(new_release, old_release):
+    # Same as UpdatePackageGenerator.populate_package_list
+    return compute_package_changes(packages_to_dictionary(new_release), packages_to_dictionary(old_release))[0]
+
+
+def clear_caches():
+    split_filename.cache_clear()
+    package_evr.cache_clear()
+    version_segments.cache_clear()
+
+
+def run_planning(function, new_release, old_releases):
+    start = time.perf_counter()
+    results = [function(new_release, old_release) for old_release in old_releases]
+    return time.perf_counter() - start, results
+
+
+def benchmark_evr_comparison(args_parameter=None):
+    parser = argparse.ArgumentParser(description='Benchmarks EVR comparison when planning update packages')
+    parser.add_argument('--packages', type=int, default=5000, help="Number of packages in each release")
+    parser.add_argument('--deltas', type=int, default=10, help="Number of old releases to generate deltas from")
+    parser.add_argument('--change-ratio', type=float, default=0.2,
+                        help="Fraction of packages changing between two consecutive releases")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs. The best one is reported")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic package lists")
+    parser.add_argument('--json', type=str, help="Write results to this JSON file")
+
+    if args_parameter:
+        args = parser.parse_args(args=args_parameter)
+    else:
+        args = parser.parse_args()
+
+    print("-- Generating {} releases of {} packages...".format(args.deltas + 1, args.packages))
+    new_release, old_releases = generate_package_lists(args.packages, args.deltas, args.change_ratio, args.seed)
+
+    results = {
+        "packages": args.packages,
+        "deltas": args.deltas,
+        "change_ratio": args.change_ratio
+    }
+
+    cold_timings = []
+    warm_timings = []
+    for _ in range(args.repeat):
+        clear_caches()
+        cold_time, cached_results = run_planning(cached_install_packages, new_release, old_releases)
+        warm_time, _ = run_planning(cached_install_packages, new_release, old_releases)
+        cold_timings.append(cold_time)
+        warm_timings.append(warm_time)
+    results["cached_cold_seconds"] = min(cold_timings)
+    results["cached_warm_seconds"] = min(warm_timings)
+
+    if rpm:
+        timings = []
+        for _ in range(args.repeat):
+            version_utils_time, version_utils_results = run_planning(version_utils_install_packages,
+                                                                     new_release, old_releases)
+            timings.append(version_utils_time)
+        results["version_utils_seconds"] = min(timings)
+        results["speedup_cold"] = results["version_utils_seconds"] / results["cached_cold_seconds"]
+        results["speedup_warm"] = results["version_utils_seconds"] / results["cached_warm_seconds"]
+
+        mismatches = [old_release for old_release, a, b in zip(old_releases, cached_results, version_utils_results)
+                      if sorted(a) != sorted(b)]
+        results["mismatching_deltas"] = len(mismatches)
+        if mismatches:
+            print("-- WARNING: {} deltas have different package lists than version_utils!".format(len(mismatches)))
+    else:
+        print("-- version_utils is not installed, reporting cached comparison only.")
+
+    for key, value in results.items():
+        print("--- {}: {}".format(key, round(value, 4) if isinstance(value, float) else value))
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(results, outfile, indent=4)
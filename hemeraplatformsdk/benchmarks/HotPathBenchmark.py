@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from hemeraplatformsdk.UpdatePackageGenerator import UpdatePackageGenerator, packages_to_dictionary
+from hemeraplatformsdk.benchmarks.EVRComparisonBenchmark import clear_caches, generate_package_lists
+from hemeraplatformsdk.imagebuilders.FsImageBuilder import FsImageBuilder
+from hemeraplatformsdk.imagebuilders.devices.PartitionDevice import PartitionDevice
+
+try:
+    from hemeraplatformsdk.imagebuilders.devices.RawDevice import RawDevice
+except ImportError:
+    # python-parted is missing
+    RawDevice = None
+
+COMPRESSION_FORMATS = ["bz2", "gz", "xz", "zip"]
+BENCHMARKS = ["compress_file", "compress_files", "image_metadata", "tar_extraction", "installer_data",
+              "package_list", "flashing"]
+TEXT_WORDS = ["hemera", "gravity", "astarte", "systemd", "usr", "lib", "share", "locale", "qt5", "plugins", "etc",
+              "include", "python3", "site-packages", "firmware", "doc", "man", "0", "1", "x86_64", "armv7hl"]
+DEFAULT_MAX_REGRESSION = 10
+# What makes two runs comparable
+BENCHMARK_PARAMETERS = ["size", "files", "packages", "deltas", "device_nodes", "partitions", "repeat", "seed"]
+
+
+def generate_payload(rng, filename, size):
+    """
+    Write size bytes of data compressing roughly like a root filesystem: half text, half binary noise.
+    """
+    chunk_size = 65536
+    with open(filename, "wb") as f:
+        written = 0
+        while written < size:
+            text = " ".join(rng.choice(TEXT_WORDS) for _ in range(chunk_size // 8)).encode()[:chunk_size // 2]
+            noise = rng.getrandbits(8 * (chunk_size // 2)).to_bytes(chunk_size // 2, "little")
+            chunk = (text + noise)[:size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+
+def generate_tree(rng, directory, file_count, file_size):
+    for i in range(file_count):
+        subdir = os.path.join(directory, "dir{:03d}".format(i % 100))
+        os.makedirs(subdir, exist_ok=True)
+        generate_payload(rng, os.path.join(subdir, "file{:05d}".format(i)), rng.randint(1, file_size * 2))
+
+
+def generate_packages_file(filename, release):
+    # Same format as mic's: "name.arch epoch:version-release"
+    with open(filename, "w") as f:
+        for package in release:
+            name_version_release, arch = package[:-len(".rpm")].rsplit(".", 1)
+            name_version, release_part = name_version_release.rsplit("-", 1)
+            name, version = name_version.rsplit("-", 1)
+            f.write("{}.{} {}-{}\n".format(name, arch, version, release_part))
+
+
+def generate_partition_layout(device_nodes, partitions_per_node):
+    devices = []
+    mountpoints = ["/", "/var", "/var/cache", "/home"]
+    for node in range(device_nodes):
+        for number in range(1, partitions_per_node + 1):
+            index = node * partitions_per_node + number - 1
+            devices.append({
+                "type": "partition-gpt",
+                "install_device": "/dev/mmcblk{}p{}".format(node, number),
+                "filesystem": "ext4",
+                "mountpoint": mountpoints[index] if index < len(mountpoints) else "/data{}".format(index),
+                "label": "part{}".format(index),
+                "name": "part{}".format(index),
+                "size": 64
+            })
+    return devices
+
+
+class HotPathBenchmark:
+    """
+    Times the Python hot paths of an image build on synthetic data. Nothing touches the network or needs root.
+    """
+    def __init__(self, work_dir, size, repeat, seed):
+        self.work_dir = work_dir
+        self.size = size
+        self.repeat = repeat
+        self.rng = random.Random(seed)
+        self.results = {}
+
+        self.payload = os.path.join(work_dir, "payload.bin")
+        generate_payload(self.rng, self.payload, size)
+
+    def make_builder(self, data=None):
+        image = {"name": "benchmark", "type": "fs", "skip_incompressible": False}
+        image.update(data if data else {})
+        builder = FsImageBuilder(image, {}, build_root=self.work_dir)
+        # Devices look this up, but only raw multipart builders have it.
+        builder.partition_population = "mount"
+        return builder
+
+    def measure(self, name, function, setup=None, processed_bytes=None):
+        """
+        Run function repeat times, after an untimed setup, and keep the best run.
+        """
+        timings = []
+        for _ in range(self.repeat):
+            arguments = setup() if setup else ()
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                function(*arguments)
+                timings.append(time.perf_counter() - start)
+
+        result = {"seconds": min(timings)}
+        if processed_bytes:
+            result["bytes"] = processed_bytes
+            result["throughput"] = processed_bytes / result["seconds"] if result["seconds"] else 0
+        self.results[name] = result
+        print("--- {:<40} {:>10.4f} s{}".format(name, result["seconds"],
+                                                "  {:>10.1f} MB/s".format(result["throughput"] / 1048576)
+                                                if processed_bytes else ""))
+
+    def copy_payload(self, name):
+        filename = os.path.join(self.work_dir, name)
+        shutil.copyfile(self.payload, filename)
+        return filename
+
+    def benchmark_compress_file(self):
+        for compression_format in COMPRESSION_FORMATS:
+            builder = self.make_builder({"compression_format": compression_format})
+
+            def setup():
+                for f in os.listdir(builder.build_dir):
+                    os.remove(os.path.join(builder.build_dir, f))
+                return self.copy_payload(os.path.join(builder.build_dir, "payload")),
+
+            self.measure("compress_file_" + compression_format, builder.compress_file, setup, self.size)
+            shutil.rmtree(builder.build_dir)
+
+    def benchmark_compress_files(self, file_count):
+        tree = os.path.join(self.work_dir, "tree")
+        generate_tree(self.rng, tree, file_count, max(self.size // file_count, 1))
+        files = [os.path.join(root, f) for root, dirs, names in os.walk(tree) for f in names]
+        tree_size = sum(os.path.getsize(f) for f in files)
+
+        for compression_format in COMPRESSION_FORMATS:
+            builder = self.make_builder({"compression_format": compression_format})
+            out_filename = os.path.join(builder.build_dir, "tree.tar." + compression_format)
+            self.measure("compress_files_" + compression_format,
+                         lambda: builder.compress_files(files, out_filename, base_dir=tree), processed_bytes=tree_size)
+            shutil.rmtree(builder.build_dir)
+
+        shutil.rmtree(tree)
+
+    def benchmark_image_metadata(self, package_count):
+        builder = self.make_builder()
+        new_release, _ = generate_package_lists(package_count, 0, 0, self.rng.random())
+        os.makedirs(builder.output_dir, exist_ok=True)
+        generate_packages_file(os.path.join(builder.output_dir, builder.image_name + ".packages"), new_release)
+
+        self.measure("image_metadata_hashing", lambda: builder.generate_image_metadata(self.payload),
+                     processed_bytes=self.size)
+        self.measure("image_metadata_packages", lambda: builder.generate_image_metadata(None))
+        shutil.rmtree(builder.build_dir)
+
+    def benchmark_tar_extraction(self, file_count):
+        tree = os.path.join(self.work_dir, "tree")
+        generate_tree(self.rng, tree, file_count, max(self.size // file_count, 1))
+        tarball = os.path.join(self.work_dir, "tree.tar")
+        with tarfile.open(tarball, "w") as tar:
+            tar.add(tree, arcname="")
+        shutil.rmtree(tree)
+        extract_dir = os.path.join(self.work_dir, "extracted")
+
+        def setup():
+            shutil.rmtree(extract_dir, ignore_errors=True)
+            return ()
+
+        def extract():
+            # Same as RawMultipartImageBuilder
+            with tarfile.open(tarball) as fs_compressed:
+                fs_compressed.extractall(path=extract_dir)
+
+        self.measure("tar_extraction", extract, setup, os.path.getsize(tarball))
+        shutil.rmtree(extract_dir)
+        os.remove(tarball)
+
+    def benchmark_installer_data(self, device_nodes, partitions_per_node):
+        builder = self.make_builder({"name": "benchmark_installer"})
+        built_packages = [(PartitionDevice(d, builder), [os.path.join(builder.build_dir, d["name"] + ".raw")])
+                          for d in generate_partition_layout(device_nodes, partitions_per_node)]
+
+        def setup():
+            builder.ks_copy_files_in_image = {}
+            return ()
+
+        self.measure("installer_data_{}_partitions".format(len(built_packages)),
+                     lambda: builder.prepare_installer_data(built_packages), setup)
+        shutil.rmtree(builder.build_dir)
+
+    def benchmark_package_list(self, package_count, delta_count):
+        new_release, old_releases = generate_package_lists(package_count, delta_count, 0.2, self.rng.random())
+
+        def setup():
+            clear_caches()
+            return ()
+
+        self.measure("packages_to_dictionary_{}".format(package_count),
+                     lambda: [packages_to_dictionary(r) for r in [new_release] + old_releases], setup)
+
+        def plan():
+            new_packages = packages_to_dictionary(new_release)
+            for old_release in old_releases:
+                # Only the package lists matter to populate_package_list.
+                generator = UpdatePackageGenerator.__new__(UpdatePackageGenerator)
+                generator.new_packages = new_packages
+                generator.old_packages = packages_to_dictionary(old_release)
+                generator.populate_package_list()
+
+        self.measure("populate_package_list_{}x{}".format(package_count, delta_count), plan, setup)
+
+    def benchmark_flashing(self):
+        if not RawDevice:
+            print("--- python-parted is not installed, skipping flashing")
+            return
+
+        builder = self.make_builder()
+        size_mb = self.size // 1048576 + 1
+        device = RawDevice({"type": "raw", "install_device": "/dev/mmcblk0",
+                            "partitions": [{"name": "flash", "size": size_mb + 1, "flash": self.payload + ".flash"}]},
+                           builder)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            device.create_disk("gpt")
+
+        def setup():
+            # extract_file drops what it flashed.
+            self.copy_payload(self.payload + ".flash")
+            return builder.build_dir,
+
+        self.measure("flashing", device.extract_file, setup, self.size)
+        shutil.rmtree(builder.build_dir)
+
+
+def compare_to_baseline(results, baseline, max_regression):
+    """
+    Print how each benchmark moved since the baseline, and return the names of those which regressed.
+    """
+    regressions = []
+    print("-- {:<40} {:>12} {:>12} {:>8}".format("benchmark", "baseline (s)", "now (s)", "change"))
+    for name, result in results.items():
+        try:
+            before = baseline[name]["seconds"]
+        except KeyError:
+            continue
+        change = 100 * (result["seconds"] - before) / before if before else 0
+        if change > max_regression:
+            regressions.append(name)
+        print("-- {:<40} {:>12.4f} {:>12.4f} {:>+7.1f}%{}".format(name, before, result["seconds"], change,
+                                                                   " REGRESSION" if name in regressions else ""))
+    return regressions
+
+
+def benchmark_hot_paths(args_parameter=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the Python hot paths of image builds on synthetic data')
+    parser.add_argument('--only', type=str, action='append', choices=BENCHMARKS,
+                        help="Run only this benchmark. Can be given more than once")
+    parser.add_argument('--size', type=int, default=16, help="Size of the synthetic payloads, in MB")
+    parser.add_argument('--files', type=int, default=2000, help="Number of files in synthetic trees")
+    parser.add_argument('--packages', type=int, default=10000, help="Number of packages in each release")
+    parser.add_argument('--deltas', type=int, default=5, help="Number of old releases to plan updates from")
+    parser.add_argument('--device-nodes', type=int, default=4, help="Number of disks in the installer layout")
+    parser.add_argument('--partitions', type=int, default=64, help="Number of partitions on each disk")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs. The best one is reported")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic data")
+    parser.add_argument('--work-dir', type=str, help="Where to write synthetic data")
+    parser.add_argument('--json', type=str, help="Write results to this JSON file")
+    parser.add_argument('--baseline', type=str, help="Compare results with this JSON file, written by --json")
+    parser.add_argument('--max-regression', type=float, default=DEFAULT_MAX_REGRESSION,
+                        help="Slowdown compared to the baseline, in percent, above which a benchmark regressed")
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help="Exit with an error if any benchmark regressed")
+
+    if args_parameter:
+        args = parser.parse_args(args=args_parameter)
+    else:
+        args = parser.parse_args()
+
+    selected = args.only if args.only else BENCHMARKS
+    size = args.size * 1048576
+    # Partition numbers have at most two digits
+    partitions = min(args.partitions, 99)
+
+    print("-- Benchmarking {}...".format(", ".join(selected)))
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        benchmark = HotPathBenchmark(work_dir, size, args.repeat, args.seed)
+        if "compress_file" in selected:
+            benchmark.benchmark_compress_file()
+        if "compress_files" in selected:
+            benchmark.benchmark_compress_files(args.files)
+        if "image_metadata" in selected:
+            benchmark.benchmark_image_metadata(args.packages)
+        if "tar_extraction" in selected:
+            benchmark.benchmark_tar_extraction(args.files)
+        if "installer_data" in selected:
+            benchmark.benchmark_installer_data(args.device_nodes, partitions)
+        if "package_list" in selected:
+            benchmark.benchmark_package_list(args.packages, args.deltas)
+        if "flashing" in selected:
+            benchmark.benchmark_flashing()
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": {k: v for k, v in vars(args).items() if k in BENCHMARK_PARAMETERS},
+        "results": benchmark.results
+    }
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(results, outfile, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as data_file:
+            baseline = json.load(data_file)
+        if baseline["parameters"] != results["parameters"]:
+            print("-- WARNING: the baseline was run with different parameters, results might not be comparable.")
+        regressions = compare_to_baseline(benchmark.results, baseline["results"], args.max_regression)
+        if regressions:
+            print("-- {} benchmarks regressed by more than {}%: {}".format(len(regressions), args.max_regression,
+                                                                         ", ".join(regressions)))
+            if args.fail_on_regression:
+                sys.exit(1)
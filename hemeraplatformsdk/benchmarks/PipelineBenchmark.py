@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from hemeraplatformsdk.BuildTracer import BuildTracer
+from hemeraplatformsdk.ProcessExecutor import exit_code_from_status
+from hemeraplatformsdk.benchmarks.StubToolchain import STUB_COMPRESSION_RATIO, STUB_MIC_SECONDS, STUB_PACKAGES, \
+    STUB_ROOTFS_FILES, STUB_ROOTFS_SIZE, STUB_STATE_DIR, install_stub_toolchain
+
+BUILD_KINDS = ["fs", "raw", "squash", "installer", "vm"]
+BUILD_COMMAND = "from hemeraplatformsdk.ImageBuilder import build_hemera_image; build_hemera_image()"
+REPORTED_STAGES = 8
+
+
+def disk_usage(paths):
+    # Allocated blocks rather than sizes: images are sparse.
+    usage = 0
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                try:
+                    usage += os.lstat(os.path.join(root, f)).st_blocks * 512
+                except FileNotFoundError:
+                    # Gone in the meantime
+                    pass
+    return usage
+
+
+def raw_image(name, partition_size, compress):
+    return {
+        "name": name,
+        "group": "benchmark",
+        "arch": "armv7hl",
+        "type": "raw",
+        "compress": compress,
+        "repositories": [{"name": "Hemera:Benchmark"}],
+        "packages": ["@Hemera Benchmark"],
+        "devices": [
+            {"type": "partition", "install_device": "/dev/mmcblk0p1", "filesystem": "ext4", "mountpoint": "/",
+             "label": "rootfs", "size": partition_size},
+            {"type": "partition", "install_device": "/dev/mmcblk0p2", "filesystem": "ext4", "mountpoint": "/var",
+             "label": "var", "size": partition_size}
+        ]
+    }
+
+
+def generate_configuration(kind, rootfs_size, compress):
+    """
+    A minimal image configuration of each kind, for stand-in tools.
+    """
+    name = "benchmark_" + kind
+    base_image = {
+        "name": name,
+        "group": "benchmark",
+        "arch": "armv7hl",
+        "compress": compress,
+        "repositories": [{"name": "Hemera:Benchmark"}],
+        "packages": ["@Hemera Benchmark"]
+    }
+    # Room for the whole rootfs in every partition, so that any layout fits.
+    partition_size = rootfs_size // 1048576 * 2 + 64
+
+    if kind == "raw":
+        return {"image": raw_image(name, partition_size, compress)}
+    elif kind == "installer":
+        # Inner images of installers are never compressed.
+        return {"image": raw_image(name, partition_size, False),
+                "installer": dict(base_image, type="squash", name=name + "_installer")}
+    elif kind == "vm":
+        return {"image": dict(base_image, type="vm", arch="i686")}
+    return {"image": dict(base_image, type=kind)}
+
+
+class PipelineBenchmark:
+    """
+    Runs whole image builds with stand-in tools, measuring where the time goes and how much disk and memory it takes.
+
+    Each build runs build-hemera-image in its own process, so that its peak RSS can be told apart. Disk usage of the
+    work directory and of the staging paths is sampled while the build runs.
+    """
+    def __init__(self, work_dir, rootfs_size, rootfs_files, packages, mic_seconds, compression_ratio,
+                 sample_interval):
+        self.work_dir = work_dir
+        self.sample_interval = sample_interval
+
+        bin_dir = os.path.join(work_dir, "bin")
+        install_stub_toolchain(bin_dir)
+        self.env = os.environ.copy()
+        self.env.update({
+            "PATH": bin_dir + os.pathsep + self.env.get("PATH", ""),
+            # Standalone, non-versioned builds.
+            "CI_BUILD_REF_NAME": "master",
+            STUB_ROOTFS_SIZE: str(rootfs_size),
+            STUB_ROOTFS_FILES: str(rootfs_files),
+            STUB_PACKAGES: str(packages),
+            STUB_MIC_SECONDS: str(mic_seconds),
+            STUB_COMPRESSION_RATIO: str(compression_ratio),
+            STUB_STATE_DIR: os.path.join(work_dir, "state"),
+            # Where raw builds stage their partitions, outside of the build directory
+            "HEMERA_WORKSPACE_DIR": os.path.join(work_dir, "workspaces")
+        })
+        self.env.pop("CI_BUILD_TAG", None)
+        self.env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))] + [p for p in [self.env.get("PYTHONPATH")] if p])
+        os.makedirs(self.env[STUB_STATE_DIR], exist_ok=True)
+
+    def run_build(self, name, configuration, build_args=None):
+        build_dir = os.path.join(self.work_dir, name)
+        os.makedirs(build_dir)
+        configuration_file = os.path.join(build_dir, name + ".json")
+        with open(configuration_file, "w") as outfile:
+            json.dump(configuration, outfile, indent=4)
+        trace_file = os.path.join(build_dir, name + ".trace.json")
+        log_file = os.path.join(build_dir, name + ".log")
+
+        peak_disk = 0
+        done = threading.Event()
+
+        def sample_disk_usage():
+            nonlocal peak_disk
+            while not done.wait(self.sample_interval):
+                peak_disk = max(peak_disk, disk_usage([build_dir, self.env["HEMERA_WORKSPACE_DIR"]]))
+
+        sampler = threading.Thread(target=sample_disk_usage)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            with open(log_file, "w") as log:
+                proc = subprocess.Popen([sys.executable, "-c", BUILD_COMMAND, configuration_file, "--skip-upload",
+                                         "--skip-crypto", "--trace", trace_file,
+                                         "--tool-logs", os.path.join(build_dir, "tools")] +
+                                        (build_args if build_args else []),
+                                        cwd=build_dir, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+                # wait4 rather than wait: we want the build's rusage.
+                _, status, rusage = os.wait4(proc.pid, 0)
+                proc.returncode = exit_code_from_status(status)
+        finally:
+            wall_time = time.perf_counter() - start
+            done.set()
+            sampler.join()
+
+        result = {
+            "returncode": proc.returncode,
+            "wall_time": wall_time,
+            "user_time": rusage.ru_utime,
+            "system_time": rusage.ru_stime,
+            "peak_disk": peak_disk,
+            # Linux reports it in KB. This is the largest of the build and the tools it waited for.
+            "peak_rss": rusage.ru_maxrss * 1024,
+            "log": log_file,
+            "stages": {}
+        }
+        if proc.returncode != 0:
+            print("--- Build failed, see {}".format(log_file))
+
+        try:
+            with open(trace_file) as data_file:
+                trace = BuildTracer()
+                trace.events = json.load(data_file)["traceEvents"]
+            result["stages"] = {name: {"count": count, "seconds": total} for name, count, total in trace.get_summary()}
+        except FileNotFoundError:
+            pass
+        return result
+
+
+def benchmark_pipeline(args_parameter=None):
+    parser = argparse.ArgumentParser(description='Benchmarks whole image builds, running stand-ins for the SDK, '
+                                                 'mic and system tools')
+    parser.add_argument('--kind', type=str, action='append', choices=BUILD_KINDS,
+                        help="Build only this kind of image. Can be given more than once")
+    parser.add_argument('--rootfs-size', type=int, default=64, help="Size of the synthetic rootfs, in MB")
+    parser.add_argument('--rootfs-files', type=int, default=2000, help="Number of files in the synthetic rootfs")
+    parser.add_argument('--packages', type=int, default=1000, help="Number of packages in the synthetic image")
+    parser.add_argument('--mic-seconds', type=float, default=0,
+                        help="Time the mic stand-in spends installing packages, on top of writing the rootfs")
+    parser.add_argument('--compression-ratio', type=float, default=0.5,
+                        help="Output to input ratio of the compressing stand-ins (mksquashfs, qemu-img)")
+    parser.add_argument('--compress', action='store_true', help="Build compressed images")
+    parser.add_argument('--pipeline-installer', action='store_true', help="Pipeline installer builds")
+    parser.add_argument('--scratch', type=str, choices=["disk", "tmpfs"], default="disk",
+                        help="Where builds keep their intermediates")
+    parser.add_argument('--sample-interval', type=float, default=0.2,
+                        help="Interval between disk usage samples, in seconds")
+    parser.add_argument('--work-dir', type=str, help="Where to run builds")
+    parser.add_argument('--keep', action='store_true', help="Keep the work directory, with logs and traces")
+    parser.add_argument('--json', type=str, help="Write results to this JSON file")
+
+    if args_parameter:
+        args = parser.parse_args(args=args_parameter)
+    else:
+        args = parser.parse_args()
+
+    kinds = args.kind if args.kind else BUILD_KINDS
+    rootfs_size = args.rootfs_size * 1048576
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="hemera-pipeline-benchmark-", dir=args.work_dir)
+    print("-- Benchmarking {} builds in {}".format(", ".join(kinds), work_dir))
+
+    benchmark = PipelineBenchmark(work_dir, rootfs_size, args.rootfs_files, args.packages, args.mic_seconds,
+                                  args.compression_ratio, args.sample_interval)
+    results = {}
+    try:
+        for kind in kinds:
+            print("--- Building {}...".format(kind))
+            build_args = ["--scratch", args.scratch]
+            if kind == "installer" and args.pipeline_installer:
+                build_args.append("--pipeline-installer")
+            results[kind] = benchmark.run_build(kind, generate_configuration(kind, rootfs_size, args.compress),
+                                                build_args)
+    finally:
+        if args.keep:
+            print("-- Work directory kept in {}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+
+    print("-- {:<12} {:>8} {:>10} {:>10} {:>12} {:>12}".format("build", "result", "wall (s)", "cpu (s)",
+                                                                "disk (MB)", "rss (MB)"))
+    for kind, r in results.items():
+        print("-- {:<12} {:>8} {:>10.2f} {:>10.2f} {:>12.1f} {:>12.1f}".format(
+            kind, "ok" if r["returncode"] == 0 else "failed", r["wall_time"], r["user_time"] + r["system_time"],
+            r["peak_disk"] / 1048576, r["peak_rss"] / 1048576))
+    for kind, r in results.items():
+        print("-- Stages of {}:".format(kind))
+        for name, stage in list(r["stages"].items())[:REPORTED_STAGES]:
+            print("--- {:<40} {:>6} {:>10.2f} s".format(name, stage["count"], stage["seconds"]))
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump({"parameters": {k: v for k, v in vars(args).items() if k not in ("json", "work_dir", "keep")},
+                       "results": results}, outfile, indent=4)
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from hemeraplatformsdk.SquashPackageGenerator import SquashPackageGenerator, squash_profile_args
+
+DEFAULT_PROFILES = [
+    {"compressor": "lzo"},
+    {"compressor": "lz4"},
+    {"compressor": "zstd"},
+    {"compressor": "xz"},
+    {"compressor": "lzo", "block_size": 1048576},
+    {"compressor": "zstd", "block_size": 1048576}
+]
+
+
+def tree_size(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            if not os.path.islink(os.path.join(root, f)):
+                size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def benchmark_profile(source_dir, profile, work_dir):
+    image = os.path.join(work_dir, "profile.squashfs")
+    extract_dir = os.path.join(work_dir, "extracted")
+
+    start = time.perf_counter()
+    SquashPackageGenerator(source_dir, image, profile=profile).generate()
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as f:
+        subprocess.check_call(["unsquashfs", "-n", "-d", extract_dir, image], stdout=f)
+    extract_time = time.perf_counter() - start
+    extracted_size = tree_size(extract_dir)
+
+    result = {
+        "profile": profile,
+        "mksquashfs_args": squash_profile_args(profile),
+        "build_seconds": build_time,
+        "image_size": os.path.getsize(image),
+        "decompression_seconds": extract_time,
+        "decompression_throughput": extracted_size / extract_time if extract_time else 0
+    }
+
+    os.remove(image)
+    shutil.rmtree(extract_dir)
+    return result
+
+
+def benchmark_squash_profiles(args_parameter=None):
+    parser = argparse.ArgumentParser(description='Benchmarks mksquashfs compression profiles on a root filesystem')
+    parser.add_argument('source', type=str, help="The directory to squash, e.g. an unpacked rootfs")
+    parser.add_argument('--profiles', type=str,
+                        help="JSON file with a list of squash profiles. Defaults to one per compressor")
+    parser.add_argument('--work-dir', type=str,
+                        help="Where to write images and extract them. Use the same kind of storage the images "
+                             "will be read from")
+    parser.add_argument('--json', type=str, help="Write results to this JSON file")
+
+    if args_parameter:
+        args = parser.parse_args(args=args_parameter)
+    else:
+        args = parser.parse_args()
+
+    if args.profiles:
+        with open(args.profiles) as data_file:
+            profiles = json.load(data_file)
+    else:
+        profiles = DEFAULT_PROFILES
+
+    source_size = tree_size(args.source)
+    print("-- Benchmarking {} profiles on {} ({} bytes)".format(len(profiles), args.source, source_size))
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for profile in profiles:
+            print("--- Profile: {}".format(" ".join(squash_profile_args(profile))))
+            try:
+                results.append(benchmark_profile(args.source, profile, work_dir))
+            except subprocess.CalledProcessError as exc:
+                # Most likely, mksquashfs was built without this compressor.
+                print("--- Profile failed: {}".format(exc))
+
+    print("-- {:<40} {:>10} {:>14} {:>8} {:>14}".format("profile", "build (s)", "size", "ratio", "decomp (MB/s)"))
+    for r in results:
+        print("-- {:<40} {:>10.2f} {:>14} {:>8.3f} {:>14.1f}".format(" ".join(r["mksquashfs_args"]),
+                                                                     r["build_seconds"], r["image_size"],
+                                                                     r["image_size"] / max(source_size, 1),
+                                                                     r["decompression_throughput"] / 1048576))
+
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump({"source_size": source_size, "results": results}, outfile, indent=4)
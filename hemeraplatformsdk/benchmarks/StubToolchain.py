@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import stat
+import sys
+import tarfile
+import time
+
+# Tools replaced by stand-ins. Everything else (truncate, dd, cp, mv...) is the real thing.
+STUB_TOOLS = ["sdk", "losetup", "mount", "umount", "mke2fs", "mkfs.ext2", "mkfs.ext3", "mkfs.ext4",
+              "mkfs.vfat", "mkfs.erofs", "mcopy", "mksquashfs", "qemu-img"]
+# Environment of the stand-ins
+STUB_ROOTFS_SIZE = "HEMERA_STUB_ROOTFS_SIZE"
+STUB_ROOTFS_FILES = "HEMERA_STUB_ROOTFS_FILES"
+STUB_PACKAGES = "HEMERA_STUB_PACKAGES"
+STUB_MIC_SECONDS = "HEMERA_STUB_MIC_SECONDS"
+STUB_COMPRESSION_RATIO = "HEMERA_STUB_COMPRESSION_RATIO"
+STUB_STATE_DIR = "HEMERA_STUB_STATE_DIR"
+# Synthetic files are cut out of this much generated data
+DATA_POOL_SIZE = 4 * 1048576
+WRITE_BLOCK_SIZE = 1048576
+
+
+def strip_parentroot(path):
+    # The SDK sees the host under /parentroot
+    return "/" + path[len("/parentroot/"):] if path.startswith("/parentroot/") else path
+
+
+def tree_files(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for f in sorted(files):
+            if not os.path.islink(os.path.join(root, f)):
+                yield os.path.join(root, f)
+
+
+class StubToolchain:
+    """
+    Stand-ins for the tools an image build runs, producing synthetic output of a configurable size.
+
+    They do the I/O the real tools would do (mic writes a rootfs, mkfs fills its image, mksquashfs and qemu-img
+    write their output) without needing the SDK, root or loop devices, so that builds can run end to end on any
+    machine. The sdk stand-in plays mic as run through the SDK. Each stand-in is a script named after the tool, all
+    of them dispatching to run_stub_tool.
+    """
+    def __init__(self):
+        self.rootfs_size = int(os.environ.get(STUB_ROOTFS_SIZE, 64 * 1048576))
+        self.rootfs_files = int(os.environ.get(STUB_ROOTFS_FILES, 2000))
+        self.packages = int(os.environ.get(STUB_PACKAGES, 1000))
+        self.mic_seconds = float(os.environ.get(STUB_MIC_SECONDS, 0))
+        self.compression_ratio = float(os.environ.get(STUB_COMPRESSION_RATIO, 0.5))
+        self.state_dir = os.environ.get(STUB_STATE_DIR)
+
+    def run(self, tool, args):
+        if tool == "sdk":
+            return self.mic(args)
+        elif tool == "losetup":
+            return self.losetup(args)
+        elif tool == "mount":
+            return self.mount(args)
+        elif tool == "umount":
+            return self.umount(args)
+        elif tool == "mke2fs" or tool.startswith("mkfs."):
+            return self.mkfs(tool, args)
+        elif tool == "mcopy":
+            return self.mcopy(args)
+        elif tool == "mksquashfs":
+            return self.mksquashfs(args)
+        elif tool == "qemu-img":
+            return self.qemu_img(args)
+        raise ValueError("No stand-in for {}".format(tool))
+
+    def generate_rootfs(self, rootfs_dir, seed):
+        # Stand-ins start for every tool call: only mic pays for importing the builders.
+        from hemeraplatformsdk.benchmarks.HotPathBenchmark import generate_payload
+
+        rng = random.Random(seed)
+        pool_file = rootfs_dir + ".pool"
+        generate_payload(rng, pool_file, DATA_POOL_SIZE)
+        with open(pool_file, "rb") as f:
+            pool = f.read()
+        os.remove(pool_file)
+
+        for directory in ["boot", "etc", "var/cache", "var/lib/rpm", "usr/bin", "usr/lib", "usr/share"]:
+            os.makedirs(os.path.join(rootfs_dir, directory), exist_ok=True)
+        with open(os.path.join(rootfs_dir, "etc", "fstab"), "w") as f:
+            print("/dev/root / auto defaults 1 1", file=f)
+
+        # Most of the space goes to few files, like in a real rootfs.
+        weights = [rng.paretovariate(1.2) for _ in range(self.rootfs_files)]
+        total_weight = sum(weights)
+        subdirs = ["usr/bin", "usr/lib", "usr/share", "var/lib/rpm", "boot"]
+        for index, weight in enumerate(weights):
+            size = int(self.rootfs_size * weight / total_weight)
+            filename = os.path.join(rootfs_dir, subdirs[index % len(subdirs)], "file{:06d}".format(index))
+            with open(filename, "wb") as f:
+                while size > 0:
+                    offset = rng.randrange(DATA_POOL_SIZE)
+                    chunk = pool[offset:offset + min(size, WRITE_BLOCK_SIZE)]
+                    f.write(chunk)
+                    size -= len(chunk)
+
+    def copy_payload(self, kickstart, build_dir, rootfs_dir):
+        """
+        Run the copy commands of the kickstart, waiting for a deferred installer payload like %post would.
+        """
+        with open(kickstart) as f:
+            commands = f.read()
+
+        deferred = re.search(r"while \[ ! -e (\S+) \]", commands)
+        if deferred:
+            payload_script = strip_parentroot(deferred.group(1))
+            while not os.path.exists(payload_script) and not os.path.exists(payload_script + ".failed"):
+                time.sleep(1)
+            if os.path.exists(payload_script + ".failed"):
+                print("Installer payload failed, aborting")
+                return 1
+            with open(payload_script) as f:
+                commands += f.read()
+
+        for command in commands.splitlines():
+            copy = re.match(r"^cp (\S+) (\S+)$", command) or re.match(r"^tar .*--directory=(?P<dest>\S+) -xf (\S+)$",
+                                                                      command)
+            # Only what goes into the image, not what %post scripts shuffle around inside it
+            if not copy or "${INSTALL_ROOT}" not in command:
+                continue
+            if command.startswith("cp "):
+                source, destination = copy.group(1), copy.group(2)
+            else:
+                source, destination = copy.group(2), copy.group("dest")
+            source = strip_parentroot(source) if os.path.isabs(source) else os.path.join(build_dir, source)
+            destination = os.path.join(rootfs_dir, destination.replace("${INSTALL_ROOT}", "").lstrip("/"))
+            os.makedirs(destination, exist_ok=True)
+            # Archives are copied rather than unpacked: what matters is moving the bytes.
+            shutil.copy(source, destination)
+        return 0
+
+    def mic(self, args):
+        # sdk -u root exec <script> <name> <type> <arch> <cache dir> <build dir> <kickstart> [mic args]
+        image_name, image_type = args[4], args[5]
+        build_dir = strip_parentroot(args[8])
+        kickstart = os.path.join(build_dir, args[9])
+        output_dir = os.path.join(build_dir, image_name)
+        rootfs_dir = os.path.join(output_dir, image_name)
+        print("[ =STUB= ] {} image {} in {}".format(image_type, image_name, output_dir))
+
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(rootfs_dir)
+        seed = int(hashlib.sha256(image_name.encode("utf-8")).hexdigest()[:8], 16)
+
+        # Package installation
+        time.sleep(self.mic_seconds)
+        self.generate_rootfs(rootfs_dir, seed)
+        from hemeraplatformsdk.benchmarks.EVRComparisonBenchmark import generate_package_lists
+        from hemeraplatformsdk.benchmarks.HotPathBenchmark import generate_packages_file
+        new_release, _ = generate_package_lists(self.packages, 0, 0, seed)
+        generate_packages_file(os.path.join(output_dir, image_name + ".packages"), new_release)
+
+        if self.copy_payload(kickstart, build_dir, rootfs_dir) != 0:
+            return 1
+
+        if image_type == "raw":
+            with open(os.path.join(output_dir, image_name + "-sda.raw"), "wb") as image:
+                self.write_tree(image, rootfs_dir)
+            shutil.rmtree(rootfs_dir)
+        elif image_type not in ("squash", "fs-tree"):
+            with tarfile.open(os.path.join(output_dir, image_name + ".tar"), "w") as tar:
+                for entry in sorted(os.listdir(rootfs_dir)):
+                    tar.add(os.path.join(rootfs_dir, entry), arcname=entry)
+            shutil.rmtree(rootfs_dir)
+        return 0
+
+    @staticmethod
+    def write_tree(output, source_dir, ratio=1.0):
+        written = 0
+        for filename in tree_files(source_dir):
+            with open(filename, "rb") as f:
+                size = int(os.path.getsize(filename) * ratio)
+                while size > 0:
+                    buf = f.read(min(size, WRITE_BLOCK_SIZE))
+                    if not buf:
+                        break
+                    output.write(buf)
+                    size -= len(buf)
+                    written += len(buf)
+        return written
+
+    def fill_image(self, image, sources, ratio=1.0):
+        # Images are sparse files to begin with: overwrite them from the start.
+        with open(image, "r+b" if os.path.exists(image) else "wb") as output:
+            for source in sources:
+                if os.path.isdir(source):
+                    self.write_tree(output, source, ratio)
+                elif os.path.isfile(source):
+                    with open(source, "rb") as f:
+                        shutil.copyfileobj(f, output, WRITE_BLOCK_SIZE)
+
+    def get_mount_state(self, mountpoint):
+        return os.path.join(self.state_dir, hashlib.sha256(os.path.abspath(mountpoint).encode("utf-8"))
+                            .hexdigest() + ".json")
+
+    def losetup(self, args):
+        if "--show" in args:
+            print("/dev/loop0")
+        return 0
+
+    def mount(self, args):
+        # mount -o loop <image> <mountpoint>: remember it, files land in the mountpoint meanwhile.
+        # A tmpfs is just the mountpoint, until it is unmounted.
+        if self.state_dir and len(args) >= 2 and "tmpfs" not in args:
+            with open(self.get_mount_state(args[-1]), "w") as f:
+                json.dump({"image": args[-2]}, f)
+        return 0
+
+    def umount(self, args):
+        # What was written into the mountpoint goes into the image, and disappears from the tree.
+        mountpoint = args[-1]
+        try:
+            with open(self.get_mount_state(mountpoint)) as f:
+                image = json.load(f)["image"]
+            os.remove(self.get_mount_state(mountpoint))
+        except (TypeError, FileNotFoundError):
+            image = None
+        if image:
+            self.fill_image(image, [mountpoint])
+        for entry in os.scandir(mountpoint):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        return 0
+
+    def mkfs(self, tool, args):
+        if tool == "mkfs.erofs":
+            # mkfs.erofs <options> <image> <source dir>
+            self.fill_image(args[-2], [args[-1]], self.compression_ratio)
+        elif "-d" in args:
+            self.fill_image(args[-1], [args[args.index("-d") + 1]])
+        return 0
+
+    def mcopy(self, args):
+        # mcopy -i <image> <options> <entries> ::/
+        self.fill_image(args[args.index("-i") + 1], [a for a in args[2:-1] if not a.startswith("-")])
+        return 0
+
+    def mksquashfs(self, args):
+        # mksquashfs <source dir> <destination> <options>
+        with open(args[1], "wb") as output:
+            self.write_tree(output, args[0], self.compression_ratio)
+        return 0
+
+    def qemu_img(self, args):
+        # qemu-img convert <options> <source> <destination>
+        compressed = "-c" in args or "subformat=streamOptimized" in args
+        with open(args[-2], "rb") as source, open(args[-1], "wb") as output:
+            size = int(os.path.getsize(args[-2]) * (self.compression_ratio if compressed else 1))
+            while size > 0:
+                buf = source.read(min(size, WRITE_BLOCK_SIZE))
+                if not buf:
+                    break
+                output.write(buf)
+                size -= len(buf)
+        return 0
+
+
+def run_stub_tool():
+    return StubToolchain().run(os.path.basename(sys.argv[0]), sys.argv[1:])
+
+
+def install_stub_toolchain(bin_dir):
+    """
+    Write the stand-ins into bin_dir, which should then come first in PATH.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for tool in STUB_TOOLS:
+        filename = os.path.join(bin_dir, tool)
+        with open(filename, "w") as f:
+            f.write("#!{}\n".format(sys.executable))
+            f.write("import sys\n")
+            f.write("sys.path.insert(0, {!r})\n".format(package_root))
+            f.write("from hemeraplatformsdk.benchmarks.StubToolchain import run_stub_tool\n")
+            f.write("sys.exit(run_stub_tool())\n")
+        os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
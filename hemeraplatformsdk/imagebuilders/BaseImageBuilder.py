@@ -1,17 +1,28 @@
 #!/usr/bin/python3
 
 import bz2
+import contextlib
 import errno
 import gzip
 import hashlib
+import heapq
 import json
 import lzma
 import math
 import os
 import shutil
-import subprocess
 import tarfile
+import threading
+import time
+import uuid
 import zipfile
+import zlib
+
+from hemeraplatformsdk.BuildMetrics import metrics
+from hemeraplatformsdk.BuildTracer import tracer
+from hemeraplatformsdk.BuildWorkspace import workspace
+from hemeraplatformsdk.IntermediateFiles import intermediates
+from hemeraplatformsdk.ProcessExecutor import executor
 
 BLOCKSIZE = 65536
 SDK_BUILD_SCRIPT="/usr/bin/build-hemera-image-sdk.sh"
@@ -20,20 +31,91 @@ MYROOT_DIR="${BUILDROOT_DIR}/${IMAGE_NAME}"
 MIC_CACHE_DIR="/var/lib/mic-cache"
 DEFAULT_COMPRESSION_FORMAT="bz2"
 DEFAULT_REPOSITORY_HOST="http://DEFAULT_REPOSITORY_HOST_HERE:82/"
+COMPRESSIBILITY_SAMPLE_SIZE = 65536
+COMPRESSIBILITY_SAMPLES_PER_FILE = 4
+COMPRESSIBILITY_MAX_FILES = 256
+# Above this sampled ratio, compressing is just burning CPU.
+INCOMPRESSIBLE_RATIO = 0.95
+# 1980-01-01, the oldest timestamp zip can store
+DEFAULT_SOURCE_DATE_EPOCH = 315532800
+FILESYSTEM_UUID_NAMESPACE = uuid.UUID("9c7b2e5e-58b3-4c8e-9f0a-6c2f1e3d7a41")
+# A deferred installer payload: how often we tell mic we are still alive, when mic stops believing it, and how long
+# it waits at most, in seconds.
+PAYLOAD_HEARTBEAT_INTERVAL = 5
+PAYLOAD_HEARTBEAT_TIMEOUT = 120
+PAYLOAD_WAIT_TIMEOUT = 4 * 3600
+
+
+def get_source_date_epoch(image_dictionary):
+    """
+    Return the timestamp to stamp artifacts with, or None when the build does not have to be reproducible.
+
+    SOURCE_DATE_EPOCH wins when set, otherwise images with "reproducible" get a fixed default.
+    """
+    if "SOURCE_DATE_EPOCH" in os.environ:
+        return int(os.environ["SOURCE_DATE_EPOCH"])
+    if "reproducible" in image_dictionary and image_dictionary["reproducible"]:
+        return DEFAULT_SOURCE_DATE_EPOCH
+    return None
+
+
+def sample_compression_ratio(paths):
+    """
+    Estimate how well a set of files or directories compresses, by deflating a few samples of the largest files.
+
+    Return the compressed/original size ratio, weighted by file size. 1.0 means incompressible.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, filenames in os.walk(path):
+                files += [os.path.join(root, f) for f in filenames if os.path.isfile(os.path.join(root, f))]
+        elif os.path.isfile(path):
+            files.append(path)
+
+    # Big files dominate the ratio, and are the ones worth deciding for.
+    sizes = {f: os.path.getsize(f) for f in files if not os.path.islink(f)}
+    sampled_files = heapq.nlargest(COMPRESSIBILITY_MAX_FILES, sizes, key=lambda f: sizes[f])
+
+    weighted_ratio = 0
+    total_size = 0
+    for f in sampled_files:
+        if not sizes[f]:
+            continue
+        original = 0
+        compressed = 0
+        with open(f, 'rb') as afile:
+            step = max(sizes[f] // COMPRESSIBILITY_SAMPLES_PER_FILE, COMPRESSIBILITY_SAMPLE_SIZE)
+            for offset in range(0, sizes[f], step):
+                afile.seek(offset)
+                buf = afile.read(COMPRESSIBILITY_SAMPLE_SIZE)
+                original += len(buf)
+                compressed += len(zlib.compress(buf, 1))
+        weighted_ratio += min(compressed / original, 1.0) * sizes[f]
+        total_size += sizes[f]
+
+    if not total_size:
+        return 1.0
+    return weighted_ratio / total_size
 
 
 class BaseImageBuilder:
-    def __init__(self, image_dictionary, crypto_dictionary, variant=None, version=None):
+    def __init__(self, image_dictionary, crypto_dictionary, variant=None, version=None, build_root=None):
         self.version = version
         self.variant = variant
         self.data = image_dictionary
         self.crypto = crypto_dictionary
         self.compress = self.data["compress"] if "compress" in self.data else False
+        self.source_date_epoch = get_source_date_epoch(self.data)
 
         self.internal_post_scripts = []
         self.internal_post_nochroot_scripts = []
 
         self.built_packages = []
+        # Size of the artifact before compression, if it was compressed
+        self.uncompressed_size = None
+        # Artifact -> the format it was stored with, which is not always the configured one
+        self.compression_formats = {}
 
         self.base_image_name = self.data["name"]
         self.image_name = self.data["name"]
@@ -43,11 +125,18 @@ class BaseImageBuilder:
         if version:
             self.image_name += "-"+version
 
-        self.build_dir = os.path.join(os.getcwd(), "build-"+self.image_name)
+        self.build_dir = os.path.join(build_root if build_root else os.getcwd(), "build-"+self.image_name)
         self.output_dir = os.path.join(self.build_dir, self.image_name)
 
         self.ks_unpack_files_in_image = {}
         self.ks_copy_files_in_image = {}
+        # Whether mic waits for files to copy in the image, see defer_installer_payload
+        self.deferred_payload = False
+        self.payload_heartbeat = None
+        # Whether a recovery package will be made out of the image, after compressing it
+        self.recovery_package_wanted = False
+        # Whether the build directory is a tmpfs of ours
+        self.scratch_mounted = False
 
         try:
             os.makedirs(self.build_dir)
@@ -69,6 +158,97 @@ class BaseImageBuilder:
     def get_image_variant(self):
         return self.variant
 
+    def get_consumer(self, step):
+        # Installers and their embedded images go through the same steps.
+        return self.image_name + ":" + step
+
+    def estimate_rootfs_size(self):
+        """
+        Upper bound of the size of mic's rootfs in bytes, if it can be told before building. None otherwise.
+        """
+        try:
+            return self.data["rootfs_size_estimate"] * 1024 * 1024
+        except KeyError:
+            return None
+
+    def estimate_peak_disk_usage(self):
+        rootfs_size = self.estimate_rootfs_size()
+        if rootfs_size is None:
+            return None
+        # mic's output and what is made out of it (partitions, squashfs, compressed archive) have to coexist for a
+        # while, intermediates are deleted as soon as they are consumed.
+        return 2 * rootfs_size
+
+    def mount_scratch_space(self, size):
+        """
+        Puts the build directory on a tmpfs of at most size bytes. Must be called before building anything.
+        """
+        print("--- Building {} in memory".format(self.image_name))
+        # Should we die, whoever cleans up our workspace unmounts it.
+        workspace.add_mount(self.build_dir)
+        executor.check_call(["mount", "-t", "tmpfs", "-o", "size={},mode=0755".format(size), "hemera-scratch",
+                            self.build_dir])
+        self.scratch_mounted = True
+        self.prepare_scratch_space()
+
+    def prepare_scratch_space(self):
+        # Whatever was created in the build directory is hidden by the tmpfs.
+        pass
+
+    def unmount_scratch_space(self):
+        if not self.scratch_mounted:
+            return
+        # Lazily, as a failed build might have left loop mounts in there.
+        executor.check_call(["umount", "-l", self.build_dir])
+        self.scratch_mounted = False
+
+    def get_filesystem_uuid(self, name):
+        # Random UUIDs are fine, unless we want reproducible filesystems.
+        if self.source_date_epoch is None:
+            return None
+        return uuid.uuid5(FILESYSTEM_UUID_NAMESPACE, "{}:{}".format(self.image_name, name))
+
+    def get_tool_environment(self):
+        process_env = os.environ.copy()
+        if self.source_date_epoch is not None:
+            process_env["SOURCE_DATE_EPOCH"] = str(self.source_date_epoch)
+            # Older e2fsprogs only know about this one.
+            process_env["E2FSPROGS_FAKE_TIME"] = str(self.source_date_epoch)
+        return process_env
+
+    def normalize_tarinfo(self, tarinfo):
+        tarinfo.mtime = self.source_date_epoch
+        tarinfo.uid = 0
+        tarinfo.gid = 0
+        tarinfo.uname = "root"
+        tarinfo.gname = "root"
+        return tarinfo
+
+    def write_zip_member(self, zip_file, file, arcname=None):
+        if self.source_date_epoch is None:
+            zip_file.write(file, arcname=arcname)
+            return
+
+        date_time = time.gmtime(max(self.source_date_epoch, DEFAULT_SOURCE_DATE_EPOCH))[:6]
+        if hasattr(zipfile.ZipInfo, "from_file"):
+            zip_info = zipfile.ZipInfo.from_file(file, arcname=arcname)
+            zip_info.date_time = date_time
+            zip_info.compress_type = zip_file.compression
+            # Streamed, unlike writestr.
+            with open(file, 'rb') as f_in, zip_file.open(zip_info, 'w') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            return
+
+        # Python 3.5 can only stream members through ZipFile.write, which dates them after their mtime, in local
+        # time. Lend it ours for the time being.
+        stat = os.stat(file)
+        mtime = time.mktime(date_time + (0, 0, -1))
+        os.utime(file, (mtime, mtime))
+        try:
+            zip_file.write(file, arcname=arcname)
+        finally:
+            os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
     def build_image(self):
         raise NotImplementedError
 
@@ -76,16 +256,19 @@ class BaseImageBuilder:
         raise NotImplementedError
 
     def prepare_environment(self):
-        self.prepare_ks()
+        with tracer.span("kickstart", image=self.image_name):
+            self.prepare_ks()
 
     def generate_image_metadata(self, payload):
         if payload:
             hasher = hashlib.sha256()
-            with open(payload, 'rb') as afile:
+            start = time.perf_counter()
+            with tracer.span("hashing", file=os.path.basename(payload)), open(payload, 'rb') as afile:
                 buf = afile.read(BLOCKSIZE)
                 while len(buf) > 0:
                     hasher.update(buf)
                     buf = afile.read(BLOCKSIZE)
+            metrics.record_hashing("sha256", os.path.getsize(payload), time.perf_counter() - start)
             checksum = hasher.hexdigest()
         else:
             checksum = ""
@@ -97,6 +280,8 @@ class BaseImageBuilder:
             'download_size': os.path.getsize(payload) if payload else 0,
             'checksum': checksum
         }
+        if payload and os.path.abspath(payload) in self.compression_formats:
+            metadata['compression_format'] = self.compression_formats[os.path.abspath(payload)]
 
         # Let's read packages
         with open(os.path.join(self.output_dir, self.image_name + ".packages"), "r") as packages:
@@ -254,6 +439,8 @@ class BaseImageBuilder:
             if filenames:
                 for f in filenames:
                     self.ks_copy_files_in_image[f] = "/installer/"
+                    # Nothing else needs the embedded image, once it is in the installer.
+                    intermediates.register(f, self.get_consumer("mic"))
 
         # Fixup copy_recovery action, if any
         for idx, action in enumerate(installer_data["actions"]):
@@ -536,8 +723,58 @@ class BaseImageBuilder:
         # Copy the image and sysrestore, of course
         self.ks_copy_files_in_image[os.path.join(self.build_dir, 'sysrestore.json')] = "/boot/sysconfig/"
 
-        # Add internal scripts
+        # Add internal scripts. A deferred payload got them already, as our kickstart had to be written before.
+        if not self.deferred_payload:
+            self.internal_post_scripts.append("mkdir /ramdisk")
+
+    def defer_installer_payload(self):
+        """
+        Lets the installer's mic run start before its payload is built.
+
+        Package installation goes ahead, then the kickstart waits for release_installer_payload (after
+        prepare_installer_data) or abort_installer_payload before copying files into the image. Should we die
+        without calling either, mic notices we stopped touching the heartbeat file, and gives up.
+        """
+        self.deferred_payload = True
         self.internal_post_scripts.append("mkdir /ramdisk")
+        for f in [self.get_payload_script_path(), self.get_payload_script_path() + ".failed"]:
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+
+        stopped = threading.Event()
+
+        def beat():
+            while True:
+                with open(self.get_payload_script_path() + ".alive", "w"):
+                    pass
+                if stopped.wait(PAYLOAD_HEARTBEAT_INTERVAL):
+                    return
+
+        self.payload_heartbeat = stopped
+        threading.Thread(target=beat, daemon=True).start()
+
+    def stop_payload_heartbeat(self):
+        if self.payload_heartbeat:
+            self.payload_heartbeat.set()
+            self.payload_heartbeat = None
+
+    def get_payload_script_path(self):
+        return os.path.join(self.build_dir, "payload-copy.sh")
+
+    def release_installer_payload(self):
+        print("-- Installer payload is ready, letting mic go ahead")
+        with open(self.get_payload_script_path() + ".tmp", "w") as outfile:
+            outfile.write("\n".join(self.generate_copy_commands()) + "\n")
+        # mic might be polling: the script must show up complete.
+        os.rename(self.get_payload_script_path() + ".tmp", self.get_payload_script_path())
+        self.stop_payload_heartbeat()
+
+    def abort_installer_payload(self):
+        with open(self.get_payload_script_path() + ".failed", "w"):
+            pass
+        self.stop_payload_heartbeat()
 
     def get_partition_mount_options(self, p):
         fs_options = ''
@@ -708,27 +945,25 @@ class BaseImageBuilder:
                     pass
         replacements['@REMOUNT_LIST@'] = "\n".join(remount_partitions)
 
-        copy_commands = []
-        for src, dest in self.ks_unpack_files_in_image.items():
-            if os.path.isabs(src):
-                src = os.path.join("/parentroot", src[1:])
-            else:
-                src = os.path.join("../", src)
-
-            dest = '${INSTALL_ROOT}' + dest
-            copy_commands.append("mkdir -p " + dest)
-            copy_commands.append("tar --numeric-owner -p --directory={} -xf {}".format(dest, src))
-        for src, dest in self.ks_copy_files_in_image.items():
-            if os.path.isabs(src):
-                src = os.path.join("/parentroot", src[1:])
-            else:
-                src = os.path.join("../", src)
-            dest = '${INSTALL_ROOT}' + dest
-
-            copy_commands.append("mkdir -p " + dest)
-            copy_commands.append("cp {} {}".format(src, dest))
-
-        replacements['@COPY_COMMANDS@'] = "\n".join(copy_commands)
+        if self.deferred_payload:
+            payload_script = os.path.join("/parentroot", self.get_payload_script_path()[1:])
+            replacements['@COPY_COMMANDS@'] = "\n".join([
+                'echo "Waiting for the installer payload..."',
+                'waited=0',
+                'while [ ! -e {0} ] && [ ! -e {0}.failed ]; do'.format(payload_script),
+                '    if [ $waited -ge {} ]; then'.format(PAYLOAD_WAIT_TIMEOUT),
+                '        echo "Timed out waiting for the installer payload"; exit 1',
+                '    fi',
+                '    if [ $(( $(date +%s) - $(stat -c %Y {0}.alive 2>/dev/null || echo 0) )) -gt {1} ]; then'
+                .format(payload_script, PAYLOAD_HEARTBEAT_TIMEOUT),
+                '        echo "The image builder is gone, giving up"; exit 1',
+                '    fi',
+                '    sleep {0}; waited=$((waited + {0}))'.format(PAYLOAD_HEARTBEAT_INTERVAL),
+                'done',
+                '[ -e {0}.failed ] && exit 1'.format(payload_script),
+                '. {}'.format(payload_script)])
+        else:
+            replacements['@COPY_COMMANDS@'] = "\n".join(self.generate_copy_commands())
 
         if "serial_login" in self.data:
             serial_logins = []
@@ -762,6 +997,29 @@ class BaseImageBuilder:
         with open(os.path.join(self.build_dir, self.image_name+".ks"), 'w') as outfile:
             outfile.write(ks_template)
 
+    def generate_copy_commands(self):
+        copy_commands = []
+        for src, dest in self.ks_unpack_files_in_image.items():
+            if os.path.isabs(src):
+                src = os.path.join("/parentroot", src[1:])
+            else:
+                src = os.path.join("../", src)
+
+            dest = '${INSTALL_ROOT}' + dest
+            copy_commands.append("mkdir -p " + dest)
+            copy_commands.append("tar --numeric-owner -p --directory={} -xf {}".format(dest, src))
+        for src, dest in self.ks_copy_files_in_image.items():
+            if os.path.isabs(src):
+                src = os.path.join("/parentroot", src[1:])
+            else:
+                src = os.path.join("../", src)
+            dest = '${INSTALL_ROOT}' + dest
+
+            copy_commands.append("mkdir -p " + dest)
+            copy_commands.append("cp {} {}".format(src, dest))
+
+        return copy_commands
+
     def run_mic(self, additional_args=None):
         self.prepare_environment()
 
@@ -773,7 +1031,11 @@ class BaseImageBuilder:
         if additional_args:
             sdk_call += additional_args
 
-        subprocess.check_call(sdk_call)
+        with tracer.span("mic", category="mic", image=self.image_name):
+            # A deferred payload waits for another mic run: it must not hold a slot that run needs.
+            executor.check_call(sdk_call, limited=not self.deferred_payload)
+        # Whatever was copied or unpacked in the image is in there now.
+        intermediates.release(self.get_consumer("mic"))
 
     def compress_image(self):
         raise NotImplementedError
@@ -790,49 +1052,108 @@ class BaseImageBuilder:
     def set_should_compress(self, compress):
         self.compress = compress
 
+    def payload_is_incompressible(self, files):
+        # Already compressed (or encrypted) payloads gain nothing from another compression pass.
+        if "skip_incompressible" in self.data and not self.data["skip_incompressible"]:
+            return False
+
+        ratio = sample_compression_ratio(files)
+        if ratio > INCOMPRESSIBLE_RATIO:
+            print("--- Payload sampled compression ratio is {:.2f}, storing it as-is".format(ratio))
+            return True
+        return False
+
+    def record_compression_metrics(self, uncompressed_size, compressed_file, compression_format):
+        compressed_size = os.path.getsize(compressed_file)
+        self.uncompressed_size = uncompressed_size
+        self.compression_formats[os.path.abspath(compressed_file)] = compression_format
+        labels = {"image": self.image_name, "format": compression_format}
+        metrics.set("artifact_uncompressed_bytes", uncompressed_size, "Size of artifacts before compression", **labels)
+        metrics.set("artifact_compressed_bytes", compressed_size, "Size of artifacts after compression", **labels)
+        metrics.set("artifact_compression_ratio", compressed_size / uncompressed_size if uncompressed_size else 1,
+                    "Compressed to uncompressed size of artifacts", **labels)
+
     def compress_file(self, file):
         print("--- Compressing {}...".format(file))
         if "compression_format" not in self.data:
             self.data["compression_format"] = DEFAULT_COMPRESSION_FORMAT
 
-        if self.data["compression_format"] == "bz2":
+        compression_format = self.data["compression_format"]
+        uncompressed_size = os.path.getsize(file)
+        if compression_format != "zip" and self.payload_is_incompressible([file]):
+            self.record_compression_metrics(uncompressed_size, file, "none")
+            return file
+
+        if compression_format == "bz2":
             compressor_open = bz2.open
-        if self.data["compression_format"] == "gz":
-            compressor_open = gzip.open
-        elif self.data["compression_format"] == "xz":
+        if compression_format == "gz":
+            if self.source_date_epoch is not None:
+                # Do not let gzip stamp the current time in its header.
+                def compressor_open(filename, mode):
+                    return gzip.GzipFile(filename, mode, mtime=self.source_date_epoch)
+            else:
+                compressor_open = gzip.open
+        elif compression_format == "xz":
             compressor_open = lzma.open
-        elif self.data["compression_format"] == "zip":
+        elif compression_format == "zip":
             with zipfile.ZipFile(file+".zip", 'w') as my_zip:
-                my_zip.write(file)
-            return
+                self.write_zip_member(my_zip, file, arcname=os.path.basename(file))
+            intermediates.release(self.get_consumer("compress"), [file])
+            self.record_compression_metrics(uncompressed_size, file+".zip", compression_format)
+            return file+".zip"
 
-        with open(file, 'rb') as f_in, compressor_open(file+"."+self.data["compression_format"], 'wb') as f_out:
+        with open(file, 'rb') as f_in, compressor_open(file+"."+compression_format, 'wb') as f_out:
             shutil.copyfileobj(f_in, f_out)
         os.remove(file)
+        self.record_compression_metrics(uncompressed_size, file+"."+compression_format, compression_format)
+        return file+"."+compression_format
 
-    def compress_files(self, files, out_filename, base_dir=None):
-        print("--- Compressing to {}...".format(out_filename))
+    def compress_files(self, files, out_filename, base_dir):
         if "compression_format" not in self.data:
             self.data["compression_format"] = DEFAULT_COMPRESSION_FORMAT
 
-        if self.data["compression_format"] == "zip":
+        compression_format = self.data["compression_format"]
+        uncompressed_size = sum(os.path.getsize(f) for f in files)
+        if compression_format != "zip" and self.payload_is_incompressible(files):
+            # Plain tarball, then. Let metadata tell.
+            compression_format = "none"
+            out_filename = out_filename[:out_filename.rfind(".tar")] + ".tar"
+
+        print("--- Compressing to {}...".format(out_filename))
+        if self.source_date_epoch is not None:
+            # Same inputs, same archive.
+            files = sorted(files)
+            tar_filter = self.normalize_tarinfo
+        else:
+            tar_filter = None
+
+        if compression_format == "zip":
             with zipfile.ZipFile(out_filename, 'w') as my_zip:
                 for file in files:
-                    try:
-                        my_zip.write(file, arcname=file.replace(base_dir, ""))
-                    except TypeError:
-                        my_zip.write(file)
+                    self.write_zip_member(my_zip, file, arcname=file.replace(base_dir, ""))
+                    intermediates.release(self.get_consumer("compress"), [file])
         else:
             tar_mode = "w:"
-            if self.data["compression_format"] is not None:
-                tar_mode += self.data["compression_format"]
+            if compression_format not in (None, "none"):
+                tar_mode += compression_format
+
+            with contextlib.ExitStack() as stack:
+                if self.source_date_epoch is not None and compression_format == "gz":
+                    # tarfile would stamp the gzip header with the current time.
+                    raw_file = stack.enter_context(open(out_filename, 'wb'))
+                    gzip_file = stack.enter_context(gzip.GzipFile(filename="", mode='wb', fileobj=raw_file,
+                                                                  mtime=self.source_date_epoch))
+                    tar = stack.enter_context(tarfile.open(fileobj=gzip_file, mode="w"))
+                else:
+                    tar = stack.enter_context(tarfile.open(out_filename, tar_mode))
 
-            with tarfile.open(out_filename, tar_mode) as tar:
                 for file in files:
-                    try:
-                        tar.add(file, arcname=file.replace(base_dir, ""))
-                    except TypeError:
-                        tar.add(file)
+                    tar.add(file, arcname=file.replace(base_dir, ""), filter=tar_filter)
+                    # Each file can go as soon as it is in the archive, rather than when the archive is complete.
+                    intermediates.release(self.get_consumer("compress"), [file])
+
+        self.record_compression_metrics(uncompressed_size, out_filename, compression_format)
+        return out_filename
 
     def generate_recovery_package(self):
         raise NotImplementedError
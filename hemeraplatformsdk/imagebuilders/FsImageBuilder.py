@@ -5,8 +5,8 @@ from hemeraplatformsdk.imagebuilders.BaseImageBuilder import BaseImageBuilder
 
 
 class FsImageBuilder(BaseImageBuilder):
-    def __init__(self, image_dictionary, crypto_dictionary, variant=None, version=None):
-        super().__init__(image_dictionary, crypto_dictionary, variant, version)
+    def __init__(self, image_dictionary, crypto_dictionary, variant=None, version=None, build_root=None):
+        super().__init__(image_dictionary, crypto_dictionary, variant, version, build_root)
         assert self.data["type"] == "fs"
 
     def build_image(self):
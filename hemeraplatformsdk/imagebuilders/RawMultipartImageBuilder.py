@@ -1,14 +1,19 @@
 #!/usr/bin/python3
 
-import errno
+import concurrent.futures
+import itertools
 import math
 import os
 import shutil
-import sys
 import tarfile
 
+from hemeraplatformsdk.BuildTracer import tracer
+from hemeraplatformsdk.BuildWorkspace import workspace
+from hemeraplatformsdk.IntermediateFiles import intermediates
+from hemeraplatformsdk.ProcessExecutor import executor
 from hemeraplatformsdk.imagebuilders.BaseImageBuilder import BaseImageBuilder
 
+from hemeraplatformsdk.imagebuilders.devices.BaseDevice import can_populate_without_mounting
 from hemeraplatformsdk.imagebuilders.devices.BlankPartitionDevice import BlankPartitionDevice
 from hemeraplatformsdk.imagebuilders.devices.GPTDevice import GPTDevice
 from hemeraplatformsdk.imagebuilders.devices.NANDFileDevice import NANDFileDevice
@@ -16,7 +21,6 @@ from hemeraplatformsdk.imagebuilders.devices.PartitionDevice import PartitionDev
 from hemeraplatformsdk.imagebuilders.devices.RawDevice import RawDevice
 from hemeraplatformsdk.imagebuilders.devices.UBIDevice import UBIDevice
 
-TMP_MOUNT_PATH="/tmp/image/rootfs"
 
 
 class RawMultipartImageBuilder(BaseImageBuilder):
@@ -34,15 +38,27 @@ class RawMultipartImageBuilder(BaseImageBuilder):
         else:
             self.compression_extension = ".tar." + self.data["compression_format"]
 
-        # Ignore errors when making dirs
+        # Where partitions are mounted, or the rootfs is staged. Other builds on this host have their own.
+        self.mount_path = workspace.get_path(self.image_name, "rootfs")
+
+        # How mic's rootfs gets into our partitions: through a tarball, or copying/moving its tree natively.
         try:
-            os.makedirs(TMP_MOUNT_PATH)
-        except IOError as exc:
-            if exc.errno == errno.EEXIST:
-                pass
-            else:
-                print("--- Warning: creation of directory {} failed: {}.".format(TMP_MOUNT_PATH, exc.strerror),
-                      file=sys.stderr)
+            self.rootfs_population = self.data["rootfs_population"]
+        except KeyError:
+            self.rootfs_population = "tar"
+
+        # Whether partitions are loop mounted and filled, or created straight from the staged tree by mkfs.
+        try:
+            self.partition_population = self.data["partition_population"]
+        except KeyError:
+            self.partition_population = "mount"
+        if self.partition_population == "mkfs":
+            # Mounted devices must not be nested in unmounted ones, or the other way around: it's all or nothing.
+            unsupported = [f for f in self.get_configured_filesystems() if not can_populate_without_mounting(f)]
+            if unsupported:
+                print("-- {} filesystems can't be created without mounting them on this host, "
+                      "mounting partitions instead".format(", ".join(sorted(set(unsupported)))))
+                self.partition_population = "mount"
 
         self.devices = []
         next_start_sector = -1
@@ -93,34 +109,58 @@ class RawMultipartImageBuilder(BaseImageBuilder):
             elif d["type"] == "nand-file":
                 self.devices.append(NANDFileDevice(d, self))
 
+    def get_configured_filesystems(self):
+        # Of the devices partition_population applies to.
+        filesystems = []
+        for d in [d for d in self.data["devices"] if d["type"].startswith("partition") or d["type"].startswith("raw")]:
+            if "filesystem" in d:
+                filesystems.append(d["filesystem"])
+            filesystems += [p["filesystem"] for p in d.get("partitions", []) if "filesystem" in p]
+        return filesystems
+
     def build_image(self):
-        # Change it to fs.
-        self.data["type"] = "fs"
+        # Change it to fs. Unless we want the tarball, mic can leave the tree as it is.
+        self.data["type"] = "fs" if self.rootfs_population == "tar" else "fs-tree"
         # We just create it as it is.
         self.run_mic()
+        # Once in our partitions, mic's output is just taking space. Moving consumes the tree by itself.
+        if self.rootfs_population == "tar":
+            intermediates.register(os.path.join(self.output_dir, self.image_name + ".tar"),
+                                   self.get_consumer("populate_rootfs"))
+        elif self.rootfs_population == "copy":
+            intermediates.register(os.path.join(self.output_dir, self.image_name),
+                                   self.get_consumer("populate_rootfs"))
 
         # Time to create the devices now.
         for d in self.devices:
-            d.create_device()
+            with tracer.span("create_device", category="device", device=type(d).__name__):
+                d.create_device()
 
         # Mount mountable devices
         for d in sorted([d for d in self.devices if d.can_be_mounted()],
                         key=lambda d: d.get_base_mountpoint()[:-1].count('/')):
-            d.mount_device(TMP_MOUNT_PATH)
+            with tracer.span("mount_device", category="device", mountpoint=d.get_base_mountpoint()):
+                d.mount_device(self.mount_path)
 
         # Now, let's unpack the filesystem.
-        fs_compressed = tarfile.open(os.path.join(self.output_dir, self.image_name + ".tar"))
-        fs_compressed.extractall(path=TMP_MOUNT_PATH)
+        with tracer.span("populate_rootfs", category="device", mode=self.rootfs_population):
+            if self.rootfs_population == "tar":
+                fs_compressed = tarfile.open(os.path.join(self.output_dir, self.image_name + ".tar"))
+                fs_compressed.extractall(path=self.mount_path)
+            else:
+                self.populate_rootfs(os.path.join(self.output_dir, self.image_name), self.mount_path)
+        intermediates.release(self.get_consumer("populate_rootfs"))
 
         # Extract files, if any
         for d in [d for d in self.devices if d.needs_file_extraction()]:
-            d.extract_file(TMP_MOUNT_PATH)
+            with tracer.span("extract_file", category="device", device=type(d).__name__):
+                d.extract_file(self.mount_path)
 
         # We shall update fstab now.
         # Given fstab is a bad beast, we basically regenerate it.
-        os.rename(os.path.join(TMP_MOUNT_PATH, "/etc/fstab"[1:]),
-                  os.path.join(TMP_MOUNT_PATH, "/etc/fstab.generated"[1:]))
-        with open(os.path.join(TMP_MOUNT_PATH, "/etc/fstab"[1:]), "w") as f:
+        os.rename(os.path.join(self.mount_path, "/etc/fstab"[1:]),
+                  os.path.join(self.mount_path, "/etc/fstab.generated"[1:]))
+        with open(os.path.join(self.mount_path, "/etc/fstab"[1:]), "w") as f:
             # Filesystem entries
             for d in [d for d in self.devices if d.has_fstab_entries()]:
                 for entry in d.get_fstab_entries():
@@ -141,28 +181,86 @@ class RawMultipartImageBuilder(BaseImageBuilder):
         # Now it's time to unmount our mountable devices, so that only what should be in packaged devices is left.
         for d in sorted([d for d in self.devices if d.can_be_mounted()],
                         key=lambda d: d.get_base_mountpoint()[:-1].count('/'), reverse=True):
-            d.unmount_device()
+            with tracer.span("unmount_device", category="device", mountpoint=d.get_base_mountpoint()):
+                d.unmount_device()
 
         # Let's handle our packaged devices now. Order must be reverse as we need to go backwards (most inner goes first)
-        for d in sorted([d for d in self.devices if d.can_be_packaged()],
-                        key=lambda d: d.get_base_mountpoint()[:-1].count('/'), reverse=True):
-            d.package_target_to_device(TMP_MOUNT_PATH)
+        # Devices at the same level have disjoint trees, those which allow it are packaged in parallel.
+        for _, level_devices in itertools.groupby(sorted([d for d in self.devices if d.can_be_packaged()],
+                                                         key=lambda d: d.get_base_mountpoint()[:-1].count('/'),
+                                                         reverse=True),
+                                                  key=lambda d: d.get_base_mountpoint()[:-1].count('/')):
+            level_devices = list(level_devices)
+            for d in [d for d in level_devices if not d.can_be_packaged_concurrently()]:
+                self.package_device(d, self.mount_path)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                for future in [pool.submit(self.package_device, d, self.mount_path)
+                               for d in level_devices if d.can_be_packaged_concurrently()]:
+                    future.result()
 
         # Get built packages
         for d in self.devices:
             self.built_packages.append((d, d.get_device_files()))
+        # Compressed images ship the archive only.
+        if self.should_compress():
+            for f in self.get_built_files():
+                intermediates.register(f, self.get_consumer("compress"))
+
+    def get_built_files(self):
+        return [f for _, files in self.built_packages if files for f in files]
+    @staticmethod
+    def package_device(d, mount_path):
+        with tracer.span("package_device", category="device", mountpoint=d.get_base_mountpoint()):
+            d.package_target_to_device(mount_path)
+
+    def prepare_scratch_space(self):
+        # Staged trees are throwaway data as well.
+        self.mount_path = os.path.join(self.build_dir, "rootfs-mount")
+        os.makedirs(self.mount_path, exist_ok=True)
+
+    def populate_rootfs(self, rootfs_dir, target_dir):
+        print("--- Populating partitions from {} ({})".format(rootfs_dir, self.rootfs_population))
+        if self.rootfs_population == "copy":
+            # cp merges into the existing mountpoints, and reflinks where the filesystem allows it.
+            executor.check_call(["cp", "-a", "--reflink=auto", os.path.join(rootfs_dir, "."), target_dir])
+        else:
+            self.move_tree(rootfs_dir, target_dir)
+
+    def move_tree(self, source_dir, target_dir):
+        # Only directories which already exist in the target (our mountpoints and their parents) need merging,
+        # everything else is moved in one go. mv renames when it can, and copies across filesystems.
+        to_move = []
+        for entry in os.scandir(source_dir):
+            target = os.path.join(target_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False) and os.path.isdir(target) and not os.path.islink(target):
+                self.move_tree(entry.path, target)
+            else:
+                to_move.append(entry.path)
+
+        if to_move:
+            executor.check_call(["mv", "-f"] + to_move + [target_dir])
+
+        # The merged directory keeps the attributes it has in the rootfs.
+        stat = os.lstat(source_dir)
+        os.chown(target_dir, stat.st_uid, stat.st_gid)
+        shutil.copystat(source_dir, target_dir)
+        os.rmdir(source_dir)
 
     def compress_image(self):
-        if len(self.built_packages) > 1:
-            self.compress_files([f for f in [d[1] for d in self.built_packages]],
-                                out_filename=os.path.join(self.build_dir, self.image_name+self.compression_extension))
+        if len(self.get_built_files()) > 1:
+            compressed_file = self.compress_files(self.get_built_files(),
+                                                  out_filename=os.path.join(self.build_dir,
+                                                                            self.image_name+self.compression_extension),
+                                                  base_dir=self.build_dir)
+            # The payload might have been stored as-is.
+            self.compression_extension = compressed_file[len(os.path.join(self.build_dir, self.image_name)):]
         else:
-            self.compress_files([f for f in self.built_packages[0][1]])
+            self.compress_file(self.get_built_files()[0])
         self.is_compressed = True
 
     def get_image_files(self):
         if self.is_compressed:
-            if len(self.built_packages) > 1:
+            if len(self.get_built_files()) > 1:
                 return self.generate_image_metadata(os.path.join(self.build_dir,
                                                                  self.image_name+self.compression_extension)), \
                                                     os.path.join(self.build_dir,
@@ -175,6 +273,13 @@ class RawMultipartImageBuilder(BaseImageBuilder):
             return self.generate_image_metadata(None), \
                    self.built_packages
 
+    def estimate_rootfs_size(self):
+        rootfs_size = super().estimate_rootfs_size()
+        if rootfs_size is not None:
+            return rootfs_size
+        # Whatever mic makes has to fit in our partitions.
+        return sum(p.get("size", 0) for p in self.get_partitions()) * 1024 * 1024
+
     def get_partitions(self):
         # None.
         partitions = []
@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 
 import errno
+import hashlib
 import json
 import os
 import shutil
 import subprocess
+from hemeraplatformsdk.IntermediateFiles import intermediates
 from hemeraplatformsdk.imagebuilders.BaseImageBuilder import BaseImageBuilder
 from hemeraplatformsdk.UpdatePackageGenerator import generate_squash_package
 
@@ -15,6 +17,9 @@ class SquashImageBuilder(BaseImageBuilder):
         assert self.data["type"] == "squash"
         self.image_filename = "hemeraos.img"
         self.squash_package_dir = os.path.join(self.build_dir, "squash-package")
+        self.squash_profile = self.data["squash_profile"] if "squash_profile" in self.data else None
+        self.sort_file = None
+        self.file_ordering = {"type": "default"}
         self.is_compressed = False
 
         self.compression_extension = ""
@@ -25,6 +30,9 @@ class SquashImageBuilder(BaseImageBuilder):
         else:
             self.compression_extension = ".tar."+self.data["compression_format"]
 
+        self.prepare_scratch_space()
+
+    def prepare_scratch_space(self):
         try:
             os.makedirs(self.squash_package_dir)
         except OSError as exc:
@@ -36,6 +44,7 @@ class SquashImageBuilder(BaseImageBuilder):
     def build_image(self):
         # We create an unpackaged fs (squash) image.
         self.run_mic()
+        intermediates.register(os.path.join(self.output_dir, self.image_name), self.get_consumer("squash"))
 
         # We extract our files
         try:
@@ -49,19 +58,79 @@ class SquashImageBuilder(BaseImageBuilder):
             # We might not need anything.
             pass
 
+        # Place what is read at boot first, if we know what that is.
+        self.prepare_file_ordering(os.path.join(self.output_dir, self.image_name))
+
         # We embed basic metadata into the package file.
         with open(os.path.join(self.squash_package_dir, "metadata"), 'w') as outfile:
             json.dump(self.generate_image_metadata(None), outfile)
 
-        # Now, we invoke our mkhemerasquashfs tool
+        # Now, we create the squash package
         generate_squash_package(self.crypto, os.path.join(self.output_dir, self.image_name),
-                                os.path.join(self.squash_package_dir, self.image_filename), remove_uid_gid=False)
+                                os.path.join(self.squash_package_dir, self.image_filename), remove_uid_gid=False,
+                                squash_profile=self.squash_profile, sort_file=self.sort_file,
+                                source_date_epoch=self.source_date_epoch)
+        intermediates.release(self.get_consumer("squash"))
+
+    def prepare_file_ordering(self, rootfs_dir):
+        # Files come from a boot access trace (one path per line, in access order), a curated list, or both.
+        if "file_ordering" not in self.data:
+            return
+
+        ordered_files = []
+        try:
+            with open(self.data["file_ordering"]["trace_file"]) as trace:
+                ordered_files += [line.strip() for line in trace]
+        except KeyError:
+            pass
+        try:
+            ordered_files += self.data["file_ordering"]["files"]
+        except KeyError:
+            pass
+
+        sort_entries = []
+        seen_files = set()
+        for f in ordered_files:
+            f = f.lstrip("/")
+            if not f or f in seen_files or not os.path.lexists(os.path.join(rootfs_dir, f)):
+                continue
+            seen_files.add(f)
+            sort_entries.append(f)
+
+        # mksquashfs writes higher priorities first. Priorities go down to -32768, files beyond share the lowest one.
+        self.sort_file = os.path.join(self.build_dir, self.image_name + ".sort")
+        with open(self.sort_file, "w") as outfile:
+            for index, f in enumerate(sort_entries):
+                print("{} {}".format(f, max(32767 - index, -32767)), file=outfile)
+
+        self.file_ordering = {
+            "type": "boot_trace" if "trace_file" in self.data["file_ordering"] else "list",
+            "files": len(sort_entries),
+            "checksum": hashlib.sha256("\n".join(sort_entries).encode("utf-8")).hexdigest()
+        }
+        print("--- Placing {} files first in the image, out of {} requested".format(len(sort_entries),
+                                                                                   len(ordered_files)))
+
+    def generate_image_metadata(self, payload):
+        metadata = super().generate_image_metadata(payload)
+        metadata["file_ordering"] = self.file_ordering
+        return metadata
 
     def compress_image(self):
+        package_files = [os.path.join(self.squash_package_dir, f) for f in os.listdir(self.squash_package_dir)]
+        # The recovery package is made out of the same files, later on.
+        consumers = [self.get_consumer("compress")]
+        if self.recovery_package_wanted:
+            consumers.append(self.get_consumer("recovery_package"))
+        for f in package_files:
+            intermediates.register(f, *consumers)
+
         # We create a zip file.
-        self.compress_files([os.path.join(self.squash_package_dir, f) for f in os.listdir(self.squash_package_dir)],
-                            os.path.join(self.build_dir, self.image_name+self.compression_extension),
-                            base_dir=self.squash_package_dir)
+        compressed_file = self.compress_files(package_files,
+                                              os.path.join(self.build_dir, self.image_name+self.compression_extension),
+                                              base_dir=self.squash_package_dir)
+        # The payload might have been stored as-is.
+        self.compression_extension = compressed_file[len(os.path.join(self.build_dir, self.image_name)):]
         # Add to built packages for installer
         self.built_packages.append((self.data, os.path.join(self.build_dir, self.image_name+self.compression_extension)))
         self.is_compressed = True
@@ -82,9 +151,13 @@ class SquashImageBuilder(BaseImageBuilder):
         # Generate our squash package. But add our partial_flash file first.
         with open(os.path.join(self.squash_package_dir, "partial_flash"), 'w+') as partial_flash:
             partial_flash.write('Generated by Hemera Image Builder')
+        # Our image is already compressed and encrypted: squashing it again is mostly pointless.
         generate_squash_package(self.data, self.squash_package_dir,
-                                os.path.join(self.build_dir, self.image_name+"_recovery.hpd"))
+                                os.path.join(self.build_dir, self.image_name+"_recovery.hpd"),
+                                payload_profile="auto", squash_profile=self.squash_profile,
+                                source_date_epoch=self.source_date_epoch)
         os.remove(os.path.join(self.squash_package_dir, "partial_flash"))
+        intermediates.release(self.get_consumer("recovery_package"))
 
     def get_partitions(self):
         # None.
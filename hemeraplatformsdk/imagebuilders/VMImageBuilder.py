@@ -1,11 +1,18 @@
 #!/usr/bin/python3
 
+import concurrent.futures
+import hashlib
 import os
 import paramiko
+import requests
 import scp
-import subprocess
+import shutil
+import tempfile
 import time
 
+from hemeraplatformsdk.BuildTracer import tracer
+from hemeraplatformsdk.IntermediateFiles import intermediates
+from hemeraplatformsdk.ProcessExecutor import executor
 from hemeraplatformsdk.imagebuilders.FsImageBuilder import FsImageBuilder
 from hemeraplatformsdk.imagebuilders.BaseImageBuilder import BaseImageBuilder
 
@@ -16,6 +23,14 @@ VM_PORT=2223
 VM_USER="root"
 VM_PASS="rootme"
 SB2_INIT_SCRIPT="hemera-sb2-init"
+# Formats whose disks come out of qemu-img compressed, and the options to do so
+COMPRESSED_DISK_FORMATS = {
+    "qcow2": ["-c"],
+    "vmdk": ["-o", "subformat=streamOptimized"]
+}
+# qemu-img does not go beyond this many coroutines
+MAX_CONVERT_COROUTINES = 16
+TOOLCHAIN_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "hemeraplatformsdk", "toolchains")
 
 
 class VMImageBuilder(BaseImageBuilder):
@@ -28,6 +43,10 @@ class VMImageBuilder(BaseImageBuilder):
         except KeyError:
             # By default, initialise the VM
             self.skip_vm_init = False
+        try:
+            self.disk_format = self.data["disk_format"]
+        except KeyError:
+            self.disk_format = "vdi"
         # Defaults
         if "bootloader" not in self.data:
             self.data["bootloader"] = '--timeout=100  --append="vga=0x315 video=vesafb:mtrr,ywrap quiet"'
@@ -35,6 +54,7 @@ class VMImageBuilder(BaseImageBuilder):
     def build_image(self):
         # We have to build our toolchains first
         if "embedded_images" in self.data:
+            toolchain_builders = []
             for toolchain in self.data["embedded_images"]:
                 # Add defaults
                 if "name" not in toolchain:
@@ -47,15 +67,21 @@ class VMImageBuilder(BaseImageBuilder):
                     toolchain["timezone"] = self.data["timezone"]
                 if "root_password" not in toolchain:
                     toolchain["root_password"] = self.data["root_password"]
-                # Build a fs image
-                builder = FsImageBuilder(toolchain, self.crypto)
+                # Build a fs image, in its own build directory
+                builder = FsImageBuilder(toolchain, self.crypto, build_root=self.build_dir)
                 # HACK, FIXME: we need this to avoid to script local packages
                 builder.internal_post_scripts.append("cp /bin/true /usr/bin/strip")
-                builder.build_image()
-                # Do not compress it, it's pointless.
-                _, toolchain_file = builder.get_image_files()
+                toolchain_builders.append(builder)
+
+            # Toolchains don't depend on each other
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(toolchain_builders)) as pool:
+                toolchain_files = list(pool.map(self.build_toolchain, toolchain_builders))
+
+            for toolchain, toolchain_file in zip(self.data["embedded_images"], toolchain_files):
                 target_path = "/srv/hemera/targets/Hemera-{}/".format(toolchain["arch"])
                 self.ks_unpack_files_in_image[toolchain_file] = target_path
+                # Cached toolchains are hard links: only our copy goes.
+                intermediates.register(toolchain_file, self.get_consumer("mic"))
                 # Init toolchain
                 if not self.skip_vm_init:
                     self.internal_post_scripts.append('ln -s ../{0}@.service '
@@ -68,27 +94,115 @@ class VMImageBuilder(BaseImageBuilder):
         self.internal_post_scripts.append("cp /bin/true /usr/bin/strip")
         # We just create it as it is.
         self.run_mic()
-        image_vdi = self.image_name+".vdi"
+        image_disk = self.image_name + "." + self.disk_format
         # Fix filename
         raw_files = [f for f in os.listdir(self.output_dir) if f.endswith(".raw")]
         if len(raw_files) != 1:
             # WTF
             raise Exception("No raw files found in build directory")
 
-        subprocess.check_call(["qemu-img", "convert", "-f", "raw", "-O", "vdi",
-                               os.path.join(self.output_dir, raw_files[0]),
-                               os.path.join(self.output_dir, image_vdi)])
+        convert_call = ["qemu-img", "convert", "-f", "raw", "-O", self.disk_format,
+                        # Skip zeroed areas: most of the disk is empty
+                        "-S", "4k",
+                        "-m", str(min(os.cpu_count() or 1, MAX_CONVERT_COROUTINES))]
+        try:
+            convert_call += COMPRESSED_DISK_FORMATS[self.disk_format]
+        except KeyError:
+            # Out of order writes can't be combined with compression
+            convert_call.append("-W")
+        print("-- Converting disk to {}".format(self.disk_format))
+        with tracer.span("convert_disk", format=self.disk_format):
+            executor.check_call(convert_call + [os.path.join(self.output_dir, raw_files[0]),
+                                                os.path.join(self.output_dir, image_disk)])
         os.remove(os.path.join(self.output_dir, raw_files[0]))
 
+    def build_toolchain(self, builder):
+        # Do not compress it, it's pointless.
+        builder.prepare_environment()
+        digest = self.get_toolchain_digest(builder)
+        cache_dir = os.path.join(os.environ.get("HEMERA_TOOLCHAIN_CACHE_DIR", TOOLCHAIN_CACHE_DIR), digest) \
+            if digest else None
+
+        if cache_dir and os.path.isdir(cache_dir):
+            print("--- Toolchain {} is unchanged, reusing it from {}".format(builder.image_name, cache_dir))
+            os.makedirs(builder.output_dir, exist_ok=True)
+            for f in os.listdir(cache_dir):
+                self.link_or_copy(os.path.join(cache_dir, f), os.path.join(builder.output_dir, f))
+        else:
+            with tracer.span("build_toolchain", image=builder.image_name):
+                builder.build_image()
+            if cache_dir:
+                print("--- Caching toolchain {} in {}".format(builder.image_name, cache_dir))
+                os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+                # Other builds might be caching the same toolchain: each stages on its own.
+                staging_dir = tempfile.mkdtemp(prefix=digest + ".", suffix=".tmp", dir=os.path.dirname(cache_dir))
+                for f in [builder.image_name + ".tar", builder.image_name + ".packages"]:
+                    self.link_or_copy(os.path.join(builder.output_dir, f), os.path.join(staging_dir, f))
+                os.chmod(staging_dir, 0o755)
+                try:
+                    os.rename(staging_dir, cache_dir)
+                except OSError:
+                    if not os.path.isdir(cache_dir):
+                        shutil.rmtree(staging_dir)
+                        raise
+                    # Someone else got there first, with the very same toolchain.
+                    print("--- Toolchain {} was cached meanwhile".format(builder.image_name))
+                    shutil.rmtree(staging_dir)
+
+        _, toolchain_file = builder.get_image_files()
+        return toolchain_file
+
+    @staticmethod
+    def get_toolchain_digest(builder):
+        """
+        Digest of what goes into a toolchain: its kickstart, and the current state of the repositories it uses.
+
+        Returns None if a repository can't be checked, in which case the toolchain should not be cached.
+        """
+        hasher = hashlib.sha256()
+        with open(os.path.join(builder.build_dir, builder.image_name + ".ks"), "rb") as ks_file:
+            kickstart = ks_file.read()
+        hasher.update(kickstart)
+
+        for line in kickstart.decode("utf-8").splitlines():
+            if not line.startswith("repo "):
+                continue
+            baseurls = [a[len("--baseurl="):] for a in line.split() if a.startswith("--baseurl=")]
+            if not baseurls:
+                # e.g. a mirrorlist: no telling what we'll get.
+                print("--- Repository {} has no baseurl, toolchain won't be cached".format(line))
+                return None
+            baseurl = baseurls[0]
+            try:
+                r = requests.get(baseurl.rstrip("/") + "/repodata/repomd.xml", timeout=30)
+                r.raise_for_status()
+            except requests.exceptions.RequestException as exc:
+                print("--- Could not check repository {}, toolchain won't be cached: {}".format(baseurl, exc))
+                return None
+            hasher.update(r.content)
+
+        return hasher.hexdigest()
+
+    @staticmethod
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
     def compress_image(self):
+        if self.disk_format in COMPRESSED_DISK_FORMATS:
+            print("--- {} disks are compressed already, skipping compression".format(self.disk_format))
+            self.data["compression_format"] = "none"
+            return
         # Ask to compress
-        self.compress_file(os.path.join(self.output_dir, self.image_name+".vdi"))
+        self.compress_file(os.path.join(self.output_dir, self.image_name + "." + self.disk_format))
 
     def get_image_files(self):
-        built_files = [f for f in os.listdir(self.output_dir) if ".vdi" in f]
+        built_files = [f for f in os.listdir(self.output_dir) if "." + self.disk_format in f]
         if len(built_files) != 1:
             # WTF
-            raise Exception("No VDI files found in build directory")
+            raise Exception("No {} files found in build directory".format(self.disk_format.upper()))
 
         return self.generate_image_metadata(os.path.join(self.output_dir, built_files[0])), \
                os.path.join(self.output_dir, built_files[0])
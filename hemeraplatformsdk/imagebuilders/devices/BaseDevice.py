@@ -1,5 +1,10 @@
 #!/usr/bin/python3
 
+import os
+import shutil
+
+from hemeraplatformsdk.ProcessExecutor import executor
+
 
 class ExtractedFileTooBigException(Exception):
     def __init__(self, *args, **kwargs):
@@ -11,11 +16,107 @@ class WrongPartitionTypeException(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 
+class MountFreePopulationNotSupportedException(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+
+def filesystem_uuid_args(filesystem, fs_uuid):
+    # mkfs arguments pinning the filesystem's UUID (and hash seed), if we have one.
+    if not fs_uuid:
+        return []
+    if filesystem.startswith("ext"):
+        return ["-U", str(fs_uuid), "-E", "hash_seed={}".format(fs_uuid)]
+    elif filesystem == "vfat":
+        return ["-i", fs_uuid.hex[:8]]
+    return []
+
+
+def can_populate_without_mounting(filesystem):
+    # What populate_filesystem_image knows how to create, with the tools this host has.
+    if filesystem.startswith("ext"):
+        tools = ["mke2fs"]
+    elif filesystem == "vfat":
+        tools = ["mkfs.vfat", "mcopy"]
+    elif filesystem == "erofs":
+        tools = ["mkfs.erofs"]
+    else:
+        return False
+    return all(shutil.which(t) for t in tools)
+
+
+def write_image_at(source, destination, offset, buffer_size=1024 * 1024):
+    """
+    Write the contents of source into destination at offset, without truncating it. Blocks of zeroes are skipped
+    rather than written, so that a sparse destination stays sparse.
+    """
+    zeroes = bytes(buffer_size)
+    with open(source, "rb") as f_in, open(destination, "r+b") as f_out:
+        f_out.seek(offset)
+        while True:
+            data = f_in.read(buffer_size)
+            if not data:
+                break
+            if data == zeroes[:len(data)]:
+                f_out.seek(len(data), os.SEEK_CUR)
+            else:
+                f_out.write(data)
+
+
+def populate_filesystem_image(filesystem, filename, source_dir=None, label=None, fs_uuid=None, extra_args=None,
+                              env=None):
+    """
+    Create a filesystem in filename, holding the contents of source_dir, without mounting anything.
+
+    filename must already exist, with the size of the filesystem. An empty filesystem is created if source_dir is None.
+    """
+    if not extra_args:
+        extra_args = []
+
+    if filesystem.startswith("ext"):
+        mkfs_call = ["mkfs." + filesystem, "-F", "-q"] + extra_args
+        if label:
+            mkfs_call += ["-L", label]
+        mkfs_call += filesystem_uuid_args(filesystem, fs_uuid)
+        if source_dir:
+            mkfs_call += ["-d", source_dir]
+        executor.check_call(mkfs_call + [filename], env=env)
+    elif filesystem == "vfat":
+        mkfs_call = ["mkfs.vfat"] + extra_args
+        if label:
+            mkfs_call += ["-n", label]
+        mkfs_call += filesystem_uuid_args(filesystem, fs_uuid)
+        with open(os.devnull, "w") as f:
+            executor.check_call(mkfs_call + [filename], stdout=f, env=env)
+
+        entries = [os.path.join(source_dir, e) for e in sorted(os.listdir(source_dir))] if source_dir else []
+        if entries:
+            mtools_env = dict(env if env else os.environ)
+            mtools_env["MTOOLS_SKIP_CHECK"] = "1"
+            executor.check_call(["mcopy", "-i", filename, "-s", "-m", "-Q"] + entries + ["::/"], env=mtools_env)
+    elif filesystem == "erofs":
+        mkfs_call = ["mkfs.erofs", "--quiet"] + extra_args
+        if label:
+            mkfs_call += ["-L", label]
+        if fs_uuid:
+            mkfs_call += ["-U", str(fs_uuid)]
+        if not source_dir:
+            raise MountFreePopulationNotSupportedException("An erofs filesystem needs contents to be created.")
+        executor.check_call(mkfs_call + [filename, source_dir], env=env)
+    else:
+        raise MountFreePopulationNotSupportedException("{} filesystems can't be populated without mounting them."
+                                                       .format(filesystem))
+
+
 class BaseDevice:
     def __init__(self, device_dictionary, image_builder):
         self.data = device_dictionary
         self.builder = image_builder
 
+    def get_filesystem_uuid(self, *keys):
+        # Out of what describes the filesystem, never of where the build happens to run.
+        return self.builder.get_filesystem_uuid(":".join(str(k) for k in keys))
+
     def can_be_mounted(self):
         raise NotImplementedError
 
@@ -26,6 +127,10 @@ class BaseDevice:
     def can_be_packaged(self):
         raise NotImplementedError
 
+    # Whether package_target_to_device can run alongside other devices' at the same tree level.
+    def can_be_packaged_concurrently(self):
+        return False
+
     def has_fstab_entries(self):
         raise NotImplementedError
 
@@ -1,8 +1,8 @@
 #!/usr/bin/python3
 
 import os
-import subprocess
 
+from hemeraplatformsdk.ProcessExecutor import executor
 from hemeraplatformsdk.imagebuilders.devices.RawDevice import RawDevice
 
 
@@ -19,6 +19,11 @@ class GPTDevice(RawDevice):
         self.fix_partitions_uuid_type()
         super().unmount_device()
 
+    def package_target_to_device(self, base_path):
+        super().package_target_to_device(base_path)
+        # We are never unmounted in this case, fix partition types now
+        self.fix_partitions_uuid_type()
+
     def get_fstab_entries(self):
         entries = []
         for p in self.data["partitions"]:
@@ -30,7 +35,7 @@ class GPTDevice(RawDevice):
                             continue
 
                         print("--- Adding {} to fstab".format(p["mountpoint"]))
-                        out = subprocess.check_output(["sgdisk", "--info", str(partition.number), self.filename])
+                        out = executor.check_output(["sgdisk", "--info", str(partition.number), self.filename])
                         guid = out.split(b"\n")[1].split(b":")[-1].replace(b" ", b"") \
                             .replace(b"\n", b"").decode("ascii").lower()
 
@@ -59,8 +64,8 @@ class GPTDevice(RawDevice):
                                                                                          partition.name,
                                                                                          partition.number))
                     with open(os.devnull, "w") as f:
-                        subprocess.check_call(["sgdisk","-t",str(partition.number)+":"+
-                                               x["partition_type"],self.filename], stdout=f)
+                        executor.check_call(["sgdisk","-t",str(partition.number)+":"+
+                                            x["partition_type"],self.filename], stdout=f)
                 except KeyError:
                     # Don't care
                     pass
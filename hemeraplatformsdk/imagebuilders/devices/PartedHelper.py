@@ -1,7 +1,8 @@
 #!/usr/bin/python3
 
 import parted
-import subprocess
+
+from hemeraplatformsdk.ProcessExecutor import executor
 
 
 class PartedHelper:
@@ -46,7 +47,7 @@ class PartedHelper:
         self.disk_type = type
 
         # fallocate is not supported on alpine - let's use truncate
-        subprocess.check_call(["truncate", "-s", "{}M".format(size), self.output_file])
+        executor.check_call(["truncate", "-s", "{}M".format(size), self.output_file])
         disk_fd = open(self.output_file, 'ab')
         # os.posix_fallocate(disk_fd.fileno(), 0, int(self.config["size"]) * 1024 * 1024)
 
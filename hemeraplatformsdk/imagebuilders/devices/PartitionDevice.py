@@ -2,12 +2,12 @@
 
 import errno
 import os
-import subprocess
+import shutil
 import sys
 
-from hemeraplatformsdk.imagebuilders.devices.BaseDevice import BaseDevice
-
-TMP_MKFS_MOUNT_PATH = "/tmp/image/build"
+from hemeraplatformsdk.ProcessExecutor import executor
+from hemeraplatformsdk.imagebuilders.devices.BaseDevice import BaseDevice, filesystem_uuid_args, \
+    populate_filesystem_image
 
 
 class PartitionDevice(BaseDevice):
@@ -28,24 +28,25 @@ class PartitionDevice(BaseDevice):
                 self.filename = os.path.join(self.builder.build_dir,
                                              "{}.raw".format(self.builder.image_name))
 
-        # Ignore errors when making dirs
-        try:
-            os.makedirs(TMP_MKFS_MOUNT_PATH)
-        except IOError as exc:
-            if exc.errno == errno.EEXIST:
-                pass
-            else:
-                print("--- Warning: creation of directory {} failed: {}.".format(TMP_MKFS_MOUNT_PATH, exc.strerror),
-                      file=sys.stderr)
+        # Without mounts, the filesystem is created from the staged tree when packaging.
+        self.mount_free = self.builder.partition_population == "mkfs"
+
+    def get_partition_uuid(self):
+        return self.get_filesystem_uuid(self.data.get("install_device", self.data.get("device")),
+                                        self.data.get("mountpoint"), self.data.get("label"))
 
     def can_be_mounted(self):
-        return True
+        return not self.mount_free
 
     def get_base_mountpoint(self):
         return self.data["mountpoint"]
 
     def can_be_packaged(self):
-        return False
+        return self.mount_free
+
+    def can_be_packaged_concurrently(self):
+        # We only touch our own file and subtree.
+        return self.mount_free
 
     def has_fstab_entries(self):
         return True
@@ -57,9 +58,13 @@ class PartitionDevice(BaseDevice):
             return
         # Let's start by creating the loop disk
         # fallocate is not supported on alpine - let's use truncate
-        subprocess.check_call(["truncate", "-s", "{}M".format(self.data["size"]), self.filename])
+        executor.check_call(["truncate", "-s", "{}M".format(self.data["size"]), self.filename])
         # os.posix_fallocate(disk_fd.fileno(), 0, int(self.config["size"]) * 1024 * 1024)
 
+        if self.mount_free:
+            # We'll be formatted and populated in one go.
+            return
+
         # Format the filesystem
         print("--- Now formatting {} as {}".format(self.data["mountpoint"], self.data["filesystem"]))
 
@@ -71,13 +76,37 @@ class PartitionDevice(BaseDevice):
                 mkfs_call += ["-n", self.data["label"]]
         except KeyError:
             pass
-        mkfs_call += ["/dev/loop7"]
+        mkfs_call += filesystem_uuid_args(self.data["filesystem"], self.get_partition_uuid())
+
+        # Whichever loop device is free: other builds might be running on this host.
+        loop_device = executor.check_output(["losetup", "--find", "--show", self.filename],
+                                            universal_newlines=True).strip()
+        try:
+            with open(os.devnull, "w") as f:
+                executor.check_call(mkfs_call + [loop_device], stdout=f, stderr=f,
+                                    env=self.builder.get_tool_environment())
+        finally:
+            executor.check_call(["losetup", "-d", loop_device])
 
-        with open(os.devnull, "w") as f:
-            subprocess.check_call(["losetup",
-                                   "/dev/loop7", self.filename])
-            subprocess.check_call(mkfs_call, stdout=f, stderr=f)
-            subprocess.check_call(["losetup", "-d", "/dev/loop7"])
+    def package_target_to_device(self, base_path):
+        if self.data["type"].endswith("recovery"):
+            # Nothing to do.
+            return
+        target_path = os.path.join(base_path, self.data["mountpoint"][1:])
+        print("--- Now populating {} as {}".format(self.data["mountpoint"], self.data["filesystem"]))
+        if not os.path.isdir(target_path):
+            # Nothing was staged here, we want an empty filesystem.
+            os.makedirs(target_path)
+
+        populate_filesystem_image(self.data["filesystem"], self.filename, target_path,
+                                  label=self.data["label"] if "label" in self.data else None,
+                                  fs_uuid=self.get_partition_uuid(),
+                                  extra_args=["-m", "1"] if self.data["filesystem"].startswith("ext") else None,
+                                  env=self.builder.get_tool_environment())
+
+        # What's in here is not part of the parent's filesystem, just leave the mountpoint.
+        shutil.rmtree(target_path)
+        os.makedirs(target_path)
 
     def mount_device(self, base_path):
         if self.data["type"].endswith("recovery"):
@@ -93,15 +122,15 @@ class PartitionDevice(BaseDevice):
                 print("--- Warning: creation of directory {} failed: {}."
                       .format(os.path.join(base_path, self.data["mountpoint"][1:]), exc.strerror), file=sys.stderr)
 
-        subprocess.check_call(["mount", "-o", "loop", self.filename,
-                               os.path.join(base_path, self.data["mountpoint"][1:])])
+        executor.check_call(["mount", "-o", "loop", self.filename,
+                            os.path.join(base_path, self.data["mountpoint"][1:])])
         self.mount_path = os.path.join(base_path, self.data["mountpoint"][1:])
 
     def unmount_device(self):
         if self.data["type"].endswith("recovery"):
             # Nothing to do.
             return
-        subprocess.check_call(["umount", self.mount_path])
+        executor.check_call(["umount", self.mount_path])
 
     def get_device_files(self):
         if self.data["type"].endswith("recovery"):
@@ -4,12 +4,14 @@ import binascii
 import errno
 import math
 import os
-import subprocess
+import shutil
 import sys
 
 import parted
 
-from hemeraplatformsdk.imagebuilders.devices.BaseDevice import BaseDevice
+from hemeraplatformsdk.ProcessExecutor import executor
+from hemeraplatformsdk.imagebuilders.devices.BaseDevice import BaseDevice, filesystem_uuid_args, \
+    populate_filesystem_image, write_image_at
 from hemeraplatformsdk.imagebuilders.devices.BaseDevice import ExtractedFileTooBigException
 from hemeraplatformsdk.imagebuilders.devices.BaseDevice import WrongPartitionTypeException
 from hemeraplatformsdk.imagebuilders.devices.PartedHelper import PartedHelper
@@ -42,8 +44,12 @@ class RawDevice(BaseDevice):
         self.partition_start = {}
         self.mounted_partitions = []
 
+        # Without mounts, filesystems are created from the staged tree when packaging.
+        self.mount_free = self.builder.partition_population == "mkfs"
+        self.pending_filesystems = []
+
     def can_be_mounted(self):
-        return True
+        return not self.mount_free
 
     def get_base_mountpoint(self):
         # We have a set of partitions: let's return the most basic one.
@@ -51,7 +57,7 @@ class RawDevice(BaseDevice):
                       key=lambda x: x["mountpoint"][:-1].count('/'))[0]["mountpoint"]
 
     def can_be_packaged(self):
-        return False
+        return self.mount_free
 
     def has_fstab_entries(self):
         return True
@@ -85,7 +91,7 @@ class RawDevice(BaseDevice):
             except KeyError:
                 pass
             dd_call.append("conv=notrunc")
-            subprocess.check_call(dd_call)
+            executor.check_call(dd_call)
 
             try:
                 keep_in_image = self.data["dd"]["keep_in_image"]
@@ -244,6 +250,11 @@ class RawDevice(BaseDevice):
             try:
                 # Do this print so we can trigger the exception!
                 print("--- Now formatting as {}".format(p["filesystem"]))
+                if self.mount_free:
+                    # Formatted and populated in one go when packaging.
+                    self.pending_filesystems.append((p, partition.number, partition.geometry.start,
+                                                     partition.geometry.end))
+                    continue
                 mkfs_call = ["mkfs." + self.data["filesystem"]]
                 try:
                     if self.data["filesystem"].startswith("ext"):
@@ -252,19 +263,63 @@ class RawDevice(BaseDevice):
                         mkfs_call += ["-n", self.data["label"]]
                 except KeyError:
                     pass
-                mkfs_call += ["/dev/loop7"]
-                with open(os.devnull, "w") as f:
-                    subprocess.check_call(
-                        ["losetup", "-o", str(partition.geometry.start * self.parted_helper.device.sectorSize),
-                         "--sizelimit", str((partition.geometry.end - partition.geometry.start) *
-                                            self.parted_helper.device.sectorSize),
-                         "/dev/loop7", self.filename])
-                    subprocess.check_call([mkfs_call], stdout=f, stderr=f)
-                    subprocess.check_call(["losetup", "-d", "/dev/loop7"])
+                mkfs_call += filesystem_uuid_args(self.data["filesystem"],
+                                                  self.get_partition_uuid(p, partition.number))
+                # Whichever loop device is free: other builds might be running on this host.
+                loop_device = executor.check_output(
+                    ["losetup", "-o", str(partition.geometry.start * self.parted_helper.device.sectorSize),
+                     "--sizelimit", str((partition.geometry.end - partition.geometry.start) *
+                                        self.parted_helper.device.sectorSize),
+                     "--find", "--show", self.filename], universal_newlines=True).strip()
+                try:
+                    with open(os.devnull, "w") as f:
+                        executor.check_call(mkfs_call + [loop_device], stdout=f, stderr=f,
+                                            env=self.builder.get_tool_environment())
+                finally:
+                    executor.check_call(["losetup", "-d", loop_device])
             except KeyError:
                 # Don't care
                 pass
 
+    def get_partition_uuid(self, p, number):
+        return self.get_filesystem_uuid(os.path.basename(self.filename), number, p.get("mountpoint"), p.get("label"))
+
+    def package_target_to_device(self, base_path):
+        # Innermost partitions go first, as each one takes its subtree away from the staged tree.
+        sector_size = self.parted_helper.device.sectorSize
+        self.parted_helper.device.beginExternalAccess()
+        try:
+            for p, number, start, end in sorted(self.pending_filesystems, reverse=True,
+                                                key=lambda x: x[0]["mountpoint"][:-1].count('/')
+                                                if "mountpoint" in x[0] else -1):
+                if "mountpoint" in p:
+                    target_path = os.path.join(base_path, p["mountpoint"][1:])
+                    print("--- Now populating {} as {}".format(p["mountpoint"], p["filesystem"]))
+                    if not os.path.isdir(target_path):
+                        os.makedirs(target_path)
+                else:
+                    target_path = None
+                    print("--- Now formatting partition {} as {}".format(number, p["filesystem"]))
+
+                # Build the filesystem on its own, then place it in the disk image.
+                filesystem_image = "{}.p{}".format(self.filename, number)
+                with open(filesystem_image, "wb") as f:
+                    f.truncate((end - start) * sector_size)
+                populate_filesystem_image(p["filesystem"], filesystem_image, target_path,
+                                          label=p["label"] if "label" in p else None,
+                                          fs_uuid=self.get_partition_uuid(p, number),
+                                          extra_args=["-m", "1"] if p["filesystem"].startswith("ext") else None,
+                                          env=self.builder.get_tool_environment())
+                write_image_at(filesystem_image, self.filename, start * sector_size)
+                os.remove(filesystem_image)
+
+                if target_path:
+                    # What's in here is not part of the parent's filesystem, just leave the mountpoint.
+                    shutil.rmtree(target_path)
+                    os.makedirs(target_path)
+        finally:
+            self.parted_helper.device.endExternalAccess()
+
     def mount_device(self, base_path):
         # We want to sort mountpoints based on the occurrences of the number of / (except for the first one, of course).
         # / must always be mounted first. Then we do a rundown of each single tree level for each mountpoint, so that
@@ -282,7 +337,7 @@ class RawDevice(BaseDevice):
                           .format(os.path.join(base_path, p["mountpoint"][1:]), exc.strerror), file=sys.stderr)
 
             print("--- Mounting {}".format(p["mountpoint"]))
-            subprocess.check_call(
+            executor.check_call(
                 ["mount", "-o", "loop,offset=" + str(self.partition_start[p["mountpoint"]] *
                                                      self.parted_helper.device.sectorSize),
                  self.filename, os.path.join(base_path, p["mountpoint"][1:])])
@@ -291,7 +346,7 @@ class RawDevice(BaseDevice):
     def unmount_device(self):
         for p in reversed(self.mounted_partitions):
             print("--- Unmounting {}".format(p))
-            subprocess.check_call(["umount", p])
+            executor.check_call(["umount", p])
 
     def get_device_files(self):
         return [self.filename]
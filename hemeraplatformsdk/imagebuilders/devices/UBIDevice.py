@@ -3,8 +3,9 @@
 import configparser
 import os
 import shutil
-import subprocess
 
+from hemeraplatformsdk.BuildWorkspace import workspace
+from hemeraplatformsdk.ProcessExecutor import executor
 from hemeraplatformsdk.imagebuilders.devices.BaseDevice import BaseDevice
 
 
@@ -94,11 +95,11 @@ class UBIDevice(BaseDevice):
             filename_img = os.path.join(self.builder.build_dir,
                                         "{}_{}.img".format(self.data["mapped_node"].split("/")[-1].rsplit("p", 1)[0], index))
             # We need to craft the correct commands for mkfs and ubinize
-            subprocess.check_call(["mkfs.ubifs", "-q", "-r", os.path.join(base_path, v["mountpoint"][1:]),
-                                   "-o", filename_img, "-e", str(self.data["logical_eraseblock_size"]),
-                                   "-c", str(int(((v["size"] + 1) * 1024 * 1024) /
-                                                 self.data["logical_eraseblock_size"])),
-                                   "-m", str(self.data["minimum_unit_size"])])
+            executor.check_call(["mkfs.ubifs", "-q", "-r", os.path.join(base_path, v["mountpoint"][1:]),
+                                "-o", filename_img, "-e", str(self.data["logical_eraseblock_size"]),
+                                "-c", str(int(((v["size"] + 1) * 1024 * 1024) /
+                                              self.data["logical_eraseblock_size"])),
+                                "-m", str(self.data["minimum_unit_size"])])
             shutil.rmtree(os.path.join(base_path, v["mountpoint"][1:]))
             # Ignore errors when making dirs
             try:
@@ -129,7 +130,9 @@ class UBIDevice(BaseDevice):
                 'vol_flags': 'autoresize'
             }
 
-            with open(os.path.join(self.builder.build_dir, 'ubifs.conf'), 'w') as configfile:
+            config_filename = os.path.join(workspace.get_path(self.builder.image_name),
+                                           os.path.basename(filename) + ".ubinize.conf")
+            with open(config_filename, 'w') as configfile:
                 ubiconfig.write(configfile)
 
             ubinize_args = ["ubinize", "-o", filename, "-p", str(self.data["physical_eraseblock_size"]), "-m",
@@ -138,11 +141,11 @@ class UBIDevice(BaseDevice):
                 ubinize_args += ["-s", str(self.data["subpage_size"])]
             except KeyError:
                 pass
-            ubinize_args.append(os.path.join(self.builder.build_dir, 'ubifs.conf'))
-            subprocess.check_call(ubinize_args)
+            ubinize_args.append(config_filename)
+            executor.check_call(ubinize_args)
 
             os.remove(filename_img)
-            os.remove(os.path.join(self.builder.build_dir, 'ubifs.conf'))
+            os.remove(config_filename)
 
     def get_device_files(self):
         if self.do_ubinize:
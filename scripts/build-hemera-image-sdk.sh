@@ -26,6 +26,9 @@ if [ "${IMAGE_TYPE}" == "raw" ]; then
 elif [ "${IMAGE_TYPE}" == "squash" ]; then
   # Create a pure fs with no packing, then squash will process it. Do not put additional mic args here!
   mic create fs ${KICKSTART_FILE} -o ${IMAGE_NAME} --cachedir=${MIC_CACHE_DIR} --record-pkgs=name --pkgmgr=zypp --arch=${IMAGE_ARCH}
+elif [ "${IMAGE_TYPE}" == "fs-tree" ]; then
+  # Leave the fs unpacked, the image builder will place it in its partitions straight away.
+  mic create fs ${KICKSTART_FILE} -o ${IMAGE_NAME} --cachedir=${MIC_CACHE_DIR} --record-pkgs=name --pkgmgr=zypp --arch=${IMAGE_ARCH} ${MIC_EXTRA_ARGS}
 else
   mic create ${IMAGE_TYPE} ${KICKSTART_FILE} --pack-to=${IMAGE_NAME}.tar -o ${IMAGE_NAME} --cachedir=${MIC_CACHE_DIR} --record-pkgs=name --pkgmgr=zypp --arch=${IMAGE_ARCH} ${MIC_EXTRA_ARGS}
 fi
@@ -78,12 +78,21 @@ setup(
         # Copy needed files for package
         '': ['kickstart-template.ks', '*.jsonschema']
     },
-    requires=["jsonschema", "parted", "requests", "paramiko", "ratelimit", "scp", "version_utils"],
+    requires=["jsonschema", "parted", "requests", "paramiko", "ratelimit", "scp"],
     scripts=["scripts/mkhemerasquashfs", "scripts/build-hemera-image-sdk.sh"],
     entry_points={
         'console_scripts': [
             'build-hemera-image = hemeraplatformsdk.ImageBuilder:build_hemera_image',
-            'create-hemera-update-packages = hemeraplatformsdk.UpdatePackageGenerator:create_hemera_update_packages'
+            'build-hemera-image-matrix = hemeraplatformsdk.BuildMatrix:build_hemera_image_matrix',
+            'create-hemera-update-packages = hemeraplatformsdk.UpdatePackageGenerator:create_hemera_update_packages',
+            'benchmark-hemera-evr-comparison = '
+            'hemeraplatformsdk.benchmarks.EVRComparisonBenchmark:benchmark_evr_comparison',
+            'benchmark-hemera-squash-profiles = '
+            'hemeraplatformsdk.benchmarks.SquashProfileBenchmark:benchmark_squash_profiles',
+            'benchmark-hemera-hot-paths = '
+            'hemeraplatformsdk.benchmarks.HotPathBenchmark:benchmark_hot_paths',
+            'benchmark-hemera-pipeline = '
+            'hemeraplatformsdk.benchmarks.PipelineBenchmark:benchmark_pipeline'
         ]
     }
 )
@@ -0,0 +1,72 @@
+import unittest
+
+from hemeraplatformsdk.UpdatePackageGenerator import UpdatePathPlanner
+
+PACKAGE_SIZES = {
+    "app-2.0-1.noarch.rpm": 900,
+    "lib-1.1-1.noarch.rpm": 100
+}
+
+
+def release(version, packages, download_size=None):
+    r = {"version": version, "packages": packages}
+    if download_size is not None:
+        r["download_size"] = download_size
+    return r
+
+
+class OversizedDeltasTest(unittest.TestCase):
+    def setUp(self):
+        self.new_release = release("1.2", ["app-2.0-1.noarch.rpm", "lib-1.1-1.noarch.rpm"], download_size=1000)
+        # 900 bytes worth of updates, and 100.
+        self.old_releases = [release("1.0", ["app-1.0-1.noarch.rpm", "lib-1.1-1.noarch.rpm"]),
+                             release("1.1", ["app-2.0-1.noarch.rpm", "lib-1.0-1.noarch.rpm"])]
+
+    def plan(self, **kwargs):
+        return UpdatePathPlanner(self.new_release, self.old_releases, PACKAGE_SIZES, max_delta_ratio=0.5,
+                                 **kwargs).plan()
+
+    def test_skip(self):
+        plan = self.plan(oversized_deltas="skip")
+        self.assertEqual([(d["from_version"], d["oversized"]) for d in plan["deltas"]], [("1.1", False)])
+        self.assertEqual([(d["from_version"], d["estimated_size"]) for d in plan["skipped_deltas"]], [("1.0", 900)])
+        self.assertEqual(plan["paths"]["1.0"]["type"], "full")
+        self.assertEqual(plan["estimated_storage"], 100)
+
+    def test_flag(self):
+        plan = self.plan(oversized_deltas="flag")
+        self.assertEqual(sorted((d["from_version"], d["oversized"]) for d in plan["deltas"]),
+                         [("1.0", True), ("1.1", False)])
+        self.assertEqual(plan["skipped_deltas"], [])
+        self.assertEqual(plan["paths"]["1.0"]["type"], "direct")
+        self.assertEqual(plan["estimated_storage"], 1000)
+
+    def test_without_planning(self):
+        # Without update planning, every delta gets built, however big.
+        plan = UpdatePathPlanner(self.new_release, self.old_releases, PACKAGE_SIZES, skip_oversized=False).plan()
+        self.assertEqual(len(plan["deltas"]), 2)
+        self.assertEqual(plan["skipped_deltas"], [])
+
+
+class ChainedUpdatesTest(unittest.TestCase):
+    def setUp(self):
+        self.new_release = release("1.2", ["app-2.0-1.noarch.rpm", "lib-1.1-1.noarch.rpm"], download_size=10000)
+        self.old_releases = [release("1.0", ["app-1.0-1.noarch.rpm", "lib-1.0-1.noarch.rpm"]),
+                             release("1.1", ["app-2.0-1.noarch.rpm", "lib-1.0-1.noarch.rpm"])]
+
+    def plan(self, step_exists):
+        # Only room for the delta from 1.1: 1.0 has to chain through it, or get the full image.
+        return UpdatePathPlanner(self.new_release, self.old_releases, PACKAGE_SIZES, storage_budget=150 / 1048576,
+                                 chained_updates=True, step_exists=step_exists).plan()
+
+    def test_published_step(self):
+        plan = self.plan(lambda from_version, version: True)
+        self.assertEqual(plan["paths"]["1.0"]["steps"], ["1.0", "1.1", "1.2"])
+
+    def test_missing_step(self):
+        plan = self.plan(lambda from_version, version: False)
+        self.assertEqual(plan["paths"]["1.0"]["type"], "full")
+
+
+if __name__ == "__main__":
+    unittest.main()